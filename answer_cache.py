@@ -0,0 +1,52 @@
+from collections import OrderedDict
+
+
+class AnswerCache:
+    """
+    LRU-кэш готовых ответов на вопросы в чате.
+
+    Ключ — нормализованный вопрос (и страна пользователя), значение — готовый
+    ответ со ссылками на законы (в main.py — вместе с результатом поиска).
+    Кэш привязан к версии базы знаний
+    и очищается, как только она меняется.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, version):
+        if version != self.version:
+            self._entries.clear()
+            self.version = version
+        response = self._entries.get(key)
+        if response is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def put(self, key, response, version):
+        # Ответ, посчитанный по старой версии базы, не сохраняем
+        if self.max_size <= 0 or version != self.version:
+            return
+        self._entries[key] = response
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "entries": len(self),
+        }
@@ -0,0 +1,529 @@
+"""
+Офлайн-бенчмарк горячих путей бота.
+
+python benchmark.py                                   # все сценарии, базы на 50, 5000 и 50000 записей
+python benchmark.py --scenarios match --sizes 50 5000
+python benchmark.py --corpus data/bench_messages.jsonl --repeat 20 --output before.json
+
+Сценарии:
+- match — вопросы из JSONL-корпуса ({"text": ..., "country": ...}) проходят
+  через handle_question на синтетических базах знаний разного размера;
+- wizard — мастер /document от выбора типа до PDF, YaLM API подменяется
+  локальным сервером (--llm-delay — задержка ответа, --stream — потоковый режим);
+- pdf — рендеринг документов через create_pdf;
+- startup — холодный старт в новом процессе: импорт main, готовность
+  принимать обновления (on_startup), загрузка базы, первый ответ и
+  окончание фонового прогрева. --startup-target — целевое время готовности
+  в секундах, при превышении медианы бенчмарк завершается с кодом 1.
+
+Каждый сценарий выполняется в отдельном процессе, поэтому пиковая память
+(RSS) не смешивается между сценариями. Сеть и токен Telegram не нужны:
+запросы к Bot API перехватываются сессией-заглушкой.
+"""
+import os
+import sys
+import json
+import time
+import math
+import random
+import asyncio
+import argparse
+import shutil
+import resource
+import tempfile
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+from search import TOKEN_RE
+
+BENCH_TOKEN = "123456:benchmark-token"
+BENCH_CHAT_ID = 1000
+
+# Цель по времени от импорта main до готовности принимать обновления, в секундах
+STARTUP_TARGET = 5.0
+
+# Данные, которыми бенчмарк заполняет поля мастера документов
+FIELD_VALUE = "Иванов Иван Иванович, г. Москва, ул. Ленина, д. 1"
+
+
+def percentile(values, p):
+    """Перцентиль по методу ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def summarize(name, size, latencies, elapsed):
+    return {
+        "scenario": name,
+        "size": size,
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss в Linux — килобайты
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def synthesize_knowledge_base(base, size, seed=0):
+    """
+    Синтетическая база знаний на size записей: копии настоящих записей,
+    к вопросам и синонимам которых добавлены случайные слова из словаря базы,
+    страны распределены по кругу.
+    """
+    from partitions import COUNTRIES
+
+    rng = random.Random(seed)
+    vocabulary = sorted({
+        word for item in base
+        for text in [item["question"], item["answer"], *item.get("synonyms", [])]
+        for word in TOKEN_RE.findall(text.lower()) if len(word) > 3
+    })
+    entries = []
+    for position in range(size):
+        item = dict(base[position % len(base)])
+        if position >= len(base):
+            suffix = " ".join(rng.sample(vocabulary, 3))
+            item["question"] = f"{item['question']} {suffix}"
+            item["synonyms"] = [f"{synonym} {suffix}" for synonym in item.get("synonyms", [])]
+            item["country"] = [COUNTRIES[position // len(base) % len(COUNTRIES)]]
+        item["id"] = position + 1
+        entries.append(item)
+    return entries
+
+
+def load_corpus(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def mock_document_text(doc_type, paragraphs=12):
+    """Текст документа, похожий на ответ YaLM API"""
+    lines = [doc_type.upper(), "", f"г. Москва, {datetime.now().strftime('%d.%m.%Y')}", ""]
+    for number in range(1, paragraphs + 1):
+        lines.append(
+            f"{number}. В соответствии с требованиями действующего законодательства стороны "
+            f"подтверждают обстоятельства, изложенные в настоящем документе, и обязуются "
+            f"исполнить свои обязательства в установленный срок."
+        )
+    lines += ["", "Прошу рассмотреть настоящий документ и удовлетворить требования.",
+              f"Ф.И.О.: {FIELD_VALUE}", "Дата: ____________"]
+    return "\n".join(lines)
+
+
+def make_session():
+    """Сессия Bot API, которая отвечает сама, не обращаясь к Telegram"""
+    from aiogram import types
+    from aiogram.client.session.base import BaseSession
+
+    class BenchSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.requests = 0
+
+        async def make_request(self, bot, method, timeout=None):
+            self.requests += 1
+            # Файлы вычитываются так же, как при настоящей отправке
+            for value in method.__dict__.values():
+                if isinstance(value, types.InputFile):
+                    async for _ in value.read(bot):
+                        pass
+            if method.__returning__ is not types.Message:
+                return True
+            return types.Message(
+                message_id=self.requests,
+                date=datetime.now(),
+                chat=types.Chat(id=getattr(method, "chat_id", BENCH_CHAT_ID), type="private"),
+                text=getattr(method, "text", None),
+            ).as_(bot)
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b""
+
+        async def close(self):
+            pass
+
+    return BenchSession()
+
+
+def make_message(bot, text, chat_id=BENCH_CHAT_ID, message_id=1):
+    from aiogram import types
+
+    return types.Message.model_validate({
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+        "text": text,
+    }, context={"bot": bot})
+
+
+def import_bot(kb_path, options):
+    """Импортирует main с настройками для бенчмарка: без сети, кэшей и фоновых задач"""
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "KB_PATH": kb_path,
+        "KB_WATCH_INTERVAL": "0",
+        "METRICS_PORT": "0",
+        "FSM_STORAGE": "memory",
+        "DOC_CACHE": "off",
+        "ANSWER_CACHE_SIZE": str(options["answer_cache"]),
+        "YALM_STREAM": "1" if options["stream"] else "0",
+        "PDF_WORKERS": str(options["pdf_workers"]),
+        # Бенчмарк шлет сотни сообщений от нескольких пользователей — лимиты не нужны
+        "THROTTLE_RATE": "0",
+        "THROTTLE_EXPENSIVE_RATE": "0",
+        "THROTTLE_CHAT_IN_FLIGHT": "0",
+        "THROTTLE_MAX_QUEUE": "0",
+    })
+    import main
+    main.bot.session = make_session()
+    return main
+
+
+async def bench_match(main, kb_path, size, options):
+    from aiogram.fsm.context import FSMContext
+    from aiogram.fsm.storage.base import StorageKey
+    from knowledge_base import KnowledgeBase
+
+    rss_before = peak_rss_mb()
+    started = time.perf_counter()
+    main.knowledge_base = KnowledgeBase(
+        kb_path,
+        search_mode=options["search_mode"],
+        category_routing=options["category_routing"],
+        routes_path=os.path.join(os.path.dirname(options["base"]), "keyword_routes.json")
+    )
+    main.knowledge_base.load()
+    load_seconds = time.perf_counter() - started
+    kb_memory = peak_rss_mb() - rss_before
+
+    # Для каждой страны корпуса — свой пользователь с сохраненной настройкой
+    corpus = load_corpus(options["corpus"])
+    states = {}
+    for chat_id, country in enumerate(sorted({str(record.get("country")) for record in corpus}), BENCH_CHAT_ID):
+        state = FSMContext(main.storage, StorageKey(main.bot.id, chat_id, chat_id))
+        if country != "None":
+            await main.user_settings(state).update_data(country=country)
+        states[country] = (chat_id, state)
+
+    messages = []
+    for record in corpus:
+        chat_id, state = states[str(record.get("country"))]
+        messages.append((make_message(main.bot, record["text"], chat_id), state))
+
+    for message, state in messages[:options["warmup"]]:
+        await main.handle_question(message, state)
+
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(options["repeat"]):
+        for message, state in messages:
+            call_started = time.perf_counter()
+            await main.handle_question(message, state)
+            latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+
+    row = summarize("match", size, latencies, elapsed)
+    row["load_seconds"] = load_seconds
+    row["kb_memory_mb"] = kb_memory
+    return [row]
+
+
+async def start_mock_yalm(options):
+    """Локальный сервер, отвечающий в формате YaLM API"""
+    from aiohttp import web
+
+    async def handle_completion(request):
+        payload = await request.json()
+        prompt = payload["messages"][-1]["text"]
+        doc_type = prompt.split(":", 1)[-1].split("\n", 1)[0].strip()
+        text = mock_document_text(doc_type)
+        if not payload["completionOptions"]["stream"]:
+            await asyncio.sleep(options["llm_delay"])
+            return web.json_response({"result": {"alternatives": [{"message": {"text": text}}]}})
+
+        response = web.StreamResponse()
+        await response.prepare(request)
+        chunks = options["llm_chunks"]
+        for number in range(1, chunks + 1):
+            await asyncio.sleep(options["llm_delay"] / chunks)
+            partial = text[:len(text) * number // chunks]
+            line = json.dumps({"result": {"alternatives": [{"message": {"text": partial}}]}}, ensure_ascii=False)
+            await response.write(line.encode("utf-8") + b"\n")
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_post("/completion", handle_completion)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/completion"
+
+
+async def bench_wizard(main, size, options):
+    from aiogram import types
+    runner, url = await start_mock_yalm(options)
+    # Клиент уже подключен к планировщику запросов, поэтому только перенаправляем его
+    main.yalm_client.api_key = main.yalm_client.catalog_id = "benchmark"
+    main.yalm_client.api_url = url
+    await main.pdf_renderer.warm_up()
+    doc_types = list(main.DOCUMENT_TEMPLATES)
+    step_latencies = []
+    confirm_latencies = []
+    flow_latencies = []
+
+    async def feed(chat_id, update_id, text):
+        message = make_message(main.bot, text, chat_id, update_id)
+        update = types.Update(update_id=update_id, message=message)
+        started = time.perf_counter()
+        await main.dp.feed_update(main.bot, update)
+        return time.perf_counter() - started
+
+    async def run_flow(user):
+        chat_id = BENCH_CHAT_ID + user
+        doc_type = doc_types[user % len(doc_types)]
+        texts = ["/document", doc_type]
+        texts += [f"{FIELD_VALUE} ({user})"] * len(main.DOCUMENT_TEMPLATES[doc_type]["required_fields"])
+        started = time.perf_counter()
+        for update_id, text in enumerate(texts):
+            step_latencies.append(await feed(chat_id, update_id, text))
+        confirm_latencies.append(await feed(chat_id, len(texts), "Да, все верно"))
+        flow_latencies.append(time.perf_counter() - started)
+
+    try:
+        # Прогрев: соединение с заглушкой, пул PDF, первые импорты
+        await run_flow(0)
+        for latencies in (step_latencies, confirm_latencies, flow_latencies):
+            latencies.clear()
+
+        started = time.perf_counter()
+        for batch_start in range(0, options["wizard_runs"], options["users"]):
+            users = range(batch_start, min(batch_start + options["users"], options["wizard_runs"]))
+            await asyncio.gather(*[run_flow(user) for user in users])
+        elapsed = time.perf_counter() - started
+    finally:
+        await main.yalm_scheduler.close()
+        main.pdf_renderer.close()
+        await runner.cleanup()
+
+    return [
+        summarize("wizard.step", size, step_latencies, elapsed),
+        summarize("wizard.confirm", size, confirm_latencies, elapsed),
+        summarize("wizard.flow", size, flow_latencies, elapsed),
+    ]
+
+
+def bench_pdf(size, options):
+    from pdf_render import create_pdf, get_styles
+
+    get_styles()
+    documents = [
+        (doc_type, mock_document_text(doc_type, paragraphs))
+        for doc_type in ["Претензия на возврат товара", "Договор аренды квартиры"]
+        for paragraphs in (5, 20, 60)
+    ]
+    latencies = []
+    sizes = []
+    started = time.perf_counter()
+    for run in range(options["pdf_runs"]):
+        doc_type, text = documents[run % len(documents)]
+        call_started = time.perf_counter()
+        buffer = create_pdf(text, doc_type)
+        latencies.append(time.perf_counter() - call_started)
+        sizes.append(len(buffer.getvalue()) if buffer else 0)
+    elapsed = time.perf_counter() - started
+
+    row = summarize("pdf", size, latencies, elapsed)
+    row["avg_pdf_kb"] = sum(sizes) / len(sizes) / 1024 if sizes else 0.0
+    return [row]
+
+
+def startup_once(kb_path, options):
+    """Один холодный старт: время этапов от начала импорта main, в секундах"""
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+    started = time.perf_counter()
+    main = import_bot(kb_path, options)
+    logging.getLogger().setLevel(logging.WARNING)
+    timings = {"import": time.perf_counter() - started}
+
+    async def start():
+        await main.on_startup()
+        # С этого момента бот уже опрашивает Telegram или принимает webhook
+        timings["ready"] = time.perf_counter() - started
+        await main.knowledge_base.wait_ready()
+        timings["kb"] = time.perf_counter() - started
+        from aiogram.fsm.context import FSMContext
+        from aiogram.fsm.storage.base import StorageKey
+
+        state = FSMContext(main.storage, StorageKey(main.bot.id, BENCH_CHAT_ID, BENCH_CHAT_ID))
+        await main.handle_question(make_message(main.bot, "Меня уволили без причины"), state)
+        timings["first_answer"] = time.perf_counter() - started
+        await asyncio.gather(*main.warmup_tasks)
+        timings["warm"] = time.perf_counter() - started
+        await main.on_shutdown()
+
+    asyncio.run(start())
+    timings["peak_rss_mb"] = peak_rss_mb()
+    return timings
+
+
+def run_case(scenario, kb_path, size, options):
+    """Один сценарий в отдельном процессе"""
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+    # main при импорте включает INFO-логи, они исказили бы замеры
+    main = import_bot(options["base"], options)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if scenario == "match":
+        rows = asyncio.run(bench_match(main, kb_path, size, options))
+    elif scenario == "wizard":
+        rows = asyncio.run(bench_wizard(main, size, options))
+    else:
+        rows = bench_pdf(size, options)
+    for row in rows:
+        row["peak_rss_mb"] = peak_rss_mb()
+    return rows
+
+
+def bench_startup(context, kb_path, size, options):
+    """Несколько холодных стартов, каждый в новом процессе"""
+    runs = []
+    for _ in range(options["startup_runs"]):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            runs.append(executor.submit(startup_once, kb_path, options).result())
+    rows = []
+    for stage in ("import", "ready", "kb", "first_answer", "warm"):
+        row = summarize(f"startup.{stage}", size, [run[stage] for run in runs], 0)
+        row["peak_rss_mb"] = max(run["peak_rss_mb"] for run in runs)
+        rows.append(row)
+    return rows
+
+
+def print_rows(rows):
+    header = f"{'сценарий':<22}{'база':>8}{'n':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'опер/с':>10}{'RSS МБ':>9}  прочее"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        extra = []
+        if "load_seconds" in row:
+            extra.append(f"загрузка базы {row['load_seconds']:.2f} с, +{row['kb_memory_mb']:.0f} МБ")
+        if "avg_pdf_kb" in row:
+            extra.append(f"PDF в среднем {row['avg_pdf_kb']:.0f} КБ")
+        print(f"{row['scenario']:<22}{row['size']:>8}{row['count']:>8}{row['p50_ms']:>10.2f}"
+              f"{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}{row['throughput']:>10.1f}"
+              f"{row['peak_rss_mb']:>9.0f}  {', '.join(extra)}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Бенчмарк поиска ответов, мастера документов и PDF")
+    parser.add_argument("--scenarios", nargs="+", default=["match", "wizard", "pdf", "startup"],
+                        choices=["match", "wizard", "pdf", "startup"])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[50, 5000, 50000],
+                        help="размеры синтетических баз знаний для сценариев match и startup")
+    parser.add_argument("--base", default="data/qa_base.json", help="исходная база знаний")
+    parser.add_argument("--corpus", default="data/bench_messages.jsonl", help="JSONL с сообщениями пользователей")
+    parser.add_argument("--repeat", type=int, default=10, help="сколько раз прогнать корпус")
+    parser.add_argument("--warmup", type=int, default=10, help="сообщений для прогрева перед замером")
+    parser.add_argument("--binary", action="store_true", help="искать по скомпилированной базе (kb_binary.py)")
+    parser.add_argument("--search-mode", default="fuzzy", choices=["fuzzy", "hybrid", "semantic"])
+    parser.add_argument("--category-routing", action="store_true")
+    parser.add_argument("--answer-cache", type=int, default=0, help="размер кэша ответов (0 — без кэша)")
+    parser.add_argument("--wizard-runs", type=int, default=30, help="число прохождений мастера")
+    parser.add_argument("--users", type=int, default=5, help="одновременных пользователей мастера")
+    parser.add_argument("--stream", action="store_true", help="потоковая генерация документа")
+    parser.add_argument("--llm-delay", type=float, default=0.2, help="задержка ответа заглушки YaLM API, с")
+    parser.add_argument("--llm-chunks", type=int, default=10, help="частей ответа в потоковом режиме")
+    parser.add_argument("--pdf-runs", type=int, default=60)
+    parser.add_argument("--pdf-workers", type=int, default=2)
+    parser.add_argument("--startup-runs", type=int, default=3, help="число холодных стартов")
+    parser.add_argument("--startup-target", type=float, default=STARTUP_TARGET,
+                        help="целевая медиана времени до готовности принимать обновления, с (0 — не проверять)")
+    parser.add_argument("--output", help="сохранить результаты в JSON для сравнения")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = {
+        "base": args.base,
+        "corpus": args.corpus,
+        "repeat": args.repeat,
+        "warmup": args.warmup,
+        "search_mode": args.search_mode,
+        "category_routing": args.category_routing,
+        "answer_cache": args.answer_cache,
+        "wizard_runs": args.wizard_runs,
+        "users": args.users,
+        "stream": args.stream,
+        "llm_delay": args.llm_delay,
+        "llm_chunks": args.llm_chunks,
+        "pdf_runs": args.pdf_runs,
+        "pdf_workers": args.pdf_workers,
+        "startup_runs": args.startup_runs,
+    }
+    with open(args.base, "r", encoding="utf-8") as f:
+        base = json.load(f)
+
+    rows = []
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(prefix="lexoai-bench-") as workdir:
+        # Таблица ключевых слов ищется рядом с базой знаний
+        routes_path = os.path.join(os.path.dirname(args.base), "keyword_routes.json")
+        if os.path.exists(routes_path):
+            shutil.copy(routes_path, workdir)
+        cases = []
+        if "match" in args.scenarios or "startup" in args.scenarios:
+            for size in args.sizes:
+                kb_path = os.path.join(workdir, f"qa_{size}.json")
+                with open(kb_path, "w", encoding="utf-8") as f:
+                    json.dump(synthesize_knowledge_base(base, size), f, ensure_ascii=False)
+                if args.binary:
+                    from kb_binary import build
+                    build(kb_path, kb_path[:-len(".json")] + ".bin")
+                    kb_path = kb_path[:-len(".json")] + ".bin"
+                if "match" in args.scenarios:
+                    cases.append(("match", kb_path, size))
+                if "startup" in args.scenarios:
+                    cases.append(("startup", kb_path, size))
+        for scenario in ("wizard", "pdf"):
+            if scenario in args.scenarios:
+                cases.append((scenario, args.base, len(base)))
+
+        for scenario, kb_path, size in cases:
+            print(f"{scenario}, база {size}...", file=sys.stderr)
+            if scenario == "startup":
+                rows += bench_startup(context, kb_path, size, options)
+                continue
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                rows += executor.submit(run_case, scenario, kb_path, size, options).result()
+
+    print_rows(rows)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"options": options, "results": rows}, f, ensure_ascii=False, indent=2)
+
+    slow_starts = [
+        row for row in rows
+        if row["scenario"] == "startup.ready" and args.startup_target and row["p50_ms"] > args.startup_target * 1000
+    ]
+    for row in slow_starts:
+        print(f"Старт с базой {row['size']}: {row['p50_ms'] / 1000:.2f} с, цель {args.startup_target:.2f} с",
+              file=sys.stderr)
+    return 1 if slow_starts else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
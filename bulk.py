@@ -0,0 +1,142 @@
+"""
+Пакетная генерация документов из таблицы.
+
+Строки CSV (заголовок — названия полей) или JSONL (по объекту на строку)
+проверяются по required_fields шаблона, затем документы генерируются и
+верстаются параллельно, но не больше concurrency одновременно: скорость
+ограничивает квота YaLM API, а не переписка в чате. Результат — один
+ZIP-архив с PDF и отчетом report.csv.
+"""
+import io
+import os
+import csv
+import json
+import asyncio
+import logging
+import zipfile
+import tempfile
+
+from pdf_render import discard_pdf
+
+logger = logging.getLogger(__name__)
+
+
+class BulkError(Exception):
+    """Файл не удалось разобрать или в нем нет ни одной подходящей строки"""
+
+
+def parse_rows(data, filename, max_rows=200):
+    """Читает строки из CSV или JSONL, возвращает список словарей"""
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise BulkError("Файл должен быть в кодировке UTF-8")
+
+    if filename.lower().endswith((".jsonl", ".json")):
+        rows = []
+        for number, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                raise BulkError(f"Строка {number}: некорректный JSON")
+            if not isinstance(row, dict):
+                raise BulkError(f"Строка {number}: ожидается объект с полями документа")
+            rows.append(row)
+    else:
+        # Excel сохраняет CSV с ";" в русской локали
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        rows = list(csv.DictReader(io.StringIO(text), dialect=dialect))
+
+    if not rows:
+        raise BulkError("В файле нет ни одной строки")
+    if len(rows) > max_rows:
+        raise BulkError(f"Слишком много строк: {len(rows)}, максимум {max_rows}")
+    return rows
+
+
+def validate_rows(rows, required_fields):
+    """
+    Делит строки на годные и ошибочные.
+    Возвращает ([(номер, поля)], [(номер, текст ошибки)]), номера с 1.
+    """
+    valid = []
+    errors = []
+    for number, row in enumerate(rows, 1):
+        context = {
+            str(key).strip(): str(value).strip()
+            for key, value in row.items() if key is not None and value is not None
+        }
+        missing = [field for field in required_fields if not context.get(field)]
+        if missing:
+            errors.append((number, f"не заполнены поля: {', '.join(missing)}"))
+        else:
+            valid.append((number, context))
+    return valid, errors
+
+
+async def generate_bulk(rows, generate_text, render_pdf, concurrency=8, on_progress=None, directory=None):
+    """
+    Генерирует документы для годных строк и собирает ZIP во временном файле.
+
+    rows — [(номер, поля)], generate_text(поля) — корутина с текстом
+    документа (исключение при ошибке), render_pdf(текст) — корутина с путем
+    к временному PDF или None. on_progress(готово, всего) вызывается после
+    каждой строки. Возвращает (путь к архиву, [(номер, ошибка)]); архив
+    удаляет вызывающий.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    zip_lock = asyncio.Lock()
+    failures = []
+    done = 0
+
+    fd, zip_path = tempfile.mkstemp(prefix="lexoai-bulk-", suffix=".zip", dir=directory)
+    os.close(fd)
+    archive = zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED)
+
+    async def process(number, context):
+        nonlocal done
+        pdf_path = None
+        try:
+            async with semaphore:
+                text = await generate_text(context)
+                pdf_path = await render_pdf(text)
+            async with zip_lock:
+                if pdf_path is not None:
+                    await asyncio.to_thread(archive.write, pdf_path, f"{number:03d}.pdf")
+                else:
+                    # PDF не собрался — кладем хотя бы текст документа
+                    failures.append((number, "не удалось создать PDF, приложен текст"))
+                    await asyncio.to_thread(archive.writestr, f"{number:03d}.txt", text)
+        except Exception as e:
+            logger.error(f"Пакетная генерация, строка {number}: {e}")
+            failures.append((number, f"ошибка генерации: {e}"))
+        finally:
+            if pdf_path is not None:
+                discard_pdf(pdf_path)
+            done += 1
+            if on_progress is not None:
+                await on_progress(done, len(rows))
+
+    try:
+        await asyncio.gather(*[process(number, context) for number, context in rows])
+    finally:
+        archive.close()
+    return zip_path, sorted(failures)
+
+
+def add_report(zip_path, rows, errors):
+    """Дописывает в архив report.csv: статус каждой строки исходного файла"""
+    problems = dict(errors)
+    report = io.StringIO()
+    writer = csv.writer(report)
+    writer.writerow(["строка", "статус"])
+    for number in range(1, rows + 1):
+        writer.writerow([number, problems.get(number, "готово")])
+    with zipfile.ZipFile(zip_path, "a", compression=zipfile.ZIP_DEFLATED) as archive:
+        # BOM, чтобы Excel открыл отчет в правильной кодировке
+        archive.writestr("report.csv", "﻿" + report.getvalue())
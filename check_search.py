@@ -0,0 +1,129 @@
+"""
+Проверка, что ускорения поиска не меняют ответы.
+
+Сообщения из корпуса бенчмарка и искаженные фразы самой базы (перестановка
+и пропуск слов, опечатки) проходят через полный перебор всех фраз с
+calculate_similarity и через QAIndex.lookup — с теми же top_k и exact_limit,
+что у бота (KB_TOP_K и KB_EXACT_LIMIT, по умолчанию как в main.py), — и
+через бинарную базу (kb_binary.py). Ответы должны совпадать с перебором до
+записи, любое расхождение — ошибка (код выхода 1).
+
+python check_search.py
+python check_search.py --base data/qa_base.json --perturbed 1000
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+
+import kb_binary
+from search import QAIndex, SIMILARITY_THRESHOLD, calculate_similarity, preprocess_text
+
+
+def linear_match(index, query, threshold=SIMILARITY_THRESHOLD):
+    """Эталон: ratio со всеми фразами, при равенстве — запись, которая раньше в базе"""
+    best_entry_index = None
+    best_ratio = threshold
+    for phrase_id in range(len(index.phrases)):
+        entry_index, processed, _ = index.phrases[phrase_id]
+        ratio = calculate_similarity(query, processed)
+        if ratio > best_ratio or (
+            ratio == best_ratio and best_entry_index is not None and entry_index < best_entry_index
+        ):
+            best_ratio = ratio
+            best_entry_index = entry_index
+    return best_entry_index, best_ratio
+
+
+def perturb(phrase, rng):
+    """Фраза базы с одним случайным искажением"""
+    words = phrase.split()
+    kind = rng.randrange(4)
+    if kind == 0 and len(words) > 1:
+        rng.shuffle(words)
+    elif kind == 1 and len(words) > 1:
+        del words[rng.randrange(len(words))]
+    elif kind == 2:
+        # Опечатка: соседние буквы меняются местами
+        word_index = rng.randrange(len(words))
+        word = words[word_index]
+        if len(word) > 2:
+            i = rng.randrange(len(word) - 1)
+            words[word_index] = word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    else:
+        words.append(rng.choice(["пожалуйста", "срочно", "как быть", "подскажите"]))
+    return " ".join(words)
+
+
+def build_queries(base, corpus_path, perturbed, seed=0):
+    queries = []
+    if os.path.exists(corpus_path):
+        with open(corpus_path, "r", encoding="utf-8") as f:
+            queries.extend(preprocess_text(json.loads(line)["text"]) for line in f if line.strip())
+    phrases = [
+        preprocess_text(text) for item in base for text in [item["question"], *item.get("synonyms", [])]
+    ]
+    rng = random.Random(seed)
+    queries.extend(perturb(rng.choice(phrases), rng) for _ in range(perturbed))
+    return [query for query in queries if query]
+
+
+def entry_ids(index, query):
+    """id записи, которую вернул lookup, и оценка"""
+    item, _, score = index.lookup(query)
+    if item is None:
+        return None, 0.0
+    return item.get("id"), score
+
+
+def compare(name, expected, actual, queries):
+    mismatches = [
+        (query, want, got) for query, want, got in zip(queries, expected, actual) if want[0] != got[0]
+    ]
+    print(f"{name}: расхождений {len(mismatches)} из {len(queries)} ({'ошибка' if mismatches else 'ок'})")
+    for query, want, got in mismatches[:10]:
+        print(f"  {query!r}: перебор {want[0]} ({want[1]:.3f}), индекс {got[0]} ({got[1]:.3f})")
+    return not mismatches
+
+
+def expected_matches(base, index, queries):
+    """Ответы полного перебора: (id записи, оценка) или (None, 0.0)"""
+    expected = []
+    for query in queries:
+        entry_index, ratio = linear_match(index, query)
+        expected.append((None, 0.0) if entry_index is None else (base[entry_index].get("id"), ratio))
+    return expected
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base", default="data/qa_base.json", help="база знаний")
+    parser.add_argument("--corpus", default="data/bench_messages.jsonl", help="JSONL с сообщениями пользователей")
+    parser.add_argument("--perturbed", type=int, default=400, help="сколько искаженных фраз базы добавить")
+    parser.add_argument("--top-k", type=int, default=int(os.getenv("KB_TOP_K", "50")))
+    parser.add_argument("--exact-limit", type=int, default=int(os.getenv("KB_EXACT_LIMIT", "2000")))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    with open(args.base, "r", encoding="utf-8") as f:
+        base = json.load(f)
+    queries = build_queries(base, args.corpus, args.perturbed, args.seed)
+    settings = f"top_k={args.top_k}, exact_limit={args.exact_limit}"
+
+    index = QAIndex(base, top_k=args.top_k, exact_limit=args.exact_limit)
+    expected = expected_matches(base, index, queries)
+    ok = compare(f"QAIndex, {settings}", expected, [entry_ids(index, q) for q in queries], queries)
+
+    with tempfile.TemporaryDirectory() as directory:
+        bin_path = os.path.join(directory, "qa_base.bin")
+        kb_binary.build(args.base, bin_path)
+        binary_index = kb_binary.MmapQAIndex(bin_path, top_k=args.top_k, exact_limit=args.exact_limit)
+        ok &= compare(f"MmapQAIndex, {settings}", expected, [entry_ids(binary_index, q) for q in queries],
+                      queries)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
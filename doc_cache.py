@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+# text — сгенерированный текст, pdf — байты PDF (или None), pdf_date — дата, с которой собран PDF
+CachedDocument = namedtuple("CachedDocument", ["text", "pdf", "pdf_date"])
+
+
+def make_cache_key(payload):
+    """Ключ кэша — хэш полностью сформированного запроса к модели"""
+    data = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class DocumentCache:
+    """
+    Общая часть кэшей: счетчики попаданий и промахов.
+    Из обработчиков кэш вызывается через aget, aput и aset_pdf: кэш на диске
+    выполняет их в потоке, чтобы не блокировать цикл событий.
+    """
+
+    def __init__(self, ttl=24 * 3600, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def _count(self, entry):
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hit_ratio,
+            "entries": len(self),
+        }
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def put(self, key, text):
+        raise NotImplementedError
+
+    def set_pdf(self, key, pdf, pdf_date):
+        raise NotImplementedError
+
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aput(self, key, text):
+        self.put(key, text)
+
+    async def aset_pdf(self, key, pdf, pdf_date):
+        self.set_pdf(key, pdf, pdf_date)
+
+    def close(self):
+        pass
+
+
+class MemoryDocumentCache(DocumentCache):
+    """LRU-кэш в памяти с ограничением по числу записей, объему и времени жизни"""
+
+    def __init__(self, ttl=24 * 3600, max_entries=1000, max_bytes=64 * 1024 * 1024):
+        super().__init__(ttl, max_entries)
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        # key -> (время записи, CachedDocument)
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _entry_size(document):
+        return len(document.text.encode("utf-8")) + len(document.pdf or b"")
+
+    def _remove(self, key):
+        _, document = self._entries.pop(key)
+        self.size_bytes -= self._entry_size(document)
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+    def get(self, key):
+        item = self._entries.get(key)
+        if item is None:
+            return self._count(None)
+        created, document = item
+        if time.time() - created > self.ttl:
+            self._remove(key)
+            return self._count(None)
+        self._entries.move_to_end(key)
+        return self._count(document)
+
+    def put(self, key, text):
+        if key in self._entries:
+            self._remove(key)
+        document = CachedDocument(text, None, None)
+        self._entries[key] = (time.time(), document)
+        self.size_bytes += self._entry_size(document)
+        self._evict()
+
+    def set_pdf(self, key, pdf, pdf_date):
+        item = self._entries.get(key)
+        if item is None:
+            return
+        created, document = item
+        self.size_bytes -= self._entry_size(document)
+        document = document._replace(pdf=pdf, pdf_date=pdf_date)
+        self._entries[key] = (created, document)
+        self.size_bytes += self._entry_size(document)
+        self._evict()
+
+
+class SQLiteDocumentCache(DocumentCache):
+    """
+    Кэш на диске в SQLite, переживает перезапуск бота.
+    Вытеснение — по времени жизни и по числу записей (сначала самые давно использованные).
+    """
+
+    def __init__(self, path, ttl=24 * 3600, max_entries=1000):
+        super().__init__(ttl, max_entries)
+        self.path = path
+        self._lock = threading.Lock()
+        # Соединение открывается при первом обращении в каждом процессе,
+        # чтобы процессы webhook-сервера не делили соединение родителя
+        self._pid = None
+        self._conn = None
+
+    def _connection(self):
+        """Соединение текущего процесса; вызывается под self._lock"""
+        pid = os.getpid()
+        if self._pid != pid:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "key TEXT PRIMARY KEY, text TEXT NOT NULL, pdf BLOB, pdf_date TEXT, "
+                "created REAL NOT NULL, used REAL NOT NULL)"
+            )
+            conn.commit()
+            self._conn = conn
+            self._pid = pid
+        return self._conn
+
+    def __len__(self):
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT text, pdf, pdf_date, created FROM documents WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return self._count(None)
+            text, pdf, pdf_date, created = row
+            if now - created > self.ttl:
+                self._conn.execute("DELETE FROM documents WHERE key = ?", (key,))
+                self._conn.commit()
+                return self._count(None)
+            self._conn.execute("UPDATE documents SET used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return self._count(CachedDocument(text, pdf, pdf_date))
+
+    def put(self, key, text):
+        now = time.time()
+        with self._lock:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO documents (key, text, pdf, pdf_date, created, used) "
+                "VALUES (?, ?, NULL, NULL, ?, ?)",
+                (key, text, now, now)
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def set_pdf(self, key, pdf, pdf_date):
+        with self._lock:
+            self._connection().execute(
+                "UPDATE documents SET pdf = ?, pdf_date = ? WHERE key = ?", (pdf, pdf_date, key)
+            )
+            self._conn.commit()
+
+    async def aget(self, key):
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key, text):
+        await asyncio.to_thread(self.put, key, text)
+
+    async def aset_pdf(self, key, pdf, pdf_date):
+        await asyncio.to_thread(self.set_pdf, key, pdf, pdf_date)
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM documents WHERE created < ?", (now - self.ttl,))
+        self._conn.execute(
+            "DELETE FROM documents WHERE key NOT IN "
+            "(SELECT key FROM documents ORDER BY used DESC LIMIT ?)",
+            (self.max_entries,)
+        )
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._conn.close()
+                self._pid = None
+
+
+def create_document_cache_from_env():
+    """
+    Создает кэш документов по переменным окружения:
+    DOC_CACHE=memory|sqlite|off, DOC_CACHE_PATH, DOC_CACHE_TTL, DOC_CACHE_MAX_ENTRIES, DOC_CACHE_MAX_MB
+    """
+    backend = os.getenv("DOC_CACHE", "memory").lower()
+    ttl = float(os.getenv("DOC_CACHE_TTL", str(24 * 3600)))
+    max_entries = int(os.getenv("DOC_CACHE_MAX_ENTRIES", "1000"))
+
+    if backend == "off":
+        return None
+    if backend == "sqlite":
+        path = os.getenv("DOC_CACHE_PATH", "data/doc_cache.sqlite3")
+        logger.info(f"Кэш документов: SQLite ({path})")
+        return SQLiteDocumentCache(path, ttl=ttl, max_entries=max_entries)
+
+    max_bytes = int(float(os.getenv("DOC_CACHE_MAX_MB", "64")) * 1024 * 1024)
+    return MemoryDocumentCache(ttl=ttl, max_entries=max_entries, max_bytes=max_bytes)
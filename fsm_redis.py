@@ -0,0 +1,69 @@
+"""
+Хранилище FSM в Redis (нужен пакет redis) с атомарной записью для StateSession.
+
+Состояние и данные пишутся одной транзакцией MULTI/EXEC, а рядом хранится
+счетчик версий записи: StateSession передает версию, прочитанную при входе,
+и запись проходит, только если ее никто не изменил (WATCH). Остальные
+операции — как у RedisStorage из aiogram, они тоже увеличивают версию.
+"""
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+from redis.exceptions import WatchError
+
+
+class VersionedRedisStorage(RedisStorage):
+    """RedisStorage с set_state_and_data и версиями записей"""
+
+    def _keys(self, key: StorageKey):
+        return (
+            self.key_builder.build(key, "state"),
+            self.key_builder.build(key, "data"),
+            self.key_builder.build(key, "version"),
+        )
+
+    async def set_state(self, key: StorageKey, state=None):
+        await super().set_state(key, state)
+        await self.redis.incr(self._keys(key)[2])
+
+    async def set_data(self, key: StorageKey, data):
+        await super().set_data(key, data)
+        await self.redis.incr(self._keys(key)[2])
+
+    async def get_record(self, key: StorageKey):
+        """Состояние, данные и версия записи одним запросом"""
+        state, data, version = await self.redis.mget(self._keys(key))
+        if isinstance(state, bytes):
+            state = state.decode("utf-8")
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        return state, self.json_loads(data) if data else {}, int(version or 0)
+
+    async def set_state_and_data(self, key: StorageKey, state, data, version=None):
+        """
+        Записывает состояние и данные одной транзакцией. С version — только если
+        версия записи не изменилась с тех пор, как ее прочитали (get_record),
+        иначе возвращает False.
+        """
+        state = state.state if isinstance(state, State) else state
+        state_key, data_key, version_key = self._keys(key)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if version is not None:
+                await pipe.watch(version_key)
+                if int(await pipe.get(version_key) or 0) != version:
+                    return False
+                pipe.multi()
+            if state is None:
+                pipe.delete(state_key)
+            else:
+                pipe.set(state_key, state, ex=self.state_ttl)
+            if data:
+                pipe.set(data_key, self.json_dumps(data), ex=self.data_ttl)
+            else:
+                pipe.delete(data_key)
+            pipe.incr(version_key)
+            try:
+                await pipe.execute()
+            except WatchError:
+                return False
+        return True
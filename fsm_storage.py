@@ -0,0 +1,353 @@
+import os
+import json
+import asyncio
+import sqlite3
+import logging
+import weakref
+import threading
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+logger = logging.getLogger(__name__)
+
+
+def storage_key_to_str(key: StorageKey):
+    """Строковый ключ записи: бот, чат, пользователь, тема, бизнес-подключение, назначение"""
+    parts = [
+        key.bot_id,
+        key.chat_id,
+        key.user_id,
+        key.thread_id or "",
+        getattr(key, "business_connection_id", None) or "",
+        key.destiny,
+    ]
+    return ":".join(str(part) for part in parts)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в SQLite в режиме WAL.
+
+    Состояние переживает перезапуск, а несколько процессов бота на одной
+    машине могут работать с одним файлом. Запись идет группами: пока одна
+    транзакция выполняется в потоке, новые изменения копятся и затем
+    фиксируются одним коммитом. Чтение и запись не блокируют цикл событий.
+    Каждая запись увеличивает версию, по которой StateSession обнаруживает
+    изменения из других процессов (см. set_state_and_data).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Соединения открываются при первом обращении в каждом процессе: хранилище
+        # создается до fork процессов webhook-сервера, а соединение SQLite после
+        # fork использовать нельзя
+        self._pid = None
+        self._write_conn = None
+        self._read_conn = None
+        self._open_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._pending = []
+        self._flush_task = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _ensure_open(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._open_lock:
+            if self._pid == pid:
+                return
+            # Соединения родительского процесса не трогаем, открываем свои
+            write_conn = self._connect()
+            write_conn.execute(
+                "CREATE TABLE IF NOT EXISTS fsm ("
+                "key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL DEFAULT '{}', "
+                "version INTEGER NOT NULL DEFAULT 0)"
+            )
+            # Файлы, созданные до появления версий
+            columns = {row[1] for row in write_conn.execute("PRAGMA table_info(fsm)")}
+            if "version" not in columns:
+                write_conn.execute("ALTER TABLE fsm ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            write_conn.commit()
+            self._write_conn = write_conn
+            self._read_conn = self._connect()
+            self._pid = pid
+
+    def _execute_batch(self, batch):
+        self._ensure_open()
+        with self._write_lock:
+            try:
+                # Число измененных строк каждой записи — для проверки версий
+                changes = [self._write_conn.execute(sql, params).rowcount for sql, params, _ in batch]
+                # Пустые записи (после state.clear()) не храним
+                self._write_conn.executemany(
+                    "DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = '{}'",
+                    {(params[0],) for _, params, _ in batch}
+                )
+                self._write_conn.commit()
+            except Exception:
+                self._write_conn.rollback()
+                raise
+        return changes
+
+    async def _flush(self):
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                changes = await asyncio.to_thread(self._execute_batch, batch)
+            except Exception as e:
+                logger.error(f"Ошибка записи состояния FSM: {e}")
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (*_, future), count in zip(batch, changes):
+                    if not future.done():
+                        future.set_result(count)
+
+    async def _write(self, sql, params):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((sql, params, future))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+        return await future
+
+    def _read(self, key):
+        self._ensure_open()
+        with self._read_lock:
+            return self._read_conn.execute(
+                "SELECT state, data, version FROM fsm WHERE key = ?", (key,)
+            ).fetchone()
+
+    async def set_state(self, key: StorageKey, state=None):
+        state = state.state if isinstance(state, State) else state
+        await self._write(
+            "INSERT INTO fsm (key, state, version) VALUES (?, ?, 1) "
+            "ON CONFLICT(key) DO UPDATE SET state = excluded.state, version = fsm.version + 1",
+            (storage_key_to_str(key), state)
+        )
+
+    async def get_state(self, key: StorageKey):
+        row = await asyncio.to_thread(self._read, storage_key_to_str(key))
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data):
+        await self._write(
+            "INSERT INTO fsm (key, data, version) VALUES (?, ?, 1) "
+            "ON CONFLICT(key) DO UPDATE SET data = excluded.data, version = fsm.version + 1",
+            (storage_key_to_str(key), json.dumps(data, ensure_ascii=False))
+        )
+
+    async def get_data(self, key: StorageKey):
+        row = await asyncio.to_thread(self._read, storage_key_to_str(key))
+        return json.loads(row[1]) if row else {}
+
+    async def get_record(self, key: StorageKey):
+        """Состояние, данные и версия записи одним запросом"""
+        row = await asyncio.to_thread(self._read, storage_key_to_str(key))
+        if row is None:
+            return None, {}, 0
+        return row[0], json.loads(row[1]), row[2]
+
+    async def set_state_and_data(self, key: StorageKey, state, data, version=None):
+        """
+        Записывает состояние и данные одной операцией. С version — только если
+        запись не менялась с тех пор, как ее прочитали (get_record), иначе
+        возвращает False. Версия 0 — записи нет: пустые записи удаляются.
+        """
+        state = state.state if isinstance(state, State) else state
+        params = (storage_key_to_str(key), state, json.dumps(data, ensure_ascii=False))
+        if version is None:
+            await self._write(
+                "INSERT INTO fsm (key, state, data, version) VALUES (?, ?, ?, 1) "
+                "ON CONFLICT(key) DO UPDATE SET "
+                "state = excluded.state, data = excluded.data, version = fsm.version + 1",
+                params
+            )
+            return True
+        if version == 0:
+            changed = await self._write(
+                "INSERT INTO fsm (key, state, data, version) VALUES (?, ?, ?, 1) "
+                "ON CONFLICT(key) DO UPDATE SET "
+                "state = excluded.state, data = excluded.data, version = fsm.version + 1 "
+                "WHERE fsm.version = 0",
+                params
+            )
+        else:
+            changed = await self._write(
+                # Ключ — первый параметр, как у остальных записей (см. _execute_batch)
+                "UPDATE fsm SET state = ?2, data = ?3, version = version + 1 WHERE key = ?1 AND version = ?4",
+                (*params, version)
+            )
+        return changed > 0
+
+    async def close(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._pid != os.getpid():
+            return
+        with self._write_lock:
+            self._write_conn.close()
+        with self._read_lock:
+            self._read_conn.close()
+        self._pid = None
+
+
+# Блокировки сессий по ключу FSM, удаляются сами, когда больше не используются
+_session_locks = weakref.WeakValueDictionary()
+
+_UNSET = object()
+
+
+class StateSession:
+    """
+    Сессия состояния FSM на время обработки одного сообщения.
+
+    Данные читаются из хранилища один раз при входе, изменения копятся в
+    памяти и записываются одной операцией при выходе из блока. Пока сессия
+    открыта, другие сессии того же пользователя в этом процессе ждут ее
+    завершения. Если хранилище общее для нескольких процессов (SQLite,
+    Redis), запись идет с проверкой версии: когда запись успел изменить
+    другой процесс, сессия перечитывает ее и повторяет поверх свои изменения
+    (update, clear, set_state), поэтому чужие поля не затираются.
+
+        async with StateSession(state) as session:
+            session.update(current_field_index=0)
+            session.set_state(DocumentForm.confirming_document)
+    """
+
+    # Сколько раз повторять запись при конфликте версий
+    COMMIT_ATTEMPTS = 5
+
+    def __init__(self, state):
+        self.context = state
+        self.data = {}
+        self._state = _UNSET
+        self._changed = False
+        self._lock = None
+        # Что изменила сессия — чтобы повторить поверх свежих данных
+        self._updates = {}
+        self._cleared = False
+        # Версия и состояние записи на момент чтения (если хранилище их поддерживает)
+        self._version = None
+        self._stored_state = None
+
+    @property
+    def _versioned(self):
+        return hasattr(self.context.storage, "get_record")
+
+    async def _read(self):
+        if self._versioned:
+            self._stored_state, data, self._version = await self.context.storage.get_record(self.context.key)
+        else:
+            data = await self.context.get_data()
+        self.data = {} if self._cleared else data
+        self.data.update(self._updates)
+
+    async def __aenter__(self):
+        lock_key = (id(self.context.storage), self.context.key)
+        self._lock = _session_locks.get(lock_key)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+            _session_locks[lock_key] = self._lock
+        await self._lock.acquire()
+        try:
+            await self._read()
+        except BaseException:
+            self._lock.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                await self.commit()
+        finally:
+            self._lock.release()
+
+    def update(self, data=None, **kwargs):
+        """Обновляет данные (запишутся при выходе из сессии)"""
+        if data:
+            self.data.update(data)
+            self._updates.update(data)
+        self.data.update(kwargs)
+        self._updates.update(kwargs)
+        self._changed = True
+
+    def set_state(self, state=None):
+        """Меняет состояние (запишется при выходе из сессии)"""
+        self._state = state
+
+    def clear(self):
+        """Сбрасывает состояние и данные"""
+        self.data = {}
+        self._updates = {}
+        self._cleared = True
+        self._state = None
+        self._changed = True
+
+    async def commit(self):
+        storage = self.context.storage
+        key = self.context.key
+        if self._versioned:
+            if self._changed or self._state is not _UNSET:
+                await self._commit_versioned(storage, key)
+        elif self._state is not _UNSET and self._changed and hasattr(storage, "set_state_and_data"):
+            await storage.set_state_and_data(key, self._state, self.data)
+        else:
+            if self._changed:
+                await storage.set_data(key, self.data)
+            if self._state is not _UNSET:
+                await storage.set_state(key, self._state)
+        self._state = _UNSET
+        self._changed = False
+        self._updates = {}
+        self._cleared = False
+
+    async def _commit_versioned(self, storage, key):
+        for _ in range(self.COMMIT_ATTEMPTS):
+            state = self._stored_state if self._state is _UNSET else self._state
+            if await storage.set_state_and_data(key, state, self.data, self._version):
+                self._stored_state = state
+                self._version += 1
+                return
+            # Запись изменил другой процесс: берем свежую и повторяем свои изменения
+            logger.warning(f"Состояние FSM {storage_key_to_str(key)} изменено параллельно, повторяем запись")
+            await self._read()
+        raise RuntimeError(f"Не удалось записать состояние FSM {storage_key_to_str(key)}: конфликт версий")
+
+
+def create_storage_from_env(multi_bot=False):
+    """
+    Создает хранилище FSM по переменной FSM_STORAGE:
+    memory (по умолчанию), sqlite (FSM_SQLITE_PATH) или redis (REDIS_URL, нужен пакет redis).
+    multi_bot=True — в процессе несколько ботов, ключи Redis должны включать id бота
+    (в памяти и в SQLite он есть в ключе всегда).
+    """
+    backend = os.getenv("FSM_STORAGE", "memory").lower()
+
+    if backend == "sqlite":
+        path = os.getenv("FSM_SQLITE_PATH", "data/fsm.sqlite3")
+        logger.info(f"Хранилище FSM: SQLite ({path})")
+        return SQLiteStorage(path)
+
+    if backend == "redis":
+        from aiogram.fsm.storage.redis import DefaultKeyBuilder
+        from fsm_redis import VersionedRedisStorage
+
+        url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+        logger.info(f"Хранилище FSM: Redis ({url})")
+        # Настройки пользователя хранятся под отдельным назначением (destiny="settings"),
+        # без with_destiny построитель ключей Redis отказывается с ним работать
+        key_builder = DefaultKeyBuilder(with_bot_id=multi_bot, with_destiny=True)
+        return VersionedRedisStorage.from_url(url, key_builder=key_builder)
+
+    return MemoryStorage()
@@ -0,0 +1,260 @@
+"""
+Компактный бинарный формат базы знаний.
+
+Сборка: python kb_binary.py data/qa_base.json data/qa_base.bin
+
+Файл открывается через mmap, поэтому бот стартует без разбора JSON, а
+несколько процессов бота делят одни и те же страницы памяти. Внутри —
+таблица строк без повторов, массивы записей и фраз фиксированного размера,
+нормализованные вопросы и синонимы (фразы записей одного раздела подряд,
+см. partition_key) и готовый инвертированный индекс.
+Таблица ключевых слов (data/keyword_routes.json) компилируется при запуске.
+Все числа — little-endian.
+"""
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from collections.abc import Sequence
+
+from search import BaseQAIndex, compile_entry, partition_key
+
+MAGIC = b"LXKB"
+FORMAT_VERSION = 2
+
+# magic, версия, 6 счетчиков, 7 смещений секций
+HEADER = struct.Struct("<4sI6I7Q")
+# id, вопрос, ответ, категория, (начало, длина) синонимов, стран и ссылок в таблице списков
+ENTRY = struct.Struct("<i3I6I")
+# индекс записи, нормализованный текст, число признаков
+PHRASE = struct.Struct("<3I")
+# признак, начало и длина списка фраз в таблице postings
+FEATURE = struct.Struct("<3I")
+
+NO_ID = -1
+
+
+class StringTable:
+    """Таблица строк: одинаковые строки хранятся один раз"""
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def intern(self, text):
+        string_id = self.ids.get(text)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.ids[text] = string_id
+            self.strings.append(text)
+        return string_id
+
+    def dump(self):
+        offsets = array("I", [0])
+        data = bytearray()
+        for text in self.strings:
+            data += text.encode("utf-8")
+            offsets.append(len(data))
+        return offsets.tobytes(), bytes(data)
+
+
+def compile_knowledge_base(qa_base):
+    """Собирает бинарное представление базы знаний"""
+    strings = StringTable()
+    lists = array("I")
+    entries = bytearray()
+    phrases = bytearray()
+    postings = defaultdict(list)
+    phrase_count = 0
+
+    def add_list(values):
+        start = len(lists)
+        lists.extend(strings.intern(value) for value in values)
+        return start, len(values)
+
+    for item in qa_base:
+        entries += ENTRY.pack(
+            item.get("id", NO_ID),
+            strings.intern(item["question"]),
+            strings.intern(item["answer"]),
+            strings.intern(item.get("category", "")),
+            *add_list(item.get("synonyms", [])),
+            *add_list(item.get("country", [])),
+            *add_list(item.get("law_links") or []),
+        )
+
+    # Фразы записей одного раздела лежат подряд (см. partition_key)
+    for entry_index in sorted(range(len(qa_base)), key=lambda position: partition_key(qa_base[position])):
+        for processed, features in compile_entry(qa_base[entry_index]):
+            phrases += PHRASE.pack(entry_index, strings.intern(processed), len(features))
+            for feature in features:
+                postings[feature].append(phrase_count)
+            phrase_count += 1
+
+    features = bytearray()
+    posting_ids = array("I")
+    for feature in sorted(postings):
+        ids = postings[feature]
+        features += FEATURE.pack(strings.intern(feature), len(posting_ids), len(ids))
+        posting_ids.extend(ids)
+
+    string_offsets, string_data = strings.dump()
+    sections = [
+        string_offsets, string_data, bytes(entries), lists.tobytes(),
+        bytes(phrases), bytes(features), posting_ids.tobytes()
+    ]
+    counts = [
+        len(strings.strings), len(qa_base), phrase_count, len(postings),
+        len(lists), len(posting_ids)
+    ]
+
+    body = bytearray()
+    offsets = []
+    position = HEADER.size
+    for section in sections:
+        # Выравниваем секции по 8 байт
+        padding = -position % 8
+        body += b"\0" * padding
+        position += padding
+        offsets.append(position)
+        body += section
+        position += len(section)
+
+    return HEADER.pack(MAGIC, FORMAT_VERSION, *counts, *offsets) + bytes(body)
+
+
+def build(json_path, bin_path):
+    """Компилирует JSON-базу в бинарный файл (атомарно заменяя старый)"""
+    with open(json_path, "r", encoding="utf-8") as f:
+        qa_base = json.load(f)
+    data = compile_knowledge_base(qa_base)
+    tmp_path = bin_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    # Замена файла не затрагивает процессы, у которых открыт старый mmap
+    os.replace(tmp_path, bin_path)
+    return len(qa_base), len(data)
+
+
+class _EntryView(Sequence):
+    """Записи базы, которые декодируются в словари только при обращении"""
+
+    def __init__(self, index):
+        self._index = index
+
+    def __len__(self):
+        return self._index.entry_count
+
+    def __getitem__(self, position):
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        index = self._index
+        (entry_id, question, answer, category,
+         synonyms_start, synonyms_count, country_start, country_count,
+         links_start, links_count) = ENTRY.unpack_from(index.mm, index.entries_offset + position * ENTRY.size)
+        item = {
+            "question": index.string(question),
+            "synonyms": index.string_list(synonyms_start, synonyms_count),
+            "category": index.string(category),
+            "country": index.string_list(country_start, country_count),
+            "answer": index.string(answer),
+            "law_links": index.string_list(links_start, links_count),
+        }
+        if entry_id != NO_ID:
+            item = {"id": entry_id, **item}
+        return item
+
+
+class _PhraseView(Sequence):
+    """Фразы: (индекс записи, нормализованный текст, число признаков)"""
+
+    def __init__(self, index):
+        self._index = index
+
+    def __len__(self):
+        return self._index.phrase_count
+
+    def __getitem__(self, phrase_id):
+        index = self._index
+        entry_index, text, feature_count = PHRASE.unpack_from(
+            index.mm, index.phrases_offset + phrase_id * PHRASE.size
+        )
+        return entry_index, index.string(text), feature_count
+
+
+class _PostingsView:
+    """Инвертированный индекс: бинарный поиск признака в отсортированной таблице"""
+
+    def __init__(self, index):
+        self._index = index
+
+    def __len__(self):
+        return self._index.feature_count
+
+    def __getitem__(self, position):
+        # Признак по позиции в отсортированной таблице — для bisect
+        index = self._index
+        string_id, _, _ = FEATURE.unpack_from(index.mm, index.features_offset + position * FEATURE.size)
+        return index.string(string_id)
+
+    def get(self, feature, default=()):
+        index = self._index
+        position = bisect_left(self, feature)
+        if position == len(self) or self[position] != feature:
+            return default
+        _, start, count = FEATURE.unpack_from(index.mm, index.features_offset + position * FEATURE.size)
+        return index.postings_array[start:start + count]
+
+
+class MmapQAIndex(BaseQAIndex):
+    """Индекс базы знаний поверх бинарного файла, открытого через mmap"""
+
+    def __init__(self, path, top_k=50, exact_limit=2000):
+        self.path = path
+        self.top_k = top_k
+        self.exact_limit = exact_limit
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = HEADER.unpack_from(self.mm, 0)
+        magic, version = header[0], header[1]
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемый формат базы знаний: {path}")
+        (self.string_count, self.entry_count, self.phrase_count, self.feature_count,
+         list_count, posting_count) = header[2:8]
+        (strings_offset, data_offset, self.entries_offset, lists_offset,
+         self.phrases_offset, self.features_offset, postings_offset) = header[8:15]
+
+        view = memoryview(self.mm)
+        self.string_offsets = view[strings_offset:strings_offset + 4 * (self.string_count + 1)].cast("I")
+        self.data_offset = data_offset
+        self.lists = view[lists_offset:lists_offset + 4 * list_count].cast("I")
+        self.postings_array = view[postings_offset:postings_offset + 4 * posting_count].cast("I")
+        # Индекс записи и число признаков каждой фразы — первое и третье поля PHRASE,
+        # без распаковки строк
+        phrase_table = view[self.phrases_offset:self.phrases_offset + PHRASE.size * self.phrase_count].cast("I")
+        self.phrase_entries = phrase_table[0::3]
+        self.phrase_sizes = phrase_table[2::3]
+
+        self.entries = _EntryView(self)
+        self.phrases = _PhraseView(self)
+        self.postings = _PostingsView(self)
+
+    def string(self, string_id):
+        start = self.data_offset + self.string_offsets[string_id]
+        end = self.data_offset + self.string_offsets[string_id + 1]
+        return self.mm[start:end].decode("utf-8")
+
+    def string_list(self, start, count):
+        return [self.string(string_id) for string_id in self.lists[start:start + count]]
+
+
+if __name__ == "__main__":
+    source = sys.argv[1] if len(sys.argv) > 1 else "data/qa_base.json"
+    target = sys.argv[2] if len(sys.argv) > 2 else "data/qa_base.bin"
+    entry_count, size = build(source, target)
+    print(f"{target}: {entry_count} записей, {size} байт")
@@ -0,0 +1,123 @@
+import json
+import logging
+from collections import deque
+
+from search import preprocess_text
+
+logger = logging.getLogger(__name__)
+
+
+class AhoCorasick:
+    """Автомат Ахо — Корасик: все вхождения набора строк за один проход по тексту"""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        for pattern_id, pattern in enumerate(patterns):
+            node = 0
+            for char in pattern:
+                next_node = self.goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][char] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                node = next_node
+            self.output[node].append(pattern_id)
+
+        # Суффиксные ссылки строим обходом в ширину
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, text):
+        """Возвращает множество id строк, которые встречаются в тексте"""
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            if self.output[node]:
+                found.update(self.output[node])
+        return found
+
+
+def load_routes(path):
+    """
+    Читает таблицу маршрутов по ключевым словам. Каждый маршрут:
+    {"phrases": [...], "question_contains": [...]} — если в сообщении есть одна из
+    phrases, отвечаем первой записью базы, вопрос которой содержит одну из question_contains.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        logger.warning(f"Таблица ключевых слов не найдена: {path}")
+        return []
+
+
+class KeywordRouter:
+    """
+    Запасной поиск по ключевым словам, скомпилированный для конкретного индекса.
+
+    Цель каждого маршрута находится заранее, а все фразы маршрутов собраны в
+    один автомат, поэтому сообщение проверяется за один проход независимо
+    от числа ключевых слов. При нескольких совпадениях побеждает маршрут,
+    который раньше в таблице.
+    """
+
+    def __init__(self, routes, index):
+        self.entries = index.entries
+        self.targets = self._resolve_targets(routes, index)
+
+        patterns = []
+        self.pattern_routes = []
+        for route_id, route in enumerate(routes):
+            if self.targets[route_id] is None:
+                continue
+            for phrase in route["phrases"]:
+                patterns.append(preprocess_text(phrase))
+                self.pattern_routes.append(route_id)
+        self.automaton = AhoCorasick(patterns)
+
+    @staticmethod
+    def _resolve_targets(routes, index):
+        """Для каждого маршрута — индекс первой подходящей записи базы или None"""
+        needles = []
+        needle_routes = []
+        for route_id, route in enumerate(routes):
+            for needle in route.get("question_contains", []):
+                needles.append(preprocess_text(needle))
+                needle_routes.append(route_id)
+        automaton = AhoCorasick(needles)
+
+        targets = [None] * len(routes)
+        unresolved = len(routes)
+        for entry_index, question in index.questions():
+            for needle_id in automaton.find(question):
+                route_id = needle_routes[needle_id]
+                if targets[route_id] is None:
+                    targets[route_id] = entry_index
+                    unresolved -= 1
+            if not unresolved:
+                break
+        return targets
+
+    def match(self, query):
+        """Запись базы для нормализованного сообщения или None"""
+        found = self.automaton.find(query)
+        if not found:
+            return None
+        route_id = min(self.pattern_routes[pattern_id] for pattern_id in found)
+        return self.entries[self.targets[route_id]]
@@ -0,0 +1,226 @@
+import os
+import json
+import asyncio
+import logging
+
+from search import QAIndex
+from kb_binary import MmapQAIndex
+from partitions import PartitionedSearch
+from keyword_router import KeywordRouter, load_routes
+
+logger = logging.getLogger(__name__)
+
+
+class KnowledgeBase:
+    """
+    База знаний с поисковым индексом, которую можно перезагружать на лету.
+
+    Новый индекс строится в отдельном потоке и подменяется одним
+    присваиванием, поэтому обработчик, который уже взял kb.index, доработает
+    со старым снимком, а следующий получит новый. При перестройке заново
+    нормализуются только изменившиеся записи (по id).
+
+    Если путь указывает на скомпилированный файл .bin (см. kb_binary.py),
+    индекс открывается через mmap без разбора JSON.
+
+    search_mode: fuzzy — только сравнение строк, hybrid — при отсутствии
+    совпадения еще и семантический поиск, semantic — только семантический
+    (см. semantic.py, нужен numpy). vectors_path — заранее посчитанные векторы.
+    partitions и category_routing — разделы по странам и категориям (см. partitions.py).
+    routes_path — таблица запасного поиска по ключевым словам (см. keyword_router.py).
+    top_k и exact_limit — сколько лучших кандидатов сравнивать точно и сколько
+    фраз досматривать, чтобы ответ совпал с полным перебором (см. BaseQAIndex.best_match).
+    """
+
+    # С какого числа записей alookup ищет в отдельном потоке
+    THREAD_LOOKUP_ENTRIES = 5000
+
+    def __init__(self, path, search_mode="fuzzy", vectors_path=None, partitions=True, category_routing=False,
+                 routes_path=None, top_k=50, exact_limit=2000):
+        self.path = path
+        # Таблица ключевых слов по умолчанию лежит рядом с базой знаний
+        self.routes_path = routes_path or os.path.join(os.path.dirname(path), "keyword_routes.json")
+        self.search_mode = search_mode
+        self.vectors_path = vectors_path
+        self.use_partitions = partitions
+        self.category_routing = category_routing
+        self.top_k = top_k
+        self.exact_limit = exact_limit
+        self.index = QAIndex([], top_k=top_k, exact_limit=exact_limit)
+        # Увеличивается при каждой перезагрузке, чтобы зависимые кэши могли сброситься
+        self.version = 0
+        self._mtime = None
+        self._reload_lock = asyncio.Lock()
+        self._watch_task = None
+        # Устанавливается после первой загрузки (даже неудачной), см. wait_ready
+        self._ready = asyncio.Event()
+        self._load_task = None
+
+    @property
+    def entries(self):
+        return self.index.entries
+
+    @property
+    def binary(self):
+        return self.path.endswith(".bin")
+
+    def _build_index(self, old_index):
+        """Читает файл и строит новый индекс, возвращает (индекс, время изменения)"""
+        mtime = os.path.getmtime(self.path)
+        if self.binary:
+            index = MmapQAIndex(self.path, top_k=self.top_k, exact_limit=self.exact_limit)
+        else:
+            with open(self.path, "r", encoding="utf-8") as f:
+                qa_base = json.load(f)
+            index = old_index.rebuild(qa_base)
+        routes = load_routes(self.routes_path)
+        index.keyword_router = KeywordRouter(routes, index)
+        if self.search_mode in ("hybrid", "semantic"):
+            self._attach_semantic(index)
+        if self.use_partitions:
+            # Разделы — диапазоны фраз основного индекса, векторы фраз у них общие с ним
+            index.partitions = PartitionedSearch(index, category_routing=self.category_routing)
+            for country_index in index.partitions.countries.values():
+                if country_index is index:
+                    continue
+                country_index.keyword_router = KeywordRouter(routes, country_index)
+                if index.semantic is not None:
+                    country_index.semantic = index.semantic.restricted(country_index.phrase_ranges)
+                    country_index.semantic_only = index.semantic_only
+        return index, mtime
+
+    def _attach_semantic(self, index, use_saved=True):
+        """Строит или загружает векторы фраз до того, как индекс станет доступен"""
+        try:
+            from semantic import SemanticIndex
+        except ImportError as e:
+            # Без numpy остается поиск по схожести строк, а не пустая база
+            logger.warning(f"Семантический поиск недоступен ({e}), SEARCH_MODE={self.search_mode} "
+                           f"работает как fuzzy. Установите numpy")
+            return
+
+        semantic = None
+        if use_saved and self.vectors_path and os.path.exists(self.vectors_path):
+            semantic = SemanticIndex.load(index, self.vectors_path)
+            if semantic is None:
+                logger.warning("Сохраненные векторы не соответствуют базе знаний, пересчитываем")
+        if semantic is None:
+            semantic = SemanticIndex.build(index)
+        index.semantic = semantic
+        index.semantic_only = self.search_mode == "semantic"
+
+    def _load(self):
+        try:
+            self.index, self._mtime = self._build_index(self.index)
+            self.version += 1
+            logger.info(f"Загружено {len(self.index)} вопросов в базу знаний")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке базы знаний: {e}")
+
+    def load(self):
+        """Первичная загрузка при старте"""
+        self._load()
+        self._ready.set()
+
+    @property
+    def loaded(self):
+        return self._ready.is_set()
+
+    def load_in_background(self):
+        """
+        Первичная загрузка в отдельном потоке, чтобы бот начал принимать
+        обновления не дожидаясь индекса. Поиск ждет ее окончания в wait_ready.
+        """
+        if not self.loaded and self._load_task is None:
+            self._load_task = asyncio.create_task(self._load_async())
+        return self._load_task
+
+    async def _load_async(self):
+        try:
+            await asyncio.to_thread(self._load)
+        finally:
+            # Событие asyncio нельзя устанавливать из другого потока
+            self._ready.set()
+
+    async def wait_ready(self):
+        if not self._ready.is_set():
+            await self._ready.wait()
+
+    def lookup(self, query, country=None):
+        """
+        Поиск по текущему снимку индекса с учетом страны пользователя.
+        Возвращает (запись, способ, оценка), см. BaseQAIndex.lookup.
+        """
+        index = self.index
+        if index.partitions is not None:
+            return index.partitions.lookup(query, country)
+        return index.lookup(query)
+
+    async def alookup(self, query, country=None):
+        """
+        lookup для обработчиков. На большой базе поиск уходит в отдельный поток,
+        чтобы цикл событий мог обслуживать другие обновления; на маленькой
+        переключение потоков дороже самого поиска.
+        """
+        if len(self.index) < self.THREAD_LOOKUP_ENTRIES:
+            return self.lookup(query, country)
+        return await asyncio.to_thread(self.lookup, query, country)
+
+    def search(self, query, country=None):
+        return self.lookup(query, country)[0]
+
+    def _changed_count(self, old_index, new_index):
+        # У бинарной базы нет сведений о записях, считаем измененными все
+        if not hasattr(old_index, "compiled") or not hasattr(new_index, "compiled"):
+            return len(new_index)
+        return sum(
+            1 for key, (signature, _) in new_index.compiled.items()
+            if old_index.compiled.get(key, (None,))[0] != signature
+        )
+
+    async def reload(self):
+        """
+        Перечитывает файл и подменяет индекс. Возвращает число измененных
+        записей или None, если загрузить базу не удалось.
+        """
+        async with self._reload_lock:
+            old_index = self.index
+            try:
+                new_index, mtime = await asyncio.to_thread(self._build_index, old_index)
+            except Exception as e:
+                logger.error(f"Ошибка при перезагрузке базы знаний: {e}")
+                return None
+
+            self.index = new_index
+            self._mtime = mtime
+            self.version += 1
+            changed = self._changed_count(old_index, new_index)
+            logger.info(
+                f"База знаний перезагружена: {len(new_index)} вопросов, изменено записей: {changed}"
+            )
+            return changed
+
+    async def _watch(self, interval):
+        await self.wait_ready()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                continue
+            if mtime != self._mtime:
+                await self.reload()
+
+    def start_watching(self, interval=5.0):
+        """Запускает фоновую проверку времени изменения файла"""
+        if self._watch_task is None or self._watch_task.done():
+            self._watch_task = asyncio.create_task(self._watch(interval))
+
+    async def stop_watching(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            self._watch_task = None
@@ -1,37 +1,54 @@
 import os
-import json
 import asyncio
 import logging
-import requests
+import time
+from dataclasses import replace
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import ReplyKeyboardRemove
 from dotenv import load_dotenv
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-import io
 from datetime import datetime
+from search import preprocess_text
+from knowledge_base import KnowledgeBase
+from partitions import COUNTRIES
+from answer_cache import AnswerCache
+from yalm import YaLMClient
+from scheduler import GenerationScheduler
+from progress import ProgressMessage
+from doc_cache import create_document_cache_from_env, make_cache_key
+from pdf_render import PDFRenderer, discard_pdf
+from bulk import BulkError, parse_rows, validate_rows, generate_bulk, add_report
+from fsm_storage import StateSession, create_storage_from_env
+from webhook import run_webhook
+from metrics import Registry, MetricsMiddleware, SIZE_BUCKETS, start_metrics_server
+from throttling import ThrottlingMiddleware
+from query_log import create_query_log_from_env
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Загружаем базу знаний
-try:
-    with open("data/qa_base.json", "r", encoding="utf-8") as f:
-        qa_base = json.load(f)
-    logger.info(f"Загружено {len(qa_base)} вопросов в базу знаний")
-except Exception as e:
-    logger.error(f"Ошибка при загрузке базы знаний: {e}")
-    qa_base = []
+load_dotenv()
+
+# База знаний; индекс строится в фоне после запуска бота (см. on_startup)
+# KB_PATH может указывать на скомпилированную базу data/qa_base.bin (см. kb_binary.py)
+# SEARCH_MODE: fuzzy, hybrid или semantic (семантический поиск требует numpy)
+# KB_PARTITIONS=0 — искать по всей базе, не учитывая страну пользователя
+# CATEGORY_ROUTING=1 — сначала искать в категории, которую предсказал классификатор
+# KB_TOP_K — сколько лучших кандидатов сравнивать точно первыми
+# KB_EXACT_LIMIT — сколько фраз досматривать, чтобы ответ совпал с полным перебором (0 — без ограничения)
+knowledge_base = KnowledgeBase(
+    os.getenv("KB_PATH", "data/qa_base.json"),
+    search_mode=os.getenv("SEARCH_MODE", "fuzzy"),
+    vectors_path=os.getenv("SEMANTIC_VECTORS"),
+    partitions=os.getenv("KB_PARTITIONS", "1") == "1",
+    category_routing=os.getenv("CATEGORY_ROUTING", "0") == "1",
+    top_k=int(os.getenv("KB_TOP_K", "50")),
+    exact_limit=int(os.getenv("KB_EXACT_LIMIT", "2000"))
+)
 
 # Определение состояний для FSM
 class DocumentForm(StatesGroup):
@@ -41,6 +58,13 @@ class DocumentForm(StatesGroup):
     entering_lease_agreement_info = State()
     confirming_document = State()
 
+class SettingsForm(StatesGroup):
+    choosing_country = State()
+
+class BulkForm(StatesGroup):
+    choosing_document_type = State()
+    waiting_file = State()
+
 # Шаблоны документов с обязательными полями
 DOCUMENT_TEMPLATES = {
     "Претензия на возврат товара": {
@@ -95,38 +119,178 @@ DOCUMENT_TEMPLATES = {
     }
 }
 
-load_dotenv()
-bot = Bot(token=os.getenv("BOT_TOKEN"))
-storage = MemoryStorage()
+# Состояние мастера для ввода полей каждого типа документа
+DOCUMENT_STATES = {
+    "Претензия на возврат товара": DocumentForm.entering_complaint_info,
+    "Исковое заявление об увольнении": DocumentForm.entering_lawsuit_info,
+    "Договор аренды квартиры": DocumentForm.entering_lease_agreement_info
+}
+
+def parse_bot_tokens(value):
+    """
+    Токены ботов через запятую; перед токеном можно указать страну бота:
+    "Россия=<токен>,Беларусь=<токен>". Возвращает [(страна или None, токен)].
+    """
+    specs = []
+    for part in value.split(","):
+        country, _, token = part.strip().rpartition("=")
+        if token:
+            specs.append((country.strip() or None, token.strip()))
+    return specs
+
+# Несколько ботов в одном процессе (BOT_TOKENS) делят базу знаний, пул PDF,
+# клиент YaLM API и пул HTTP-соединений к Telegram. Состояния диалогов у каждого
+# бота свои: ключ хранилища включает id бота
+BOT_SPECS = parse_bot_tokens(os.getenv("BOT_TOKENS") or os.getenv("BOT_TOKEN", "")) or [(None, "")]
+bot_session = AiohttpSession()
+bots = [Bot(token=token, session=bot_session) for _, token in BOT_SPECS]
+bot = bots[0]
+# Страна бота — раздел базы знаний для пользователей, не выбравших страну сами
+BOT_COUNTRIES = {tenant.id: country for tenant, (country, _) in zip(bots, BOT_SPECS) if country}
+storage = create_storage_from_env(multi_bot=len(bots) > 1)
 dp = Dispatcher(storage=storage)
 
-def preprocess_text(text):
-    """Предобработка текста для сравнения"""
-    return text.lower().strip().replace("?", "").replace(".", "").replace("!", "")
+# Потоковая генерация документов с обновлением сообщения (YALM_STREAM=0 — отключить)
+STREAM_DOCUMENTS = os.getenv("YALM_STREAM", "1") != "0"
 
-def calculate_similarity(a, b):
-    """Вычисляет степень схожести двух строк"""
-    from difflib import SequenceMatcher
-    return SequenceMatcher(None, a, b).ratio()
+# Клиент YaLM API с общим пулом соединений на все время работы бота
+yalm_client = YaLMClient.from_env()
 
-def generate_legal_document(doc_type, context):
-    """
-    Генерация юридического документа через YaLM API
-    """
-    logger.info(f"Генерация документа через YaLM API: {doc_type}")
-    
-    # Получаем данные из окружения
-    api_key = os.getenv("YALM_API_KEY")
-    catalog_id = os.getenv("CATALOG_ID")
-    
-    if not api_key or not catalog_id:
-        logger.error("Отсутствуют необходимые переменные окружения для YaLM API")
-        return "Ошибка: не настроено подключение к YaLM API. Обратитесь к администратору."
-    
-    # Формируем промпт на основе выбранного типа документа
+# Очередь запросов к YaLM API: лимит YALM_RPS, повтор временных ошибок, склейка одинаковых промптов
+yalm_scheduler = GenerationScheduler.from_env(yalm_client)
+
+# Кэш готовых ответов в чате (ANSWER_CACHE_SIZE=0 — отключить)
+answer_cache = AnswerCache(int(os.getenv("ANSWER_CACHE_SIZE", "1024")))
+
+# Кэш сгенерированных документов и PDF (DOC_CACHE=memory|sqlite|off)
+document_cache = create_document_cache_from_env()
+
+# Число процессов webhook-сервера (в режиме polling процесс один)
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1")) if os.getenv("BOT_MODE") == "webhook" else 1
+
+# Журнал вопросов, совпадений и промахов для пополнения базы (QUERY_LOG=jsonl|sqlite|off)
+# Процессы webhook-сервера пишут журнал запросов каждый в свой файл
+query_log = create_query_log_from_env(per_process=WEBHOOK_WORKERS > 1)
+
+# Рендеринг PDF в пуле процессов (PDF_WORKERS, PDF_MAX_QUEUE)
+pdf_renderer = PDFRenderer.from_env()
+# PDF больше этого размера (DOC_CACHE_MAX_PDF_KB) не кэшируются
+PDF_CACHE_MAX_BYTES = int(os.getenv("DOC_CACHE_MAX_PDF_KB", "512")) * 1024
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+# Администраторы бота (через запятую) и интервал проверки файла базы знаний
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+KB_WATCH_INTERVAL = float(os.getenv("KB_WATCH_INTERVAL", "5"))
+
+# Пакетная генерация (/bulk): кому доступна (по умолчанию администраторам),
+# сколько документов генерируется одновременно и ограничения на файл
+BULK_USER_IDS = {int(user_id) for user_id in os.getenv("BULK_USER_IDS", "").split(",") if user_id.strip()} or ADMIN_IDS
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "4"))
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "200"))
+BULK_MAX_FILE_BYTES = int(os.getenv("BULK_MAX_FILE_KB", "1024")) * 1024
+
+# Метрики: страница /metrics на METRICS_PORT (0 — отключить), METRICS_TRACE=1 — время этапов в логе
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+metrics = Registry()
+dp.message.middleware(MetricsMiddleware(metrics, trace=os.getenv("METRICS_TRACE", "0") == "1"))
+match_seconds = metrics.histogram("lexoai_match_seconds", "Время поиска ответа в базе знаний")
+answers_total = metrics.counter(
+    "lexoai_answers_total", "Ответы в чате по способу: fuzzy, semantic, keyword, miss, cache", ["result"]
+)
+llm_seconds = metrics.histogram("lexoai_llm_seconds", "Время генерации документа в YaLM API", ["mode"])
+llm_first_chunk_seconds = metrics.histogram(
+    "lexoai_llm_first_chunk_seconds", "Время до первой части текста при потоковой генерации"
+)
+llm_errors_total = metrics.counter("lexoai_llm_errors_total", "Ошибки YaLM API", ["mode"])
+pdf_render_seconds = metrics.histogram("lexoai_pdf_render_seconds", "Время создания PDF")
+pdf_bytes_size = metrics.histogram("lexoai_pdf_bytes", "Размер PDF в байтах", buckets=SIZE_BUCKETS)
+pdf_errors_total = metrics.counter("lexoai_pdf_errors_total", "Ошибки создания PDF")
+bulk_documents_total = metrics.counter(
+    "lexoai_bulk_documents_total", "Строки пакетной генерации по результату: ok, invalid, failed", ["result"]
+)
+metrics.gauge("lexoai_answer_cache_hit_ratio", "Доля ответов из кэша",
+              lambda: answer_cache.stats()["hit_ratio"])
+metrics.gauge("lexoai_doc_cache_hit_ratio", "Доля документов из кэша",
+              lambda: document_cache.hit_ratio if document_cache is not None else 0.0)
+metrics.gauge("lexoai_llm_queue_length", "Запросы к YaLM API, ожидающие очереди", yalm_scheduler.queue_length)
+metrics.gauge("lexoai_llm_coalesced_total", "Запросы, получившие результат уже выполнявшегося запроса",
+              lambda: yalm_scheduler.coalesced, kind="counter")
+metrics.gauge("lexoai_llm_retries_total", "Повторы запросов к YaLM API", lambda: yalm_scheduler.retries, kind="counter")
+metrics.gauge("lexoai_kb_entries", "Число записей в базе знаний", lambda: len(knowledge_base.entries))
+metrics_runner = None
+
+# Лимиты на пользователя: сообщений в секунду и генераций документов в секунду (0 — без лимита),
+# генераций одновременно в одном чате; при очереди к YaLM API длиннее THROTTLE_MAX_QUEUE
+# новые генерации отклоняются (0 — не отклонять)
+THROTTLE_MAX_QUEUE = int(os.getenv("THROTTLE_MAX_QUEUE", "50"))
+dp.message.middleware(ThrottlingMiddleware(
+    metrics,
+    rate=float(os.getenv("THROTTLE_RATE", "1")),
+    burst=int(os.getenv("THROTTLE_BURST", "5")),
+    expensive_rate=float(os.getenv("THROTTLE_EXPENSIVE_RATE", "0.1")),
+    expensive_burst=int(os.getenv("THROTTLE_EXPENSIVE_BURST", "2")),
+    chat_in_flight=int(os.getenv("THROTTLE_CHAT_IN_FLIGHT", "1")),
+    overloaded=lambda: 0 < THROTTLE_MAX_QUEUE <= yalm_scheduler.queue_length()
+))
+
+# Прогрев тяжелых подсистем идет в фоне, не задерживая прием обновлений
+warmup_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    warmup_tasks.add(task)
+    task.add_done_callback(warmup_tasks.discard)
+    return task
+
+async def warm_up_pdf():
+    try:
+        await pdf_renderer.warm_up()
+    except Exception as e:
+        logger.error(f"Не удалось запустить пул рендеринга PDF: {e}")
+
+@dp.startup()
+async def on_startup():
+    # Первые вопросы подождут загрузки базы в handle_question, остальные обработчики — нет
+    knowledge_base.load_in_background()
+    run_in_background(warm_up_pdf())
+    if query_log is not None:
+        query_log.start()
+    if KB_WATCH_INTERVAL > 0:
+        knowledge_base.start_watching(KB_WATCH_INTERVAL)
+    if METRICS_PORT > 0:
+        global metrics_runner
+        # Процессы webhook-сервера занимают соседние порты, начиная с METRICS_PORT
+        metrics_runner = await start_metrics_server(metrics, METRICS_HOST, METRICS_PORT, WEBHOOK_WORKERS)
+
+@dp.shutdown()
+async def on_shutdown():
+    for task in list(warmup_tasks):
+        task.cancel()
+    await knowledge_base.stop_watching()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    logger.info(f"Кэш ответов: {answer_cache.stats()}")
+    logger.info(f"Очередь YaLM API: {yalm_scheduler.stats()}")
+    await yalm_scheduler.close()
+    pdf_renderer.close()
+    if query_log is not None:
+        await query_log.close()
+        logger.info(f"Журнал запросов: {query_log.stats()}")
+    if document_cache is not None:
+        logger.info(f"Кэш документов: {document_cache.stats()}")
+        document_cache.close()
+
+SYSTEM_PROMPT = ("Ты - опытный юрист, который помогает создавать юридические документы. "
+                 "Ты должен создавать документы в соответствии с законодательством РФ, "
+                 "используя правильные формулировки и структуру.")
+
+def build_document_prompt(doc_type, context):
+    """Формирует промпт на основе выбранного типа документа"""
     if doc_type in DOCUMENT_TEMPLATES:
-        base_prompt = DOCUMENT_TEMPLATES[doc_type]["prompt"]
-        
         # Создаем детальный промпт с заполненными данными
         prompt = f"Создай юридически корректный документ: {doc_type}\n\n"
         prompt += "Используй следующие данные:\n"
@@ -143,144 +307,123 @@ def generate_legal_document(doc_type, context):
         prompt += "Сгенерируй полный текст документа:"
     else:
         prompt = f"Создай юридический документ: {doc_type}. Учти следующие данные: {context}"
+    return prompt
+
+def build_document_messages(doc_type, context):
+    """Сообщения для запроса к YaLM API"""
+    return [
+        {"role": "system", "text": SYSTEM_PROMPT},
+        {"role": "user", "text": build_document_prompt(doc_type, context)}
+    ]
+
+def document_cache_key(doc_type, context):
+    """Ключ кэша: промпт вместе с моделью и параметрами генерации"""
+    return make_cache_key(yalm_client.build_payload(build_document_messages(doc_type, context)))
+
+def fallback_document_text(doc_type):
+    """Текст, который отправляется пользователю при ошибке генерации"""
+    return ("Произошла ошибка при генерации документа.\n\n"
+            "Вот пример структуры документа:\n\n" + 
+            DOCUMENT_TEMPLATES.get(doc_type, {"prompt": ""})["prompt"])
+
+async def generate_legal_document(doc_type, context, on_position=None):
+    """
+    Генерация юридического документа через YaLM API.
+    on_position(n) вызывается, пока запрос ждет своей очереди.
+    """
+    logger.info(f"Генерация документа через YaLM API: {doc_type}")
     
-    # Подготовка запроса к YaLM API
-    api_url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
-    headers = {
-        "Authorization": f"Api-Key {api_key}",
-        "Content-Type": "application/json"
-    }
-    
-    payload = {
-        "modelUri": f"gpt://{catalog_id}/yandexgpt/latest",
-        "completionOptions": {
-            "stream": False,
-            "temperature": 0.3,
-            "maxTokens": "2000"
-        },
-        "messages": [
-            {
-                "role": "system",
-                "text": "Ты - опытный юрист, который помогает создавать юридические документы. "
-                        "Ты должен создавать документы в соответствии с законодательством РФ, "
-                        "используя правильные формулировки и структуру."
-            },
-            {
-                "role": "user",
-                "text": prompt
-            }
-        ]
-    }
+    if not yalm_client.configured:
+        logger.error("Отсутствуют необходимые переменные окружения для YaLM API")
+        return "Ошибка: не настроено подключение к YaLM API. Обратитесь к администратору."
     
     try:
-        response = requests.post(api_url, json=payload, headers=headers)
-        response.raise_for_status()
-        
-        result = response.json()
-        generated_text = result["result"]["alternatives"][0]["message"]["text"]
-        
+        with llm_seconds.time("complete"):
+            generated_text = await yalm_scheduler.complete(
+                build_document_messages(doc_type, context), on_position=on_position
+            )
         logger.info(f"Документ успешно сгенерирован через YaLM API")
+        if document_cache is not None:
+            await document_cache.aput(document_cache_key(doc_type, context), generated_text)
         return generated_text
     
     except Exception as e:
         logger.error(f"Ошибка при вызове YaLM API: {str(e)}")
-        return ("Произошла ошибка при генерации документа.\n\n"
-                "Вот пример структуры документа:\n\n" + 
-                DOCUMENT_TEMPLATES.get(doc_type, {"prompt": ""})["prompt"])
+        llm_errors_total.inc("complete")
+        return fallback_document_text(doc_type)
 
-def create_pdf(document_text, doc_type):
-    """Создает PDF файл из текста документа с поддержкой русского языка"""
-    try:
-        buffer = io.BytesIO()
-        
-        # Добавляем поддержку русского языка
-        try:
-            pdfmetrics.registerFont(TTFont('DejaVu', 'DejaVuSans.ttf'))
-            font_name = 'DejaVu'
-        except:
-            try:
-                pdfmetrics.registerFont(TTFont('Arial', 'arial.ttf'))
-                font_name = 'Arial'
-            except:
-                font_name = 'Helvetica'
-        
-        # Создаем PDF документ
-        doc = SimpleDocTemplate(
-            buffer,
-            pagesize=letter,
-            rightMargin=40,
-            leftMargin=40,
-            topMargin=40,
-            bottomMargin=40
-        )
-        
-        # Стили для документа
-        styles = getSampleStyleSheet()
-        
-        # Добавляем кастомный стиль для русского языка
-        styles.add(ParagraphStyle(
-            name='Russian',
-            fontName=font_name,
-            fontSize=12,
-            leading=15,
-            wordWrap='LTR',
-            alignment=0  # 0=left, 1=center, 2=right, 3=justify
-        ))
-        
-        title_style = styles["Heading1"]
-        title_style.fontName = font_name
-        title_style.fontSize = 16
-        title_style.alignment = 1  # Центрирование
-        
-        normal_style = styles["Russian"]
-        
-        # Разделяем текст на строки и создаем элементы
-        elements = []
-        
-        # Добавляем название документа
-        title = Paragraph(f"{doc_type}", title_style)
-        elements.append(title)
-        elements.append(Spacer(1, 20))
-        
-        # Добавляем дату и место
-        date_str = f"г. Москва, {datetime.now().strftime('%d.%m.%Y')}"
-        elements.append(Paragraph(date_str, normal_style))
-        elements.append(Spacer(1, 10))
-        
-        # Добавляем содержимое документа
-        lines = document_text.strip().split('\n')
-        for line in lines:
-            if line.strip():
-                # Если строка содержит двоеточие и выглядит как реквизит, делаем ее жирной
-                if any(keyword in line.lower() for keyword in ['г.', 'требую', 'прошу', 'адрес', 'ф.и.о', 'паспорт', 'дата']):
-                    p_style = ParagraphStyle(
-                        name='Header',
-                        fontName='Helvetica-Bold',  # Используем жирный шрифт для заголовков
-                        fontSize=12,
-                        leading=15,
-                        wordWrap='LTR',
-                        alignment=0
-                    )
-                else:
-                    p_style = normal_style
-                elements.append(Paragraph(line, p_style))
-                elements.append(Spacer(1, 5))
-        
-        # Добавляем подпись
-        elements.append(Spacer(1, 30))
-        signature = Paragraph("С уважением,<br/>_________________<br/>Дата: _________________", normal_style)
-        elements.append(signature)
-        
-        # Собираем документ
-        doc.build(elements)
-        
-        # Перематываем буфер к началу
-        buffer.seek(0)
-        return buffer
+async def stream_legal_document(doc_type, context, on_position=None):
+    """
+    Потоковая генерация документа через YaLM API.
+    Отдает накопленный текст по мере поступления, последнее значение — итоговый текст.
+    on_position(n) вызывается, пока запрос ждет своей очереди.
+    """
+    logger.info(f"Потоковая генерация документа через YaLM API: {doc_type}")
+    
+    if not yalm_client.configured:
+        logger.error("Отсутствуют необходимые переменные окружения для YaLM API")
+        yield "Ошибка: не настроено подключение к YaLM API. Обратитесь к администратору."
+        return
     
+    generated_text = ""
+    first_chunk_seconds = None
+    started = time.perf_counter()
+    try:
+        messages = build_document_messages(doc_type, context)
+        async for generated_text in yalm_scheduler.stream(messages, on_position=on_position):
+            if first_chunk_seconds is None:
+                first_chunk_seconds = time.perf_counter() - started
+                llm_first_chunk_seconds.observe(first_chunk_seconds)
+            yield generated_text
     except Exception as e:
-        logger.error(f"Ошибка при создании PDF: {e}")
-        return None
+        logger.error(f"Ошибка при вызове YaLM API: {str(e)}")
+        llm_errors_total.inc("stream")
+        yield fallback_document_text(doc_type)
+        return
+    
+    if not generated_text:
+        logger.error("YaLM API вернул пустой ответ")
+        llm_errors_total.inc("stream")
+        yield fallback_document_text(doc_type)
+        return
+    
+    llm_seconds.observe(time.perf_counter() - started, "stream")
+    logger.info(f"Документ успешно сгенерирован через YaLM API")
+    if document_cache is not None:
+        await document_cache.aput(document_cache_key(doc_type, context), generated_text)
+
+async def generate_document_text(doc_type, context):
+    """
+    Текст документа для пакетной генерации: из кэша или через очередь YaLM API.
+    В отличие от generate_legal_document, при ошибке бросает исключение.
+    """
+    cache_key = document_cache_key(doc_type, context)
+    cached = await document_cache.aget(cache_key) if document_cache is not None else None
+    if cached:
+        return cached.text
+    try:
+        with llm_seconds.time("bulk"):
+            generated_text = await yalm_scheduler.complete(build_document_messages(doc_type, context))
+    except Exception:
+        llm_errors_total.inc("bulk")
+        raise
+    if not generated_text:
+        llm_errors_total.inc("bulk")
+        raise ValueError("YaLM API вернул пустой ответ")
+    if document_cache is not None:
+        await document_cache.aput(cache_key, generated_text)
+    return generated_text
+
+def queue_position_text(position):
+    """Сообщение для пользователя, чей запрос ждет очереди к YaLM API"""
+    return (f"⏳ Много запросов, ваш документ в очереди: {position}.\n"
+            "Генерация начнется автоматически.")
+
+def document_preview(document_text):
+    """Текст документа для сообщения в чате"""
+    if len(document_text) > 3000:
+        document_text = document_text[:3000] + "..."
+    return "Текст документа:\n\n" + document_text
 
 @dp.message(Command("start"))
 async def start(message: types.Message, state: FSMContext):
@@ -301,6 +444,59 @@ async def help(message: types.Message):
         "- Загружайте договоры через /analyze"
     )
 
+@dp.message(Command("reload_kb"))
+async def reload_knowledge_base(message: types.Message):
+    # Перезагрузка базы знаний доступна только администраторам
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    await knowledge_base.wait_ready()
+    
+    changed = await knowledge_base.reload()
+    if changed is None:
+        await message.answer("Не удалось перезагрузить базу знаний, подробности в логах.")
+    else:
+        await message.answer(
+            f"База знаний перезагружена: {len(knowledge_base.entries)} вопросов, "
+            f"изменено записей: {changed}"
+        )
+
+def user_settings(state: FSMContext):
+    """Настройки пользователя хранятся отдельно от мастера документов и не сбрасываются state.clear()"""
+    return FSMContext(storage=state.storage, key=replace(state.key, destiny="settings"))
+
+async def user_country(message: types.Message, state: FSMContext):
+    """Страна, выбранная пользователем (None — любая), а если он не выбирал — страна бота"""
+    settings = await user_settings(state).get_data()
+    return settings.get("country", BOT_COUNTRIES.get(message.bot.id))
+
+@dp.message(Command("country"))
+async def choose_country(message: types.Message, state: FSMContext):
+    keyboard = types.ReplyKeyboardMarkup(
+        keyboard=[[types.KeyboardButton(text=country)] for country in COUNTRIES] +
+                 [[types.KeyboardButton(text="Любая страна")]],
+        resize_keyboard=True,
+        one_time_keyboard=True
+    )
+    
+    await message.answer(
+        "Выберите страну, законодательство которой вас интересует:",
+        reply_markup=keyboard
+    )
+    await state.set_state(SettingsForm.choosing_country)
+
+@dp.message(SettingsForm.choosing_country)
+async def process_country(message: types.Message, state: FSMContext):
+    country = message.text if message.text in COUNTRIES else None
+    await user_settings(state).update_data(country=country)
+    await state.set_state(None)
+    
+    await message.answer(
+        f"Буду искать ответы по законодательству: {country}" if country
+        else "Буду искать ответы по законодательству всех стран",
+        reply_markup=types.ReplyKeyboardRemove()
+    )
+
 @dp.message(Command("chat"))
 async def handle_chat(message: types.Message):
     # Показываем клавиатуру с примерами вопросов
@@ -353,85 +549,76 @@ async def process_document_type(message: types.Message, state: FSMContext):
         )
         return
     
-    # Сохраняем тип документа
-    await state.update_data(document_type=doc_type)
-    
     # Получаем обязательные поля
     required_fields = DOCUMENT_TEMPLATES[doc_type]["required_fields"]
     
-    # Сохраняем информацию о текущем поле
-    await state.update_data(current_field_index=0)
-    await state.update_data(required_fields=required_fields)
-    
-    # Запрашиваем первое поле
-    await message.answer(
-        f"Отлично! Будем создавать: {doc_type}\n\n"
-        f"Пожалуйста, укажите {required_fields[0]}:",
-        reply_markup=types.ReplyKeyboardRemove()
-    )
-    
-    # Устанавливаем соответствующее состояние в зависимости от типа документа
-    if doc_type == "Претензия на возврат товара":
-        await state.set_state(DocumentForm.entering_complaint_info)
-    elif doc_type == "Исковое заявление об увольнении":
-        await state.set_state(DocumentForm.entering_lawsuit_info)
-    elif doc_type == "Договор аренды квартиры":
-        await state.set_state(DocumentForm.entering_lease_agreement_info)
+    async with StateSession(state) as session:
+        # Сохраняем тип документа и информацию о текущем поле
+        session.update(
+            document_type=doc_type,
+            current_field_index=0,
+            required_fields=required_fields
+        )
+        
+        # Запрашиваем первое поле
+        await message.answer(
+            f"Отлично! Будем создавать: {doc_type}\n\n"
+            f"Пожалуйста, укажите {required_fields[0]}:",
+            reply_markup=types.ReplyKeyboardRemove()
+        )
+        
+        # Устанавливаем соответствующее состояние в зависимости от типа документа
+        session.set_state(DOCUMENT_STATES[doc_type])
 
 @dp.message(DocumentForm.entering_complaint_info)
 @dp.message(DocumentForm.entering_lawsuit_info)
 @dp.message(DocumentForm.entering_lease_agreement_info)
 async def process_document_info(message: types.Message, state: FSMContext):
-    # Получаем текущее состояние
-    user_data = await state.get_data()
-    doc_type = user_data["document_type"]
-    required_fields = user_data["required_fields"]
-    current_index = user_data.get("current_field_index", 0)
-    
-    # Сохраняем введенное значение
-    field_name = required_fields[current_index]
-    await state.update_data({field_name: message.text})
-    
-    # Переходим к следующему полю
-    current_index += 1
-    
-    # Проверяем, есть ли еще поля для заполнения
-    if current_index < len(required_fields):
-        await state.update_data(current_field_index=current_index)
-        await message.answer(f"Теперь укажите {required_fields[current_index]}:")
-    else:
-        # Все поля заполнены, показываем подтверждение
-        user_data = await state.get_data()
+    async with StateSession(state) as session:
+        # Получаем текущее состояние
+        user_data = session.data
+        doc_type = user_data["document_type"]
+        required_fields = user_data["required_fields"]
+        current_index = user_data.get("current_field_index", 0)
         
-        # Формируем текст подтверждения
-        confirmation_text = f"Проверьте введенные данные для {doc_type}:\n\n"
-        for field in required_fields:
-            confirmation_text += f"{field}: {user_data.get(field, 'Не указано')}\n"
+        # Сохраняем введенное значение
+        field_name = required_fields[current_index]
+        session.update({field_name: message.text})
         
-        # Добавляем дату, если ее нет
-        if "дата" not in required_fields:
-            user_data["дата"] = datetime.now().strftime("%d.%m.%Y")
-        
-        # Сохраняем обновленные данные
-        await state.update_data(user_data)
-        
-        # Клавиатура подтверждения
-        keyboard = types.ReplyKeyboardMarkup(
-            keyboard=[
-                [types.KeyboardButton(text="Да, все верно")],
-                [types.KeyboardButton(text="Нет, ввести заново")]
-            ],
-            resize_keyboard=True,
-            one_time_keyboard=True
-        )
+        # Переходим к следующему полю
+        current_index += 1
         
-        await message.answer(
-            confirmation_text + "\n\nВсе верно?",
-            reply_markup=keyboard
-        )
-        await state.set_state(DocumentForm.confirming_document)
+        # Проверяем, есть ли еще поля для заполнения
+        if current_index < len(required_fields):
+            session.update(current_field_index=current_index)
+            await message.answer(f"Теперь укажите {required_fields[current_index]}:")
+        else:
+            # Все поля заполнены, показываем подтверждение
+            confirmation_text = f"Проверьте введенные данные для {doc_type}:\n\n"
+            for field in required_fields:
+                confirmation_text += f"{field}: {user_data.get(field, 'Не указано')}\n"
+            
+            # Добавляем дату, если ее нет
+            if "дата" not in required_fields:
+                session.update({"дата": datetime.now().strftime("%d.%m.%Y")})
+            
+            # Клавиатура подтверждения
+            keyboard = types.ReplyKeyboardMarkup(
+                keyboard=[
+                    [types.KeyboardButton(text="Да, все верно")],
+                    [types.KeyboardButton(text="Нет, ввести заново")]
+                ],
+                resize_keyboard=True,
+                one_time_keyboard=True
+            )
+            
+            await message.answer(
+                confirmation_text + "\n\nВсе верно?",
+                reply_markup=keyboard
+            )
+            session.set_state(DocumentForm.confirming_document)
 
-@dp.message(DocumentForm.confirming_document, F.text == "Да, все верно")
+@dp.message(DocumentForm.confirming_document, F.text == "Да, все верно", flags={"cost": "expensive"})
 async def confirm_document(message: types.Message, state: FSMContext):
     # Получаем данные
     user_data = await state.get_data()
@@ -452,34 +639,86 @@ async def confirm_document(message: types.Message, state: FSMContext):
         await state.set_state(DocumentForm.entering_complaint_info)
         return
     
-    # Генерируем документ
-    document_text = generate_legal_document(doc_type, user_data)
-    
-    # Создаем PDF
-    pdf_buffer = create_pdf(document_text, doc_type)
-    
-    if pdf_buffer:
-        # Отправляем PDF
-        pdf_file = types.BufferedInputFile(
-            pdf_buffer.getvalue(),
-            filename=f"{doc_type.replace(' ', '_')}.pdf"
-        )
+    # Ищем документ в кэше: те же тип и данные — тот же промпт
+    cache_key = document_cache_key(doc_type, user_data)
+    cached = await document_cache.aget(cache_key) if document_cache is not None else None
+    today = datetime.now().strftime('%d.%m.%Y')
+    text_shown = False
+    pdf_bytes = None
+    
+    if cached:
+        logger.info(f"Документ найден в кэше: {doc_type}, доля попаданий {document_cache.hit_ratio:.2f}")
+        document_text = cached.text
+        # PDF содержит дату, поэтому берем его из кэша только в тот же день
+        if cached.pdf_date == today:
+            pdf_bytes = cached.pdf
+    elif STREAM_DOCUMENTS:
+        # Генерируем документ, показывая текст по мере генерации в одном сообщении
+        progress = await ProgressMessage.send(message, "⏳ Генерирую документ...")
         
-        await message.answer_document(
-            pdf_file,
-            caption="Ваш юридический документ готов!\n\n"
-                    "Вы можете скачать его и использовать по назначению."
-        )
+        async def show_position(position):
+            await progress.update(queue_position_text(position))
         
-        # Отправляем текст документа
-        await message.answer(
-            "Текст документа:\n\n" + document_text[:3000] + "..."
-            if len(document_text) > 3000 else document_text
-        )
+        document_text = ""
+        async for document_text in stream_legal_document(doc_type, user_data, on_position=show_position):
+            await progress.update(document_text)
+        await progress.finish(document_preview(document_text))
+        text_shown = True
     else:
-        await message.answer(
-            "Произошла ошибка при создании PDF. Отправляю текст документа:\n\n" + document_text
-        )
+        # Сообщение о месте в очереди показываем, только если запрос пришлось ждать
+        progress = None
+        
+        async def show_position(position):
+            nonlocal progress
+            if progress is None:
+                progress = await ProgressMessage.send(message, queue_position_text(position))
+            else:
+                await progress.update(queue_position_text(position))
+        
+        document_text = await generate_legal_document(doc_type, user_data, on_position=show_position)
+        if progress is not None:
+            await progress.finish(document_preview(document_text))
+            text_shown = True
+    
+    # Создаем PDF во временном файле; из кэша — сразу байты
+    filename = f"{doc_type.replace(' ', '_')}.pdf"
+    pdf_file = None
+    pdf_path = None
+    if pdf_bytes is not None:
+        pdf_file = types.BufferedInputFile(pdf_bytes, filename=filename)
+    else:
+        with pdf_render_seconds.time():
+            pdf_path = await pdf_renderer.render_pdf(document_text, doc_type)
+        if pdf_path is None:
+            pdf_errors_total.inc()
+        else:
+            pdf_size = os.path.getsize(pdf_path)
+            pdf_bytes_size.observe(pdf_size)
+            # Большие PDF в кэш не кладем, их дешевле собрать заново
+            if document_cache is not None and pdf_size <= PDF_CACHE_MAX_BYTES:
+                await document_cache.aset_pdf(cache_key, await asyncio.to_thread(read_file, pdf_path), today)
+            # Telegram читает файл с диска по частям
+            pdf_file = types.FSInputFile(pdf_path, filename=filename)
+    
+    try:
+        if pdf_file is not None:
+            # Отправляем PDF
+            await message.answer_document(
+                pdf_file,
+                caption="Ваш юридический документ готов!\n\n"
+                        "Вы можете скачать его и использовать по назначению."
+            )
+            
+            # Отправляем текст документа, если он еще не показан при генерации
+            if not text_shown:
+                await message.answer(document_preview(document_text))
+        else:
+            await message.answer(
+                "Произошла ошибка при создании PDF. Отправляю текст документа:\n\n" + document_text
+            )
+    finally:
+        if pdf_path is not None:
+            discard_pdf(pdf_path)
     
     # Сбрасываем состояние
     await state.clear()
@@ -502,100 +741,198 @@ async def confirm_document(message: types.Message, state: FSMContext):
 @dp.message(DocumentForm.confirming_document, F.text == "Нет, ввести заново")
 async def restart_document(message: types.Message, state: FSMContext):
     # Сбрасываем состояние и начинаем заново
-    user_data = await state.get_data()
-    doc_type = user_data["document_type"]
-    
-    # Получаем обязательные поля
+    async with StateSession(state) as session:
+        doc_type = session.data["document_type"]
+        
+        # Получаем обязательные поля
+        required_fields = DOCUMENT_TEMPLATES[doc_type]["required_fields"]
+        
+        # Обновляем состояние
+        session.update(current_field_index=0, required_fields=required_fields)
+        
+        await message.answer(
+            f"Хорошо, начнем заново.\n\n"
+            f"Пожалуйста, укажите {required_fields[0]}:",
+            reply_markup=types.ReplyKeyboardRemove()
+        )
+        
+        # Устанавливаем соответствующее состояние в зависимости от типа документа
+        session.set_state(DOCUMENT_STATES[doc_type])
+
+@dp.message(Command("bulk"))
+async def bulk_start(message: types.Message, state: FSMContext):
+    # Пакетная генерация доступна только пользователям из BULK_USER_IDS
+    if message.from_user.id not in BULK_USER_IDS:
+        return
+
+    await state.clear()
+    keyboard = types.ReplyKeyboardMarkup(
+        keyboard=[[types.KeyboardButton(text=doc_type)] for doc_type in DOCUMENT_TEMPLATES],
+        resize_keyboard=True,
+        one_time_keyboard=True
+    )
+    await message.answer(
+        "Пакетная генерация: выберите тип документов.",
+        reply_markup=keyboard
+    )
+    await state.set_state(BulkForm.choosing_document_type)
+
+@dp.message(BulkForm.choosing_document_type)
+async def bulk_document_type(message: types.Message, state: FSMContext):
+    doc_type = message.text
+    if doc_type not in DOCUMENT_TEMPLATES:
+        await message.answer(
+            "Выберите один из предложенных типов документа.",
+        )
+        return
+
     required_fields = DOCUMENT_TEMPLATES[doc_type]["required_fields"]
-    
-    # Обновляем состояние
-    await state.update_data(current_field_index=0)
-    await state.update_data(required_fields=required_fields)
-    
+    await state.update_data(document_type=doc_type)
+    await state.set_state(BulkForm.waiting_file)
     await message.answer(
-        f"Хорошо, начнем заново.\n\n"
-        f"Пожалуйста, укажите {required_fields[0]}:",
+        f"Отправьте файл CSV или JSONL (до {BULK_MAX_ROWS} строк).\n\n"
+        "В CSV первая строка — названия колонок, в JSONL — по объекту на строку. "
+        "Нужны поля:\n" + "\n".join(f"- {field}" for field in required_fields),
         reply_markup=types.ReplyKeyboardRemove()
     )
-    
-    # Устанавливаем соответствующее состояние в зависимости от типа документа
-    if doc_type == "Претензия на возврат товара":
-        await state.set_state(DocumentForm.entering_complaint_info)
-    elif doc_type == "Исковое заявление об увольнении":
-        await state.set_state(DocumentForm.entering_lawsuit_info)
-    elif doc_type == "Договор аренды квартиры":
-        await state.set_state(DocumentForm.entering_lease_agreement_info)
+
+@dp.message(BulkForm.waiting_file, F.document, flags={"cost": "expensive"})
+async def bulk_process_file(message: types.Message, state: FSMContext):
+    doc_type = (await state.get_data())["document_type"]
+    document = message.document
+
+    if document.file_size and document.file_size > BULK_MAX_FILE_BYTES:
+        await message.answer(f"Файл слишком большой, максимум {BULK_MAX_FILE_BYTES // 1024} КБ.")
+        return
+    if not yalm_client.configured:
+        await message.answer("Ошибка: не настроено подключение к YaLM API. Обратитесь к администратору.")
+        await state.clear()
+        return
+
+    # Разбираем и проверяем файл целиком до начала генерации
+    data = (await message.bot.download(document)).getvalue()
+    try:
+        rows = parse_rows(data, document.file_name or "", BULK_MAX_ROWS)
+    except BulkError as e:
+        await message.answer(f"Не удалось прочитать файл: {e}")
+        return
+
+    valid, errors = validate_rows(rows, DOCUMENT_TEMPLATES[doc_type]["required_fields"])
+    bulk_documents_total.inc("invalid", amount=len(errors))
+    if not valid:
+        await message.answer(
+            "Ни одна строка не прошла проверку:\n" +
+            "\n".join(f"Строка {number}: {error}" for number, error in errors[:20])
+        )
+        return
+
+    await state.clear()
+    logger.info(f"Пакетная генерация: {doc_type}, строк {len(rows)}, к генерации {len(valid)}")
+    progress = await ProgressMessage.send(message, f"⏳ Генерирую документы: 0 из {len(valid)}")
+
+    async def show_progress(done, total):
+        await progress.update(f"⏳ Генерирую документы: {done} из {total}")
+
+    async def render(document_text):
+        with pdf_render_seconds.time():
+            pdf_path = await pdf_renderer.render_pdf(document_text, doc_type)
+        if pdf_path is None:
+            pdf_errors_total.inc()
+        return pdf_path
+
+    zip_path, failures = await generate_bulk(
+        valid,
+        lambda context: generate_document_text(doc_type, context),
+        render,
+        concurrency=BULK_CONCURRENCY,
+        on_progress=show_progress,
+        directory=pdf_renderer.directory
+    )
+    bulk_documents_total.inc("failed", amount=len(failures))
+    bulk_documents_total.inc("ok", amount=len(valid) - len(failures))
+
+    try:
+        await asyncio.to_thread(add_report, zip_path, len(rows), errors + failures)
+        await progress.finish(
+            f"Готово: {len(valid) - len(failures)} из {len(rows)}. "
+            "Статус каждой строки — в report.csv внутри архива."
+        )
+        await message.answer_document(
+            types.FSInputFile(zip_path, filename=f"{doc_type.replace(' ', '_')}.zip")
+        )
+    finally:
+        discard_pdf(zip_path)
+
+@dp.message(BulkForm.waiting_file)
+async def bulk_waiting_file(message: types.Message):
+    await message.answer("Отправьте файл CSV или JSONL документом, либо /start для отмены.")
+
+NOT_FOUND_TEXT = ("К сожалению, я не нашел точного ответа в базе знаний.\n"
+                  "Попробуйте уточнить вопрос или задайте другой.\n\n"
+                  "Или воспользуйтесь /document для создания документа.")
+
+def format_answer(item):
+    """Формирует ответ по записи базы знаний"""
+    response = f"⚖️ {item['answer']}\n\n"
+    
+    # Добавляем ссылки на законы, если они есть
+    if item["law_links"] and len(item["law_links"]) > 0:
+        response += "🔗 Источник: "
+        for i, link in enumerate(item["law_links"], 1):
+            response += f"\n{i}. {link.strip()}"
+    return response
 
 @dp.message()
-async def handle_question(message: types.Message):
+async def handle_question(message: types.Message, state: FSMContext):
     # Предобработка текста
     user_question = preprocess_text(message.text)
     
-    # Поиск наиболее похожего вопроса
-    best_match = None
-    best_ratio = 0.4  # снижаем порог схожести для лучшего поиска
+    # Страна пользователя сужает поиск до ее раздела базы
+    country = await user_country(message, state)
+    
+    # Сразу после запуска база знаний может еще загружаться
+    await knowledge_base.wait_ready()
+    
+    # Частые вопросы отвечаются из кэша без поиска по базе
+    cache_key = (user_question, country)
+    kb_version = knowledge_base.version
+    cached = answer_cache.get(cache_key, kb_version)
+    
+    if cached is None:
+        # Поиск по индексу: основные вопросы, синонимы и ключевые слова
+        started = time.perf_counter()
+        with match_seconds.time():
+            best_match, source, score = await knowledge_base.alookup(user_question, country)
+        match_ms = (time.perf_counter() - started) * 1000
+        answers_total.inc(source or "miss")
+        response = format_answer(best_match) if best_match else NOT_FOUND_TEXT
+        entry_id = best_match.get("id") if best_match else None
+        # Вместе с ответом кэшируем результат поиска — для журнала запросов
+        answer_cache.put(cache_key, (response, source, entry_id, score), kb_version)
+    else:
+        answers_total.inc("cache")
+        response, source, entry_id, score = cached
+        match_ms = 0.0
     
-    # Поиск по основным вопросам и синонимам
-    for item in qa_base:
-        # Проверяем основной вопрос
-        base_question = preprocess_text(item["question"])
-        ratio = calculate_similarity(user_question, base_question)
-        
-        # Проверяем синонимы, если они есть
-        if "synonyms" in item:
-            for synonym in item["synonyms"]:
-                synonym_processed = preprocess_text(synonym)
-                synonym_ratio = calculate_similarity(user_question, synonym_processed)
-                if synonym_ratio > ratio:
-                    ratio = synonym_ratio
-        
-        # Если нашли более подходящий вопрос
-        if ratio > best_ratio:
-            best_ratio = ratio
-            best_match = item
-    
-    # Дополнительная проверка по ключевым словам
-    if not best_match:
-        keywords = {
-            "уволили": [q for q in qa_base if "уволили" in preprocess_text(q["question"])],
-            "вернуть деньги": [q for q in qa_base if "вернуть деньги" in preprocess_text(q["question"]) or "возврат" in preprocess_text(q["question"])],
-            "дтп": [q for q in qa_base if "дтп" in preprocess_text(q["question"])],
-            "гидд": [q for q in qa_base if "гидд" in preprocess_text(q["question"])]
-        }
-        
-        for keyword, matches in keywords.items():
-            if keyword in user_question and matches:
-                best_match = matches[0]
-                break
-    
-    # Если нашли подходящий вопрос
-    if best_match:
-        # Формируем ответ
-        response = f"⚖️ {best_match['answer']}\n\n"
-            
-        # Добавляем ссылки на законы, если они есть
-        if best_match["law_links"] and len(best_match["law_links"]) > 0:
-            response += "🔗 Источник: "
-            for i, link in enumerate(best_match["law_links"], 1):
-                response += f"\n{i}. {link.strip()}"
-        
-        await message.answer(
-            response,
-            reply_markup=types.ReplyKeyboardRemove()
-        )
-        return
+    if query_log is not None:
+        query_log.record(message.text, country, source, entry_id, score, match_ms, cached=cached is not None)
     
-    # Если вопрос не найден
     await message.answer(
-        "К сожалению, я не нашел точного ответа в базе знаний.\n"
-        "Попробуйте уточнить вопрос или задайте другой.\n\n"
-        "Или воспользуйтесь /document для создания документа.",
+        response,
         reply_markup=types.ReplyKeyboardRemove()
     )
 
 async def main():
     logger.info("Запуск бота...")
-    await dp.start_polling(bot)
+    await dp.start_polling(*bots)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # BOT_MODE=webhook — прием обновлений через webhook вместо long polling
+    if os.getenv("BOT_MODE", "polling") == "webhook":
+        logger.info("Запуск бота в режиме webhook...")
+        # Процессы webhook-сервера наследуют уже загруженную базу и делят ее страницы памяти
+        if WEBHOOK_WORKERS > 1:
+            knowledge_base.load()
+        run_webhook(dp, bots)
+    else:
+        asyncio.run(main())
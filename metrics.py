@@ -0,0 +1,236 @@
+"""
+Метрики бота в текстовом формате Prometheus.
+
+Счетчики и гистограммы хранятся в памяти процесса и обновляются без
+блокировок (все обработчики работают в одном цикле событий), поэтому их
+можно не отключать под нагрузкой. Страница /metrics отдается отдельным
+aiohttp-сервером на METRICS_PORT. При METRICS_TRACE=1 для каждого
+обновления в лог пишется разбивка времени по этапам.
+"""
+import time
+import logging
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм времени, в секундах
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Границы корзин размера файлов, в байтах
+SIZE_BUCKETS = (10_000, 25_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 5_000_000)
+
+# Этапы текущего обновления: [(название, секунды)] или None, если трассировка выключена
+_trace = ContextVar("metrics_trace", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Монотонный счетчик, значения хранятся отдельно для каждого набора меток"""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Для каждого набора меток: [счетчики корзин..., сумма]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *labels):
+        """Контекстный менеджер: замеряет время блока и записывает его в гистограмму"""
+        return _Timer(self, labels)
+
+    def samples(self):
+        bounds = self.buckets + (float("inf"),)
+        for labels, series in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                yield (f"{self.name}_bucket",
+                       _format_labels(self.labelnames, labels, [("le", _format_value(bound))]),
+                       cumulative)
+            yield f"{self.name}_sum", _format_labels(self.labelnames, labels), series[-1]
+            yield f"{self.name}_count", _format_labels(self.labelnames, labels), cumulative
+
+
+class Gauge:
+    """
+    Значение, которое вычисляется в момент чтения метрик. kind="counter" —
+    для счетчиков, которые ведет сам объект (например, планировщик запросов).
+    """
+
+    def __init__(self, name, documentation, callback, kind="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.kind = kind
+
+    def samples(self):
+        yield self.name, "", self.callback()
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        self.histogram.observe(elapsed, *self.labels)
+        record_stage(self.histogram.name, elapsed)
+        return False
+
+
+def record_stage(name, seconds):
+    """Добавляет этап в трассировку текущего обновления, если она включена"""
+    stages = _trace.get()
+    if stages is not None:
+        stages.append((name, seconds))
+
+
+class Registry:
+    """Набор метрик одного процесса"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, callback, kind="gauge"):
+        return self.register(Gauge(name, documentation, callback, kind))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                for name, labels, value in metric.samples():
+                    lines.append(f"{name}{labels} {_format_value(value)}")
+            except Exception as e:
+                logger.error(f"Ошибка при чтении метрики {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware: время и ошибки каждого обработчика, а при
+    trace=True — лог с разбивкой времени обновления по этапам.
+    """
+
+    def __init__(self, registry, trace=False):
+        self.trace = trace
+        self.handler_seconds = registry.histogram(
+            "lexoai_handler_seconds", "Время обработки сообщения", ["handler"]
+        )
+        self.handler_errors = registry.counter(
+            "lexoai_handler_errors_total", "Исключения в обработчиках", ["handler"]
+        )
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        token = _trace.set([]) if self.trace else None
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.handler_errors.inc(name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.handler_seconds.observe(elapsed, name)
+            if token is not None:
+                stages = ", ".join(f"{stage} {seconds * 1000:.1f} мс" for stage, seconds in _trace.get())
+                _trace.reset(token)
+                update = data.get("event_update")
+                update_id = update.update_id if update is not None else "?"
+                logger.info(f"Обновление {update_id}: {name} {elapsed * 1000:.1f} мс"
+                            + (f" ({stages})" if stages else ""))
+
+
+async def start_metrics_server(registry, host="127.0.0.1", port=9100, attempts=1):
+    """
+    Запускает HTTP-сервер с метриками на GET /metrics.
+    В режиме нескольких процессов каждый занимает первый свободный порт из
+    port..port+attempts-1. Возвращает AppRunner или None, если свободного порта нет.
+    """
+    async def handle_metrics(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    for offset in range(max(attempts, 1)):
+        try:
+            site = web.TCPSite(runner, host, port + offset)
+            await site.start()
+        except OSError:
+            continue
+        logger.info(f"Метрики доступны на http://{host}:{port + offset}/metrics")
+        return runner
+    await runner.cleanup()
+    logger.warning(f"Не удалось запустить сервер метрик: порты {port}..{port + attempts - 1} заняты")
+    return None
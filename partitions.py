@@ -0,0 +1,184 @@
+import math
+from collections import Counter, defaultdict
+
+from search import BaseQAIndex, extract_features, partition_key
+
+# Страны, между которыми может выбирать пользователь
+COUNTRIES = ["Россия", "Беларусь", "Казахстан"]
+
+
+class CategoryClassifier:
+    """
+    Наивный байесовский классификатор категории по признакам запроса
+    (слова и триграммы, как в основном индексе).
+    """
+
+    def __init__(self, phrases_by_category, alpha=1.0):
+        self.alpha = alpha
+        self.counts = {}
+        self.totals = {}
+        self.priors = {}
+        vocabulary = set()
+        total_phrases = sum(len(texts) for texts in phrases_by_category.values())
+
+        for category, texts in phrases_by_category.items():
+            counts = Counter()
+            for text in texts:
+                counts.update(extract_features(text))
+            self.counts[category] = counts
+            self.totals[category] = sum(counts.values())
+            self.priors[category] = math.log(len(texts) / total_phrases)
+            vocabulary.update(counts)
+        self.vocabulary_size = len(vocabulary) or 1
+
+    def predict(self, query):
+        """Возвращает (категория, вероятность) или (None, 0.0)"""
+        if not self.counts:
+            return None, 0.0
+        features = extract_features(query)
+        scores = {}
+        for category, counts in self.counts.items():
+            denominator = math.log(self.totals[category] + self.alpha * self.vocabulary_size)
+            score = self.priors[category]
+            for feature in features:
+                score += math.log(counts.get(feature, 0) + self.alpha) - denominator
+            scores[category] = score
+
+        best = max(scores, key=scores.get)
+        # Нормируем через softmax, чтобы получить уверенность
+        top = scores[best]
+        total = sum(math.exp(score - top) for score in scores.values())
+        return best, 1.0 / total
+
+
+def merge_ranges(ranges):
+    """Сортирует диапазоны [начало, конец) и склеивает соседние"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class PartitionView(BaseQAIndex):
+    """
+    Раздел базы поверх основного индекса: те же фразы, признаки и записи,
+    но поиск идет только по диапазонам id фраз раздела. Списки фраз по
+    признакам отсортированы, поэтому из них бисекцией берутся только участки
+    раздела, и работа на запрос пропорциональна размеру раздела. Ничего не
+    копирует и не распаковывает, поэтому подходит и для базы в mmap (kb_binary.py).
+    Результат тот же, что у отдельного индекса по записям раздела.
+    """
+
+    def __init__(self, index, phrase_ranges, entry_count):
+        self.index = index
+        self.entries = index.entries
+        self.phrases = index.phrases
+        self.phrase_entries = index.phrase_entries
+        self.phrase_sizes = index.phrase_sizes
+        self.postings = index.postings
+        self.top_k = index.top_k
+        self.exact_limit = index.exact_limit
+        self.phrase_ranges = phrase_ranges
+        self.entry_count = entry_count
+
+    def __len__(self):
+        return self.entry_count
+
+
+class PartitionedSearch:
+    """
+    Разделы по странам и по парам (страна, категория) поверх основного индекса.
+
+    Если у пользователя выбрана страна, поиск идет только по ее записям. Если
+    включена маршрутизация по категориям и классификатор уверен в категории,
+    сначала ищем только внутри нее, а при неудаче — по всей стране.
+    """
+
+    def __init__(self, index, category_routing=False, confidence=0.6):
+        self.index = index
+        self.category_routing = category_routing
+        self.confidence = confidence
+
+        # Страны и категория каждой записи читаются один раз
+        entry_keys = [partition_key(item) for item in index.entries]
+
+        # Участки подряд идущих фраз записей с одинаковым ключом. Индексы кладут
+        # такие записи рядом, поэтому у каждого ключа обычно один участок
+        runs = defaultdict(list)
+        previous_entry = previous_key = None
+        start = 0
+        for phrase_id, entry_index in enumerate(index.phrase_entries):
+            if entry_index == previous_entry:
+                continue
+            previous_entry = entry_index
+            key = entry_keys[entry_index]
+            if key != previous_key:
+                if previous_key is not None:
+                    runs[previous_key].append((start, phrase_id))
+                previous_key, start = key, phrase_id
+        if previous_key is not None:
+            runs[previous_key].append((start, len(index.phrase_entries)))
+
+        by_country = defaultdict(list)
+        by_country_category = defaultdict(list)
+        for key, entry_count in Counter(entry_keys).items():
+            countries, category = key
+            for country in dict.fromkeys(countries):
+                by_country[country].append((runs[key], entry_count))
+                by_country_category[(country, category)].append((runs[key], entry_count))
+
+        self.countries = {
+            country: self._partition(groups) for country, groups in by_country.items()
+        }
+        self.partitions = {}
+        self.classifiers = {}
+        if category_routing:
+            self.partitions = {
+                key: self._partition(groups) for key, groups in by_country_category.items()
+            }
+            phrases_by_country = defaultdict(lambda: defaultdict(list))
+            for phrase_id, entry_index in enumerate(index.phrase_entries):
+                countries, category = entry_keys[entry_index]
+                if countries:
+                    text = index.phrases[phrase_id][1]
+                    for country in countries:
+                        phrases_by_country[country][category].append(text)
+            for country, phrases_by_category in phrases_by_country.items():
+                self.classifiers[country] = CategoryClassifier(phrases_by_category)
+
+    def _partition(self, groups):
+        # groups — (участки фраз, число записей) для каждого ключа раздела
+        entry_count = sum(count for _, count in groups)
+        # Раздел со всеми записями базы — это сам основной индекс
+        if entry_count == len(self.index):
+            return self.index
+        ranges = merge_ranges(phrase_range for runs, _ in groups for phrase_range in runs)
+        return PartitionView(self.index, ranges, entry_count)
+
+    def classify(self, query, country):
+        classifier = self.classifiers.get(country)
+        if classifier is None:
+            return None, 0.0
+        return classifier.predict(query)
+
+    def lookup(self, query, country=None):
+        """Поиск с учетом страны пользователя; без страны — по всей базе"""
+        country_index = self.countries.get(country)
+        if country_index is None:
+            return self.index.lookup(query)
+
+        if self.category_routing:
+            category, probability = self.classify(query, country)
+            partition = self.partitions.get((country, category))
+            if partition is not None and probability >= self.confidence:
+                item, score = partition.best_match(query)
+                if item is not None:
+                    return item, "fuzzy", score
+
+        return country_index.lookup(query)
+
+    def search(self, query, country=None):
+        return self.lookup(query, country)[0]
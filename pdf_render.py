@@ -0,0 +1,323 @@
+import io
+import os
+import asyncio
+import logging
+import tempfile
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# reportlab импортируется при первом создании PDF, а не при запуске бота:
+# большинство обновлений до рендеринга не доходит
+
+logger = logging.getLogger(__name__)
+
+# Строки с такими словами выделяются жирным как реквизиты
+HEADER_KEYWORDS = ['г.', 'требую', 'прошу', 'адрес', 'ф.и.о', 'паспорт', 'дата']
+
+# Шрифт и стили создаются один раз на процесс
+_styles = None
+
+
+def _register_font():
+    """Добавляем поддержку русского языка"""
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    try:
+        pdfmetrics.registerFont(TTFont('DejaVu', 'DejaVuSans.ttf'))
+        return 'DejaVu'
+    except Exception:
+        try:
+            pdfmetrics.registerFont(TTFont('Arial', 'arial.ttf'))
+            return 'Arial'
+        except Exception:
+            return 'Helvetica'
+
+
+def get_styles():
+    """Возвращает стили документа, при первом вызове регистрирует шрифт"""
+    global _styles
+    if _styles is None:
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+
+        font_name = _register_font()
+        styles = getSampleStyleSheet()
+
+        # Добавляем кастомный стиль для русского языка
+        styles.add(ParagraphStyle(
+            name='Russian',
+            fontName=font_name,
+            fontSize=12,
+            leading=15,
+            wordWrap='LTR',
+            alignment=0  # 0=left, 1=center, 2=right, 3=justify
+        ))
+        styles.add(ParagraphStyle(
+            name='Header',
+            fontName='Helvetica-Bold',  # Используем жирный шрифт для заголовков
+            fontSize=12,
+            leading=15,
+            wordWrap='LTR',
+            alignment=0
+        ))
+
+        title_style = styles["Heading1"]
+        title_style.fontName = font_name
+        title_style.fontSize = 16
+        title_style.alignment = 1  # Центрирование
+
+        _styles = styles
+    return _styles
+
+
+class _FlowableStream(list):
+    """
+    Список элементов для SimpleDocTemplate.build, который пополняется из
+    итератора по мере верстки. reportlab забирает элементы с начала списка,
+    поэтому в памяти одновременно только окно из window элементов, а не
+    весь документ.
+    """
+
+    def __init__(self, iterator, window=64):
+        super().__init__()
+        self._iterator = iterator
+        self._window = window
+        self._fill()
+
+    def _fill(self):
+        while self._iterator is not None and list.__len__(self) < self._window:
+            try:
+                self.append(next(self._iterator))
+            except StopIteration:
+                self._iterator = None
+
+    def __len__(self):
+        self._fill()
+        return list.__len__(self)
+
+    def __getitem__(self, index):
+        self._fill()
+        return list.__getitem__(self, index)
+
+
+def iter_lines(text):
+    """Строки текста по одной, без копии всего текста в список"""
+    start = 0
+    while True:
+        end = text.find("\n", start)
+        if end < 0:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+
+def _document_elements(lines, doc_type, styles):
+    """Элементы документа по одной строке текста за раз"""
+    from reportlab.platypus import Paragraph, Spacer
+
+    title_style = styles["Heading1"]
+    normal_style = styles["Russian"]
+    header_style = styles["Header"]
+
+    # Добавляем название документа
+    yield Paragraph(f"{doc_type}", title_style)
+    yield Spacer(1, 20)
+
+    # Добавляем дату и место
+    date_str = f"г. Москва, {datetime.now().strftime('%d.%m.%Y')}"
+    yield Paragraph(date_str, normal_style)
+    yield Spacer(1, 10)
+
+    # Добавляем содержимое документа
+    for line in lines:
+        if line.strip():
+            # Если строка выглядит как реквизит, делаем ее жирной
+            lowered = line.lower()
+            if any(keyword in lowered for keyword in HEADER_KEYWORDS):
+                p_style = header_style
+            else:
+                p_style = normal_style
+            yield Paragraph(line, p_style)
+            yield Spacer(1, 5)
+
+    # Добавляем подпись
+    yield Spacer(1, 30)
+    yield Paragraph("С уважением,<br/>_________________<br/>Дата: _________________", normal_style)
+
+
+def write_pdf(lines, doc_type, output):
+    """
+    Верстает PDF из итератора строк текста в output (путь или файловый объект).
+
+    Абзацы создаются по мере заполнения страниц, а не все сразу, но память
+    все равно растет с длиной документа: reportlab хранит содержимое готовых
+    страниц до конца верстки и собирает файл целиком в памяти перед записью.
+    Пик — около 3.5 МБ на стили и шрифт плюс примерно четыре объема текста
+    (300 КБ текста, ~100 страниц — 4.5 МБ). Длину текста ограничивает
+    max_tokens генерации (см. yalm.py), так что для документов бота это
+    единицы мегабайт на процесс пула.
+    """
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate
+
+    doc = SimpleDocTemplate(
+        output,
+        pagesize=letter,
+        rightMargin=40,
+        leftMargin=40,
+        topMargin=40,
+        bottomMargin=40
+    )
+    doc.build(_FlowableStream(_document_elements(lines, doc_type, get_styles())))
+
+
+def create_pdf(document_text, doc_type):
+    """Создает PDF файл из текста документа с поддержкой русского языка"""
+    try:
+        buffer = io.BytesIO()
+        write_pdf(iter_lines(document_text), doc_type, buffer)
+
+        # Перематываем буфер к началу
+        buffer.seek(0)
+        return buffer
+
+    except Exception as e:
+        logger.error(f"Ошибка при создании PDF: {e}")
+        return None
+
+
+def render_pdf_file(document_text, doc_type, directory=None):
+    """
+    Собирает PDF во временный файл и возвращает путь к нему
+    (выполняется в процессе пула). Файл удаляет вызывающий.
+    """
+    fd, path = tempfile.mkstemp(prefix="lexoai-", suffix=".pdf", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write_pdf(iter_lines(document_text), doc_type, f)
+        return path
+    except Exception as e:
+        logger.error(f"Ошибка при создании PDF: {e}")
+        discard_pdf(path)
+        return None
+
+
+def discard_pdf(path):
+    """Удаляет временный файл PDF"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _warm_up():
+    return True
+
+
+def _pool_context():
+    """
+    Процессы пула запускаются через forkserver: fork из бота копировал бы
+    его потоки в произвольном состоянии (например, загрузку базы знаний в
+    фоне, которая держит блокировки). Сервер заранее импортирует только этот
+    модуль, а не main.py. Где forkserver нет — способ запуска по умолчанию.
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return None
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+class PDFRenderer:
+    """
+    Сервис рендеринга PDF в пуле процессов.
+
+    Шрифты и стили регистрируются один раз в каждом процессе пула. Число
+    ожидающих рендеринга документов ограничено max_queue: если очередь
+    заполнена дольше queue_timeout секунд, render_pdf возвращает None,
+    и бот отправляет документ текстом.
+
+    Готовый PDF пишется во временный файл в directory: между процессами
+    передается только путь, а Telegram читает файл по частям.
+    """
+
+    def __init__(self, workers=2, max_queue=32, queue_timeout=30, directory=None):
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.directory = directory
+        self._slots = asyncio.Semaphore(max_queue)
+        self._executor = None
+
+    @classmethod
+    def from_env(cls):
+        """PDF_WORKERS=0 — рендеринг в потоке без пула процессов"""
+        return cls(
+            workers=int(os.getenv("PDF_WORKERS", "2")),
+            max_queue=int(os.getenv("PDF_MAX_QUEUE", "32")),
+            queue_timeout=float(os.getenv("PDF_QUEUE_TIMEOUT", "30")),
+            directory=os.getenv("PDF_TMP_DIR") or None,
+        )
+
+    def _get_executor(self):
+        if self._executor is None and self.workers > 0:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=get_styles, mp_context=_pool_context()
+            )
+        return self._executor
+
+    def _drop_executor(self, executor, error):
+        """Сломанный пул (процесс завершился аварийно) закрывается, следующий вызов создаст новый"""
+        logger.error(f"Пул рендеринга PDF сломан, будет пересоздан: {error}")
+        if self._executor is executor:
+            self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def warm_up(self):
+        """Запускает процессы пула заранее, чтобы первый документ не ждал регистрации шрифтов"""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        if executor is None:
+            await asyncio.to_thread(get_styles)
+            return
+        try:
+            await asyncio.gather(*[
+                loop.run_in_executor(executor, _warm_up) for _ in range(self.workers)
+            ])
+        except BrokenProcessPool as e:
+            self._drop_executor(executor, e)
+            return
+        logger.info(f"Пул рендеринга PDF запущен: {self.workers} процесса(ов)")
+
+    async def render_pdf(self, document_text, doc_type):
+        """
+        Асинхронно собирает PDF, не блокируя цикл событий. Возвращает путь
+        к временному файлу (после отправки его нужно удалить через discard_pdf) или None.
+        """
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            logger.error("Очередь рендеринга PDF переполнена")
+            return None
+
+        try:
+            executor = self._get_executor()
+            if executor is None:
+                return await asyncio.to_thread(render_pdf_file, document_text, doc_type, self.directory)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, render_pdf_file, document_text, doc_type, self.directory)
+        except BrokenProcessPool as e:
+            self._drop_executor(executor, e)
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка при создании PDF: {e}")
+            return None
+        finally:
+            self._slots.release()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
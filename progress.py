@@ -0,0 +1,78 @@
+import time
+import asyncio
+import logging
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Ограничение Telegram на длину текста сообщения
+MESSAGE_LIMIT = 4096
+
+
+class ProgressMessage:
+    """
+    Одно сообщение-заглушка, которое редактируется по мере генерации текста.
+
+    Правки отправляются не чаще одного раза в min_interval секунд, чтобы не
+    упираться в лимиты Telegram. При TelegramRetryAfter промежуточные правки
+    пропускаются до истечения паузы, а финальная дожидается ее.
+    """
+
+    def __init__(self, message, min_interval=1.0, limit=MESSAGE_LIMIT):
+        self.message = message
+        self.min_interval = min_interval
+        self.limit = limit
+        self._last_text = None
+        self._next_edit_at = 0.0
+
+    @classmethod
+    async def send(cls, target, text, **kwargs):
+        """Отправляет заглушку в ответ на сообщение пользователя"""
+        message = await target.answer(text)
+        progress = cls(message, **kwargs)
+        # Первый фрагмент текста показываем сразу, дальше — с паузами
+        progress._last_text = text
+        return progress
+
+    def _fit(self, text):
+        """Обрезает текст под лимит Telegram, показывая его конец"""
+        if len(text) <= self.limit:
+            return text
+        return "…" + text[-(self.limit - 1):]
+
+    async def update(self, text):
+        """Промежуточное обновление: пропускается, если еще рано"""
+        if time.monotonic() < self._next_edit_at:
+            return False
+        return await self._edit(text)
+
+    async def finish(self, text):
+        """Финальное обновление: дожидается окончания паузы и отправляется всегда"""
+        delay = self._next_edit_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if not await self._edit(text):
+            # Сработал лимит Telegram, повторяем после паузы
+            delay = self._next_edit_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            return await self._edit(text)
+        return True
+
+    async def _edit(self, text):
+        text = self._fit(text)
+        if not text.strip() or text == self._last_text:
+            return True
+        try:
+            await self.message.edit_text(text)
+        except TelegramRetryAfter as e:
+            logger.warning(f"Telegram просит подождать {e.retry_after} с перед правкой сообщения")
+            self._next_edit_at = time.monotonic() + e.retry_after
+            return False
+        except TelegramBadRequest as e:
+            # Например, "message is not modified" — не критично
+            logger.warning(f"Не удалось обновить сообщение: {e}")
+        self._last_text = text
+        self._next_edit_at = time.monotonic() + self.min_interval
+        return True
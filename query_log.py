@@ -0,0 +1,321 @@
+"""
+Журнал вопросов пользователей для пополнения базы знаний.
+
+handle_question только кладет запись в очередь в памяти (record не ждет
+диска), а фоновая задача пишет накопившиеся записи пачками в JSONL или
+SQLite в отдельном потоке. Файл журнала ротируется по размеру: path,
+path.1, ... path.N. Если очередь переполнена, записи отбрасываются.
+Несколько процессов webhook-сервера пишут каждый в свой файл
+(см. process_log_path), при разборе файлы объединяются.
+
+Запуск как скрипта группирует вопросы, на которые не нашлось ответа, и
+предлагает, к какой записи базы добавить их как синонимы:
+
+    python query_log.py data/query_log.jsonl data/qa_base.json
+"""
+import os
+import re
+import sys
+import glob
+import json
+import time
+import heapq
+import sqlite3
+import asyncio
+import logging
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("ts", "text", "country", "source", "entry_id", "score", "match_ms", "cached")
+
+
+def process_log_path(path, pid):
+    """Журнал отдельного процесса: data/query_log.jsonl -> data/query_log-<pid>.jsonl"""
+    root, ext = os.path.splitext(path)
+    return f"{root}-{pid}{ext}"
+
+
+class QueryLogWriter:
+    """
+    Общая часть: ротация файла журнала по размеру.
+    per_process=True — каждый процесс пишет в свой файл (process_log_path),
+    путь определяется при записи, то есть уже после fork.
+    """
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, backups=5, per_process=False):
+        self.base_path = path
+        self.per_process = per_process
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    @property
+    def path(self):
+        if self.per_process:
+            return process_log_path(self.base_path, os.getpid())
+        return self.base_path
+
+    def _should_rotate(self):
+        try:
+            return self.max_bytes > 0 and os.path.getsize(self.path) >= self.max_bytes
+        except OSError:
+            return False
+
+    def _rotate(self):
+        for number in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{number}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{number + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def write(self, records):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JSONLQueryLogWriter(QueryLogWriter):
+    """Журнал в JSONL: по записи на строку"""
+
+    def write(self, records):
+        if self._should_rotate():
+            self._rotate()
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+
+class SQLiteQueryLogWriter(QueryLogWriter):
+    """Журнал в SQLite: таблица queries, удобно разбирать запросами"""
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, backups=5, per_process=False):
+        super().__init__(path, max_bytes, backups, per_process)
+        self._conn = None
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS queries ("
+            "ts REAL NOT NULL, text TEXT NOT NULL, country TEXT, source TEXT, "
+            "entry_id TEXT, score REAL, match_ms REAL, cached INTEGER)"
+        )
+        self._conn.commit()
+
+    def write(self, records):
+        if self._conn is not None and self._should_rotate():
+            self._conn.close()
+            self._conn = None
+            self._rotate()
+        if self._conn is None:
+            self._connect()
+        self._conn.executemany(
+            f"INSERT INTO queries ({', '.join(FIELDS)}) VALUES ({', '.join('?' * len(FIELDS))})",
+            [tuple(record.get(field) for field in FIELDS) for record in records]
+        )
+        self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class QueryLog:
+    """
+    Очередь записей журнала и фоновая задача, которая сбрасывает ее на диск
+    пачками до batch_size записей не реже раза в flush_interval секунд.
+    """
+
+    def __init__(self, writer, batch_size=200, flush_interval=1.0, max_queue=10000):
+        self.writer = writer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = asyncio.Queue(max_queue)
+        self._task = None
+        self.written = 0
+        self.dropped = 0
+
+    def record(self, text, country=None, source=None, entry_id=None, score=0.0, match_ms=0.0, cached=False):
+        """Добавляет запись в очередь; не блокирует и не бросает исключений"""
+        record = {
+            "ts": round(time.time(), 3),
+            "text": text,
+            "country": country,
+            "source": source,
+            "entry_id": None if entry_id is None else str(entry_id),
+            "score": round(score, 4),
+            "match_ms": round(match_ms, 3),
+            "cached": cached,
+        }
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _next_batch(self):
+        """Пачка записей и признак того, что журнал закрывается"""
+        record = await self._queue.get()
+        if record is None:
+            return [], True
+        batch = [record]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                record = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if record is None:
+                return batch, True
+            batch.append(record)
+        return batch, False
+
+    async def _flush(self, batch):
+        try:
+            await asyncio.to_thread(self.writer.write, batch)
+            self.written += len(batch)
+        except Exception as e:
+            self.dropped += len(batch)
+            logger.error(f"Не удалось записать журнал запросов: {e}")
+
+    async def _run(self):
+        closing = False
+        while not closing:
+            batch, closing = await self._next_batch()
+            if batch:
+                await self._flush(batch)
+
+    async def close(self):
+        """Дописывает то, что осталось в очереди, и останавливает фоновую задачу"""
+        if self._task is not None:
+            # Метка конца очереди: задача сбросит последнюю пачку и завершится
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+        self.writer.close()
+
+    def stats(self):
+        return {"queue": self._queue.qsize(), "written": self.written, "dropped": self.dropped}
+
+
+def create_query_log_from_env(per_process=False):
+    """
+    Создает журнал запросов по переменным окружения:
+    QUERY_LOG=jsonl|sqlite|off, QUERY_LOG_PATH, QUERY_LOG_MAX_MB, QUERY_LOG_BACKUPS.
+    per_process=True — бот работает в нескольких процессах, у каждого свой файл.
+    """
+    backend = os.getenv("QUERY_LOG", "off").lower()
+    if backend == "off":
+        return None
+    max_bytes = int(float(os.getenv("QUERY_LOG_MAX_MB", "50")) * 1024 * 1024)
+    backups = int(os.getenv("QUERY_LOG_BACKUPS", "5"))
+    if backend == "sqlite":
+        path = os.getenv("QUERY_LOG_PATH", "data/query_log.sqlite3")
+        writer = SQLiteQueryLogWriter(path, max_bytes, backups, per_process)
+    else:
+        path = os.getenv("QUERY_LOG_PATH", "data/query_log.jsonl")
+        writer = JSONLQueryLogWriter(path, max_bytes, backups, per_process)
+    logger.info(f"Журнал запросов: {process_log_path(path, '<pid>') if per_process else path}")
+    return QueryLog(writer)
+
+
+def _read_log(path):
+    """Записи одного журнала вместе с его ротированными файлами, от старых к новым"""
+    paths = [path]
+    number = 1
+    while os.path.exists(f"{path}.{number}"):
+        paths.insert(0, f"{path}.{number}")
+        number += 1
+
+    for current in paths:
+        if not os.path.exists(current):
+            continue
+        with open(current, "rb") as f:
+            is_sqlite = f.read(16) == b"SQLite format 3\x00"
+        if not is_sqlite:
+            with open(current, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+        else:
+            conn = sqlite3.connect(current)
+            try:
+                for row in conn.execute(f"SELECT {', '.join(FIELDS)} FROM queries ORDER BY ts"):
+                    yield dict(zip(FIELDS, row))
+            finally:
+                conn.close()
+
+
+def read_records(path):
+    """
+    Записи журнала path и журналов отдельных процессов (process_log_path)
+    вместе с ротированными файлами, от старых к новым
+    """
+    root, ext = os.path.splitext(path)
+    pattern = re.compile(re.escape(root) + r"-\d+" + re.escape(ext))
+    paths = [path] + sorted(
+        candidate for candidate in glob.glob(f"{glob.escape(root)}-*{glob.escape(ext)}")
+        if pattern.fullmatch(candidate)
+    )
+    return heapq.merge(*[_read_log(current) for current in paths], key=lambda record: record["ts"])
+
+
+def cluster_misses(records, similarity=0.5):
+    """
+    Группирует вопросы без ответа: сначала самые частые формулировки, каждая
+    следующая присоединяется к группе, с представителем которой у нее доля
+    общих признаков (слова и триграммы) не меньше similarity.
+    Возвращает [(представитель, число вопросов, формулировки)] по убыванию частоты.
+    """
+    from search import preprocess_text, extract_features
+
+    counts = Counter(
+        preprocess_text(record["text"]) for record in records if record["source"] is None
+    )
+    clusters = []
+    for query, count in counts.most_common():
+        if not query:
+            continue
+        features = extract_features(query)
+        for cluster in clusters:
+            common = len(features & cluster["features"])
+            if common / len(features | cluster["features"]) >= similarity:
+                cluster["count"] += count
+                cluster["queries"].append(query)
+                break
+        else:
+            clusters.append({"features": features, "count": count, "queries": [query]})
+
+    clusters.sort(key=lambda cluster: -cluster["count"])
+    return [(cluster["queries"][0], cluster["count"], cluster["queries"]) for cluster in clusters]
+
+
+if __name__ == "__main__":
+    from search import QAIndex
+
+    source = sys.argv[1] if len(sys.argv) > 1 else "data/query_log.jsonl"
+    kb_path = sys.argv[2] if len(sys.argv) > 2 else "data/qa_base.json"
+    with open(kb_path, "r", encoding="utf-8") as f:
+        index = QAIndex(json.load(f))
+
+    clusters = cluster_misses(read_records(source))
+    print(f"{source}: групп вопросов без ответа: {len(clusters)}")
+    for representative, count, queries in clusters:
+        # Ближайшая запись базы — кандидат, к которому добавить синонимы
+        item, score = index.best_match(representative, threshold=0.0)
+        print(f"\n[{count}] {representative}")
+        if item is not None:
+            print(f"  ближайшая запись {item.get('id')} ({score:.2f}): {item['question']}")
+        for query in queries[1:10]:
+            print(f"  - {query}")
+        if len(queries) > 10:
+            print(f"  ... еще {len(queries) - 10}")
@@ -0,0 +1,264 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+
+from doc_cache import make_cache_key
+from yalm import YaLMError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ведро токенов: rate запросов в секунду, всплеск до capacity запросов"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Через сколько секунд освободится токен (0 — можно сейчас)"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        """API сообщил о превышении лимита: не отправляем запросы seconds секунд"""
+        self.tokens = 0.0
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class _Flight:
+    """
+    Один запрос к API, результат которого получают все, кто ждет такой же промпт.
+    version растет при каждом изменении: новый текст, сдвиг в очереди, завершение.
+    """
+
+    def __init__(self, key, messages, stream):
+        self.key = key
+        self.messages = messages
+        self.stream = stream
+        self.text = None
+        self.position = 0
+        self.done = False
+        self.error = None
+        self.version = 0
+        self.changed = asyncio.Condition()
+        self.task = None
+
+    async def _notify(self):
+        self.version += 1
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def set_position(self, position):
+        if position != self.position:
+            self.position = position
+            await self._notify()
+
+    async def publish(self, text):
+        self.text = text
+        await self._notify()
+
+    async def finish(self, error=None):
+        self.error = error
+        self.done = True
+        await self._notify()
+
+
+class GenerationScheduler:
+    """
+    Планировщик запросов к YaLM API.
+
+    - Одинаковые промпты, которые уже генерируются, не отправляются повторно:
+      все ожидающие получают результат одного запроса (single-flight).
+    - Запросы уходят в порядке очереди не чаще rate в секунду (ведро токенов
+      с всплеском burst), чтобы не упираться в квоту.
+    - Временные ошибки (429, 5xx, таймауты) повторяются с экспоненциальной
+      паузой со случайным разбросом; 429 приостанавливает всю очередь на
+      Retry-After. Потоковый запрос повторяется, только пока пользователь
+      не получил ни одной части текста.
+    - Ожидающим сообщается их место в очереди через on_position.
+    """
+
+    def __init__(self, client, rate=10.0, burst=None, max_retries=3, backoff=1.0, backoff_max=30.0):
+        self.client = client
+        self.bucket = TokenBucket(rate, burst if burst is not None else max(1, round(rate)))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._flights = {}
+        self._queue = deque()
+        self._pump = None
+        self.coalesced = 0
+        self.retries = 0
+
+    @classmethod
+    def from_env(cls, client):
+        """Лимит по умолчанию — 10 запросов в секунду (YALM_RPS=0 — без лимита)"""
+        burst = os.getenv("YALM_BURST")
+        return cls(
+            client,
+            rate=float(os.getenv("YALM_RPS", "10")),
+            burst=int(burst) if burst else None,
+            max_retries=int(os.getenv("YALM_MAX_RETRIES", "3")),
+            backoff=float(os.getenv("YALM_BACKOFF", "1")),
+            backoff_max=float(os.getenv("YALM_BACKOFF_MAX", "30")),
+        )
+
+    @property
+    def configured(self):
+        return self.client.configured
+
+    def build_payload(self, messages):
+        return self.client.build_payload(messages)
+
+    def queue_length(self):
+        return len(self._queue)
+
+    async def complete(self, messages, on_position=None):
+        """Текст ответа модели; on_position(n) вызывается при сдвиге места в очереди"""
+        text = None
+        async for text in self._follow(self._join(messages, stream=False), on_position):
+            pass
+        return text
+
+    async def stream(self, messages, on_position=None):
+        """Потоковая генерация: отдает накопленный текст по мере поступления"""
+        async for text in self._follow(self._join(messages, stream=True), on_position):
+            yield text
+
+    def _join(self, messages, stream):
+        key = make_cache_key(self.client.build_payload(messages))
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            logger.info(f"Запрос к YaLM API уже выполняется, ждем его результат (в очереди: {len(self._queue)})")
+            return flight
+        flight = _Flight(key, messages, stream)
+        self._flights[key] = flight
+        flight.task = asyncio.create_task(self._execute(flight))
+        return flight
+
+    async def _follow(self, flight, on_position):
+        seen_version = 0
+        seen_text = None
+        seen_position = 0
+        while True:
+            async with flight.changed:
+                await flight.changed.wait_for(lambda: flight.version != seen_version)
+            seen_version = flight.version
+            if flight.position != seen_position:
+                seen_position = flight.position
+                if on_position is not None and seen_position:
+                    await on_position(seen_position)
+            if flight.text is not None and flight.text != seen_text:
+                seen_text = flight.text
+                yield seen_text
+            if flight.done:
+                if flight.error is not None:
+                    raise flight.error
+                return
+
+    async def _execute(self, flight):
+        error = None
+        try:
+            for attempt in range(self.max_retries + 1):
+                await self._acquire(flight)
+                try:
+                    if flight.stream:
+                        async for text in self.client.stream(flight.messages):
+                            await flight.publish(text)
+                    else:
+                        await flight.publish(await self.client.complete(flight.messages))
+                    return
+                except YaLMError as e:
+                    if not e.retryable or attempt == self.max_retries or flight.text is not None:
+                        raise
+                    delay = self._backoff(attempt, e.retry_after)
+                    self.retries += 1
+                    logger.warning(f"YaLM API: {e}. Повтор через {delay:.1f} с "
+                                   f"(попытка {attempt + 2} из {self.max_retries + 1})")
+                    await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            error = YaLMError("Запрос к YaLM API отменен")
+            raise
+        except Exception as e:
+            error = e
+        finally:
+            self._flights.pop(flight.key, None)
+            await flight.finish(error)
+
+    def _backoff(self, attempt, retry_after):
+        # Полный разброс: одновременно упавшие запросы не повторяются все разом
+        delay = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+        if retry_after:
+            self.bucket.pause(retry_after)
+            delay = max(delay, retry_after)
+        return delay
+
+    async def _acquire(self, flight):
+        """Ждет своей очереди и свободного токена"""
+        if not self._queue and self.bucket.delay() == 0:
+            self.bucket.take()
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._queue.append((waiter, flight))
+        await flight.set_position(len(self._queue))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run_pump())
+        try:
+            await waiter
+        finally:
+            await flight.set_position(0)
+
+    async def _run_pump(self):
+        while self._queue:
+            delay = self.bucket.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            waiter, _ = self._queue.popleft()
+            if waiter.done():
+                continue
+            self.bucket.take()
+            waiter.set_result(None)
+            for position, (_, flight) in enumerate(self._queue, 1):
+                await flight.set_position(position)
+
+    def stats(self):
+        return {
+            "queue": len(self._queue),
+            "in_flight": len(self._flights),
+            "coalesced": self.coalesced,
+            "retries": self.retries,
+        }
+
+    async def close(self):
+        """Отменяет незавершенные запросы и закрывает клиент"""
+        tasks = [flight.task for flight in self._flights.values() if flight.task is not None]
+        if self._pump is not None:
+            tasks.append(self._pump)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.client.close()
@@ -0,0 +1,342 @@
+import re
+import math
+import heapq
+from bisect import bisect_left
+from operator import itemgetter
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+
+# Порог схожести, ниже которого совпадение не засчитывается
+SIMILARITY_THRESHOLD = 0.4
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def preprocess_text(text):
+    """Предобработка текста для сравнения"""
+    return text.lower().strip().replace("?", "").replace(".", "").replace("!", "")
+
+
+def calculate_similarity(a, b):
+    """Вычисляет степень схожести двух строк"""
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def extract_features(text, n=3):
+    """Возвращает множество признаков строки: слова и символьные n-граммы"""
+    features = {"w:" + token for token in TOKEN_RE.findall(text)}
+    padded = f" {text} "
+    features.update(padded[i:i + n] for i in range(len(padded) - n + 1))
+    return features
+
+
+def entry_key(item, position):
+    """Ключ записи базы: id, а если его нет — позиция в базе"""
+    return item.get("id", f"#{position}")
+
+
+def entry_signature(item):
+    """Все, что влияет на поиск по записи"""
+    return item["question"], tuple(item.get("synonyms", []))
+
+
+def required_overlap(query, ratio):
+    """
+    Сколько признаков (extract_features) фраза должна разделять с запросом,
+    чтобы ratio SequenceMatcher между ними был не меньше ratio.
+
+    Совпавшие блоки SequenceMatcher — общие подстроки суммарной длины M, а
+    между соседними блоками есть несовпавший символ, поэтому блоков не больше
+    lq + lp - 2M + 1. Блок длины L содержит L - 2 триграммы запроса, различных
+    среди них не меньше, чем за вычетом повторов триграмм в самом запросе.
+    Значит, общих признаков не меньше 5M - 2(lq + lp) - 2 - повторы, где
+    2M >= ratio * (lq + lp) и фраза не короче lq * ratio / (2 - ratio).
+    Оценка больше нуля только при ratio выше ~0.85.
+    """
+    padded = f" {query} "
+    trigrams = len(padded) - 2
+    repeats = trigrams - len({padded[i:i + 3] for i in range(trigrams)})
+    shortest = len(query) * ratio / (2 - ratio)
+    bound = (2.5 * ratio - 2) * (len(query) + shortest) - 2 - repeats
+    # Запас на погрешность вычислений с плавающей точкой
+    return math.ceil(bound - 1e-9)
+
+
+def partition_key(item):
+    """
+    Страны и категория записи. Индексы кладут фразы записей с одинаковым
+    ключом подряд, поэтому раздел базы (partitions.py) — несколько диапазонов id фраз.
+    """
+    return tuple(item.get("country", [])), item.get("category", "")
+
+
+def compile_entry(item):
+    """Нормализует вопрос и синонимы записи и извлекает их признаки"""
+    phrases = []
+    for text in [item["question"], *item.get("synonyms", [])]:
+        processed = preprocess_text(text)
+        phrases.append((processed, frozenset(extract_features(processed))))
+    return phrases
+
+
+class BaseQAIndex:
+    """
+    Общая логика поиска. Наследник задает:
+    entries — записи базы, phrases — (индекс записи, нормализованный текст,
+    число признаков) по id фразы, phrase_entries и phrase_sizes — индекс записи
+    и число признаков по id фразы, postings — признак -> отсортированные id
+    фраз, top_k и exact_limit (см. best_match).
+    """
+
+    # Диапазоны id фраз [начало, конец), по которым идет поиск, или None — все фразы
+    phrase_ranges = None
+
+    # Сколько id фраз из списков признаков просматривать на запрос: признаки
+    # берутся от редких к частым, самые частые сверх этого объема пропускаются
+    posting_limit = 20000
+
+    # Запасной поиск по ключевым словам (keyword_router.KeywordRouter), если задан
+    keyword_router = None
+
+    # Семантический индекс (semantic.SemanticIndex), если включен
+    semantic = None
+    # Искать только по смыслу, без нечеткого сравнения строк
+    semantic_only = False
+    # Разделы по странам и категориям (partitions.PartitionedSearch), если включены
+    partitions = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def searched_ranges(self):
+        """Диапазоны id фраз, по которым идет поиск"""
+        return self.phrase_ranges or [(0, len(self.phrase_entries))]
+
+    def posting_spans(self, feature):
+        """
+        Список id фраз с признаком и участки (начало, конец) этого списка,
+        попадающие в phrase_ranges. Список отсортирован, участки ищутся бисекцией.
+        """
+        ids = self.postings.get(feature, ())
+        if self.phrase_ranges is None:
+            return ids, [(0, len(ids))]
+        spans = []
+        low = 0
+        for start, end in self.phrase_ranges:
+            low = bisect_left(ids, start, low)
+            high = bisect_left(ids, end, low)
+            if low < high:
+                spans.append((low, high))
+            low = high
+        return ids, spans
+
+    def overlap(self, features):
+        """
+        Число общих признаков с запросом у фраз, считая от самых редких
+        признаков, пока не просмотрено posting_limit id фраз. Возвращает
+        (id фразы -> число, сколько самых частых признаков пропущено).
+        """
+        lists = []
+        for feature in features:
+            ids, spans = self.posting_spans(feature)
+            lists.append((sum(high - low for low, high in spans), ids, spans))
+        lists.sort(key=itemgetter(0))
+
+        overlap = Counter()
+        volume = 0
+        for position, (count, ids, spans) in enumerate(lists):
+            volume += count
+            if volume > self.posting_limit:
+                return overlap, len(lists) - position
+            for low, high in spans:
+                overlap.update(ids[low:high])
+        return overlap, 0
+
+    def candidates(self, overlap, query_size):
+        """top_k фраз с наибольшим перекрытием признаков (при top_k=0 — все)"""
+        # Коэффициент Дайса по признакам — дешевая оценка схожести строк;
+        # nsmallest выбирает те же top_k, что и полная сортировка, без сортировки всех фраз
+        sizes = self.phrase_sizes
+
+        def dice(pair):
+            return -2 * pair[1] / (query_size + sizes[pair[0]]), pair[0]
+
+        if self.top_k > 0:
+            scored = heapq.nsmallest(self.top_k, overlap.items(), key=dice)
+        else:
+            scored = sorted(overlap.items(), key=dice)
+        return [phrase_id for phrase_id, _ in scored]
+
+    def best_match(self, query, threshold=SIMILARITY_THRESHOLD):
+        """
+        Ищет наиболее похожую запись для уже нормализованного запроса.
+        Возвращает (запись, схожесть) или (None, 0.0).
+
+        Сначала точно сравниваются top_k кандидатов по общим признакам. Затем
+        ответ проверяется: фразы, которые по required_overlap не могут его
+        превзойти, отсекаются, остальные досматриваются, а если оценка ничего
+        не отсекает (схожесть ниже ~0.85) — досматриваются все фразы. Пока
+        досмотреть нужно не больше exact_limit фраз (exact_limit=0 — без
+        ограничения), ответ совпадает с полным перебором calculate_similarity
+        по всем фразам; на базе из поставки это так для любого запроса.
+        """
+        best_entry_index = None
+        best_ratio = threshold
+        compared = set()
+
+        def can_win(bound, entry_index):
+            # При равной схожести выигрывает запись, которая раньше в базе
+            return bound > best_ratio or (
+                bound == best_ratio and best_entry_index is not None and entry_index < best_entry_index
+            )
+
+        # Верхние оценки ratio симметричны, поэтому запрос — seq2: его подсчет
+        # символов для quick_ratio строится один раз на все кандидаты
+        bounds = SequenceMatcher(None, "", query, autojunk=False)
+
+        def compare(phrase_id):
+            """Сравнивает запрос с фразой, True — если она стала лучшей"""
+            nonlocal best_entry_index, best_ratio
+            compared.add(phrase_id)
+            entry_index, processed, _ = self.phrases[phrase_id]
+            # Дешевый отсев: по длинам строк, затем по общим символам
+            bounds.set_seq1(processed)
+            if not can_win(bounds.real_quick_ratio(), entry_index):
+                return False
+            if not can_win(bounds.quick_ratio(), entry_index):
+                return False
+            # Точная оценка — только для оставшихся, с тем же порядком аргументов
+            ratio = calculate_similarity(query, processed)
+            if not can_win(ratio, entry_index):
+                return False
+            best_ratio = ratio
+            best_entry_index = entry_index
+            return True
+
+        features = extract_features(query)
+        overlap, skipped = self.overlap(features)
+        for phrase_id in self.candidates(overlap, len(features)):
+            compare(phrase_id)
+
+        required = required_overlap(query, best_ratio)
+        if required > skipped:
+            # У фразы не из overlap общих признаков не больше skipped, она не
+            # может выиграть; из остальных досматриваем те, что могут
+            pending = [
+                phrase_id for phrase_id, count in overlap.items()
+                if count + skipped >= required and phrase_id not in compared
+            ]
+            pending.sort(key=overlap.__getitem__, reverse=True)
+            if self.exact_limit:
+                pending = pending[:self.exact_limit]
+            for phrase_id in pending:
+                if overlap[phrase_id] + skipped >= required and compare(phrase_id):
+                    required = required_overlap(query, best_ratio)
+        else:
+            ranges = self.searched_ranges()
+            remaining = sum(end - start for start, end in ranges) - len(compared)
+            if not self.exact_limit or remaining <= self.exact_limit:
+                for start, end in ranges:
+                    for phrase_id in range(start, end):
+                        if phrase_id not in compared:
+                            compare(phrase_id)
+
+        if best_entry_index is None:
+            return None, 0.0
+        return self.entries[best_entry_index], best_ratio
+
+    def questions(self):
+        """Нормализованные основные вопросы (первая фраза каждой записи) в порядке записей базы"""
+        first = {}
+        for start, end in self.searched_ranges():
+            previous = None
+            for phrase_id in range(start, end):
+                entry_index = self.phrase_entries[phrase_id]
+                if entry_index != previous:
+                    previous = entry_index
+                    first[entry_index] = phrase_id
+        return [(entry_index, self.phrases[first[entry_index]][1]) for entry_index in sorted(first)]
+
+    def keyword_match(self, query):
+        """Запасной поиск по ключевым словам"""
+        if self.keyword_router is None:
+            return None
+        return self.keyword_router.match(query)
+
+    def lookup(self, query, threshold=SIMILARITY_THRESHOLD):
+        """
+        Поиск ответа: по схожести строк, по смыслу, затем по ключевым словам.
+        Возвращает (запись, способ, оценка), способ — fuzzy, semantic,
+        keyword или None, если ничего не найдено.
+        """
+        if not self.semantic_only:
+            item, score = self.best_match(query, threshold)
+            if item is not None:
+                return item, "fuzzy", score
+        if self.semantic is not None:
+            item, score = self.semantic.best_match(query)
+            if item is not None:
+                return item, "semantic", score
+        item = self.keyword_match(query)
+        if item is not None:
+            return item, "keyword", 0.0
+        return None, None, 0.0
+
+    def search(self, query, threshold=SIMILARITY_THRESHOLD):
+        """Поиск ответа, возвращает запись или None"""
+        return self.lookup(query, threshold)[0]
+
+
+class QAIndex(BaseQAIndex):
+    """
+    Индекс базы знаний, который строится один раз при загрузке.
+
+    Все вопросы и синонимы нормализуются заранее и попадают в инвертированный
+    индекс по словам и символьным триграммам. При поиске кандидаты отбираются
+    по числу общих признаков, точная оценка SequenceMatcher считается для
+    top_k лучших фраз, а затем ответ проверяется на совпадение с полным
+    перебором, досматривая не больше exact_limit фраз (см. best_match).
+    """
+
+    def __init__(self, qa_base, top_k=50, exact_limit=2000, compiled=None):
+        self.entries = list(qa_base)
+        self.top_k = top_k
+        self.exact_limit = exact_limit
+        # Фразы: (индекс записи, нормализованный текст, число признаков)
+        self.phrases = []
+        self.phrase_entries = []
+        self.phrase_sizes = []
+        self.postings = defaultdict(list)
+        # Нормализованные фразы каждой записи: ключ записи -> (подпись, фразы)
+        self.compiled = {}
+        compiled = compiled or {}
+
+        compiled_entries = []
+        for entry_index, item in enumerate(self.entries):
+            key = entry_key(item, entry_index)
+            signature = entry_signature(item)
+            cached = compiled.get(key)
+            if cached is not None and cached[0] == signature:
+                entry_phrases = cached[1]
+            else:
+                entry_phrases = compile_entry(item)
+            self.compiled[key] = (signature, entry_phrases)
+            compiled_entries.append(entry_phrases)
+
+        # Фразы записей одного раздела лежат подряд, порядок записей не меняется
+        layout = sorted(range(len(self.entries)), key=lambda position: partition_key(self.entries[position]))
+        for entry_index in layout:
+            for processed, features in compiled_entries[entry_index]:
+                phrase_id = len(self.phrases)
+                self.phrases.append((entry_index, processed, len(features)))
+                self.phrase_entries.append(entry_index)
+                self.phrase_sizes.append(len(features))
+                for feature in features:
+                    self.postings[feature].append(phrase_id)
+
+    def rebuild(self, qa_base):
+        """
+        Строит новый индекс для обновленной базы. Записи, у которых не
+        изменились вопрос и синонимы, повторно не нормализуются.
+        """
+        return QAIndex(qa_base, top_k=self.top_k, exact_limit=self.exact_limit, compiled=self.compiled)
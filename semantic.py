@@ -0,0 +1,190 @@
+"""
+Семантический поиск по базе знаний.
+
+Вопросы и синонимы переводятся в векторы хэшированного TF-IDF по словам и
+символьным n-граммам внутри слов, поэтому разные формы одного слова
+("уволили", "увольнение") оказываются близки. Все векторы хранятся одной
+матрицей NumPy, и запрос обрабатывается одним умножением матрицы на вектор.
+
+Векторы можно посчитать заранее:
+python semantic.py data/qa_base.json data/qa_base.vectors.npz
+"""
+import sys
+import math
+import zlib
+import hashlib
+from collections import Counter
+
+import numpy as np
+
+from search import TOKEN_RE
+
+# Порог косинусной близости для семантического совпадения
+SEMANTIC_THRESHOLD = 0.45
+
+
+class HashingVectorizer:
+    """Хэшированный TF-IDF: признак попадает в ячейку по crc32, знак — по старшему биту"""
+
+    def __init__(self, dim=512, ngram_range=(3, 5)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.idf = np.ones(dim, dtype=np.float32)
+
+    def features(self, text):
+        features = []
+        min_n, max_n = self.ngram_range
+        for word in TOKEN_RE.findall(text):
+            features.append("w:" + word)
+            padded = f"<{word}>"
+            for n in range(min_n, max_n + 1):
+                features.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+        return features
+
+    def _hashed(self, text):
+        """Ячейка -> суммарный вес признаков (со знаком) для текста"""
+        buckets = Counter()
+        for feature, count in Counter(self.features(text)).items():
+            h = zlib.crc32(feature.encode("utf-8"))
+            sign = 1.0 if h & 0x80000000 else -1.0
+            buckets[h % self.dim] += sign * (1.0 + math.log(count))
+        return buckets
+
+    def fit(self, texts):
+        """Считает idf по ячейкам на корпусе фраз"""
+        df = np.zeros(self.dim, dtype=np.float32)
+        for text in texts:
+            for bucket in self._hashed(text):
+                df[bucket] += 1
+        self.idf = (np.log((1 + len(texts)) / (1 + df)) + 1).astype(np.float32)
+        return self
+
+    def transform_one(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for bucket, weight in self._hashed(text).items():
+            vector[bucket] = weight
+        vector *= self.idf
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
+
+    def transform(self, texts):
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            matrix[row] = self.transform_one(text)
+        return matrix
+
+
+def phrases_digest(phrases):
+    """Хэш фраз индекса вместе с записями, к которым они относятся"""
+    digest = hashlib.sha256()
+    for entry_index, text, _ in phrases:
+        digest.update(f"{entry_index}\t{text}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class SemanticIndex:
+    """
+    Матрица векторов всех фраз индекса (вопросов и синонимов).
+    Ссылается на свой индекс, поэтому ответы берутся из того же снимка базы.
+    """
+
+    def __init__(self, index, vectorizer, matrix, phrase_entries, top_k=10, threshold=SEMANTIC_THRESHOLD,
+                 phrase_mask=None, digest=None):
+        self.index = index
+        self.vectorizer = vectorizer
+        self.matrix = matrix
+        self.phrase_entries = phrase_entries
+        # Хэш фраз, по которым посчитаны векторы (см. phrases_digest)
+        self.digest = digest
+        self.top_k = top_k
+        self.threshold = threshold
+        # Фразы раздела базы (см. restricted) или None — все фразы
+        self.phrase_mask = phrase_mask
+
+    def restricted(self, phrase_ranges):
+        """Поиск только по диапазонам id фраз раздела, с той же матрицей векторов"""
+        phrase_mask = np.zeros(len(self.phrase_entries), dtype=bool)
+        for start, end in phrase_ranges:
+            phrase_mask[start:end] = True
+        return SemanticIndex(
+            self.index, self.vectorizer, self.matrix, self.phrase_entries, self.top_k, self.threshold,
+            phrase_mask=phrase_mask, digest=self.digest
+        )
+
+    @classmethod
+    def build(cls, index, dim=512, **kwargs):
+        """Считает векторы для фраз уже построенного индекса"""
+        phrases = [index.phrases[phrase_id] for phrase_id in range(len(index.phrases))]
+        texts = [text for _, text, _ in phrases]
+        vectorizer = HashingVectorizer(dim).fit(texts)
+        matrix = vectorizer.transform(texts)
+        phrase_entries = np.array([entry_index for entry_index, _, _ in phrases], dtype=np.int32)
+        return cls(index, vectorizer, matrix, phrase_entries, digest=phrases_digest(phrases), **kwargs)
+
+    @classmethod
+    def load(cls, index, path, **kwargs):
+        """
+        Загружает заранее посчитанные векторы; None, если они посчитаны для
+        других фраз (база изменилась) или сохранены без хэша фраз.
+        """
+        data = np.load(path)
+        if "digest" not in data.files:
+            return None
+        digest = str(data["digest"])
+        if len(data["matrix"]) != len(index.phrases):
+            return None
+        if digest != phrases_digest(index.phrases[phrase_id] for phrase_id in range(len(index.phrases))):
+            return None
+        matrix, phrase_entries, idf = data["matrix"], data["phrase_entries"], data["idf"]
+        vectorizer = HashingVectorizer(dim=matrix.shape[1])
+        vectorizer.idf = idf
+        return cls(index, vectorizer, matrix, phrase_entries, digest=digest, **kwargs)
+
+    def save(self, path):
+        np.savez(
+            path, matrix=self.matrix, phrase_entries=self.phrase_entries, idf=self.vectorizer.idf,
+            digest=np.array(self.digest)
+        )
+
+    def best_match(self, query):
+        """
+        Ищет самую близкую по смыслу запись для нормализованного запроса.
+        Возвращает (запись, близость) или (None, 0.0).
+        """
+        if not len(self.matrix):
+            return None, 0.0
+        scores = self.matrix @ self.vectorizer.transform_one(query)
+        if self.phrase_mask is not None:
+            scores = np.where(self.phrase_mask, scores, -np.inf)
+        k = min(self.top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+
+        best_entry_index = None
+        best_score = self.threshold
+        for phrase_id in top:
+            score = float(scores[phrase_id])
+            entry_index = int(self.phrase_entries[phrase_id])
+            # При равной близости выигрывает запись, которая раньше в базе
+            if score > best_score or (
+                score == best_score and best_entry_index is not None and entry_index < best_entry_index
+            ):
+                best_score = score
+                best_entry_index = entry_index
+
+        if best_entry_index is None:
+            return None, 0.0
+        return self.index.entries[best_entry_index], best_score
+
+
+if __name__ == "__main__":
+    import json
+    from search import QAIndex
+
+    source = sys.argv[1] if len(sys.argv) > 1 else "data/qa_base.json"
+    target = sys.argv[2] if len(sys.argv) > 2 else "data/qa_base.vectors.npz"
+    with open(source, "r", encoding="utf-8") as f:
+        semantic = SemanticIndex.build(QAIndex(json.load(f)))
+    semantic.save(target)
+    print(f"{target}: {semantic.matrix.shape[0]} фраз, размерность {semantic.matrix.shape[1]}")
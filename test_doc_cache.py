@@ -0,0 +1,90 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import doc_cache
+from doc_cache import SQLiteDocumentCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Часы кэша, которые двигает сам тест"""
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(doc_cache, "time", SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture
+def make_cache(tmp_path):
+    caches = []
+
+    def make(**kwargs):
+        cache = SQLiteDocumentCache(str(tmp_path / "doc_cache.sqlite3"), **kwargs)
+        caches.append(cache)
+        return cache
+
+    yield make
+    for cache in caches:
+        cache.close()
+
+
+def test_put_and_get(make_cache, clock):
+    cache = make_cache()
+    assert cache.get("a") is None
+    cache.put("a", "текст")
+    cache.set_pdf("a", b"%PDF-", "01.01.2025")
+    assert cache.get("a") == ("текст", b"%PDF-", "01.01.2025")
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.hit_ratio == 0.5
+
+
+def test_expired_entry_is_a_miss_and_is_deleted(make_cache, clock):
+    cache = make_cache(ttl=60)
+    cache.put("a", "текст")
+    clock.now += 59
+    assert cache.get("a") is not None
+    clock.now += 2
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_put_evicts_expired_entries(make_cache, clock):
+    cache = make_cache(ttl=60)
+    cache.put("a", "текст")
+    clock.now += 61
+    cache.put("b", "текст")
+    assert len(cache) == 1
+    assert cache.get("b") is not None
+
+
+def test_put_evicts_least_recently_used(make_cache, clock):
+    cache = make_cache(max_entries=2)
+    cache.put("a", "первый")
+    clock.now += 1
+    cache.put("b", "второй")
+    clock.now += 1
+    # Чтение обновляет время использования: вытеснен будет b, а не a
+    assert cache.get("a") is not None
+    clock.now += 1
+    cache.put("c", "третий")
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+
+def test_entries_survive_reopening(make_cache, clock):
+    make_cache().put("a", "текст")
+    assert make_cache().get("a").text == "текст"
+
+
+def test_async_methods(make_cache, clock):
+    cache = make_cache()
+
+    async def run():
+        await cache.aput("a", "текст")
+        await cache.aset_pdf("a", b"%PDF-", "01.01.2025")
+        return await cache.aget("a")
+
+    assert asyncio.run(run()).pdf == b"%PDF-"
@@ -0,0 +1,154 @@
+import asyncio
+import sqlite3
+
+import pytest
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from fsm_storage import SQLiteStorage, StateSession
+
+KEY = StorageKey(bot_id=1, chat_id=2, user_id=3)
+
+
+class CountingSQLiteStorage(SQLiteStorage):
+    """SQLiteStorage, который считает запросы к файлу"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.reads = 0
+        self.writes = 0
+
+    async def get_record(self, key):
+        self.reads += 1
+        return await super().get_record(key)
+
+    async def _write(self, sql, params):
+        self.writes += 1
+        return await super()._write(sql, params)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "fsm.sqlite3")
+
+
+def run_with(storages, scenario):
+    async def run():
+        try:
+            return await scenario(*storages)
+        finally:
+            for storage in storages:
+                await storage.close()
+
+    return asyncio.run(run())
+
+
+def test_session_reads_once_and_writes_once(db_path):
+    async def scenario(storage):
+        context = FSMContext(storage, KEY)
+        async with StateSession(context) as session:
+            session.update(document_type="Иск", current_field_index=0)
+            session.update({"ФИО": "Иванов"})
+            session.set_state("DocumentForm:entering_lawsuit_info")
+        return storage.reads, storage.writes, await storage.get_record(KEY)
+
+    reads, writes, record = run_with([CountingSQLiteStorage(db_path)], scenario)
+    assert (reads, writes) == (1, 1)
+    state, data, version = record
+    assert state == "DocumentForm:entering_lawsuit_info"
+    assert data == {"document_type": "Иск", "current_field_index": 0, "ФИО": "Иванов"}
+    assert version == 1
+
+
+def test_session_without_changes_does_not_write(db_path):
+    async def scenario(storage):
+        async with StateSession(FSMContext(storage, KEY)) as session:
+            assert session.data == {}
+        return storage.writes
+
+    assert run_with([CountingSQLiteStorage(db_path)], scenario) == 0
+
+
+def test_session_with_memory_storage():
+    async def scenario(storage):
+        context = FSMContext(storage, KEY)
+        async with StateSession(context) as session:
+            session.update(current_field_index=1)
+            session.set_state("DocumentForm:confirming_document")
+        async with StateSession(context) as session:
+            session.update(current_field_index=session.data["current_field_index"] + 1)
+        return await context.get_state(), await context.get_data()
+
+    state, data = asyncio.run(scenario(MemoryStorage()))
+    assert state == "DocumentForm:confirming_document"
+    assert data == {"current_field_index": 2}
+
+
+def test_sessions_in_one_process_do_not_lose_updates(db_path):
+    async def increment(context):
+        async with StateSession(context) as session:
+            count = session.data.get("count", 0)
+            await asyncio.sleep(0.01)
+            session.update(count=count + 1)
+
+    async def scenario(storage):
+        context = FSMContext(storage, KEY)
+        await asyncio.gather(*[increment(context) for _ in range(5)])
+        return await context.get_data()
+
+    assert run_with([SQLiteStorage(db_path)], scenario) == {"count": 5}
+
+
+def test_concurrent_write_from_another_process_is_kept(db_path):
+    # Два хранилища на одном файле — как два процесса webhook-сервера
+    async def scenario(first, second):
+        async with StateSession(FSMContext(first, KEY)) as session:
+            async with StateSession(FSMContext(second, KEY)) as other:
+                other.update(address="Москва")
+                other.set_state("DocumentForm:entering_complaint_info")
+            session.update(name="Иванов")
+        return await first.get_record(KEY)
+
+    state, data, version = run_with([SQLiteStorage(db_path), SQLiteStorage(db_path)], scenario)
+    assert state == "DocumentForm:entering_complaint_info"
+    assert data == {"address": "Москва", "name": "Иванов"}
+    assert version == 2
+
+
+def test_clear_removes_record(db_path):
+    async def scenario(storage):
+        context = FSMContext(storage, KEY)
+        async with StateSession(context) as session:
+            session.update(name="Иванов")
+            session.set_state("DocumentForm:confirming_document")
+        async with StateSession(context) as session:
+            session.clear()
+        return await storage.get_record(KEY)
+
+    assert run_with([SQLiteStorage(db_path)], scenario) == (None, {}, 0)
+
+
+def test_stale_version_is_rejected(db_path):
+    async def scenario(storage):
+        assert await storage.set_state_and_data(KEY, "S:one", {"a": 1}, version=0)
+        assert not await storage.set_state_and_data(KEY, "S:two", {"a": 2}, version=0)
+        assert await storage.set_state_and_data(KEY, "S:two", {"a": 2}, version=1)
+        return await storage.get_record(KEY)
+
+    assert run_with([SQLiteStorage(db_path)], scenario) == ("S:two", {"a": 2}, 2)
+
+
+def test_file_without_version_column_is_upgraded(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL DEFAULT '{}')")
+    conn.execute("INSERT INTO fsm VALUES ('1:2:3:::default', 'S:one', '{\"a\": 1}')")
+    conn.commit()
+    conn.close()
+
+    async def scenario(storage):
+        async with StateSession(FSMContext(storage, KEY)) as session:
+            session.update(b=2)
+        return await storage.get_record(KEY)
+
+    assert run_with([SQLiteStorage(db_path)], scenario) == ("S:one", {"a": 1, "b": 2}, 1)
@@ -0,0 +1,90 @@
+import os
+import json
+
+import pytest
+
+import kb_binary
+from partitions import PartitionedSearch, PartitionView, merge_ranges
+from search import QAIndex, preprocess_text
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+QUERIES = [
+    "как уволиться с работы",
+    "вернуть товар в магазин",
+    "развод через суд",
+    "штраф за превышение скорости",
+    "как получить налоговый вычет",
+    "наследство без завещания",
+]
+
+
+@pytest.fixture(scope="module")
+def base():
+    """База из поставки, разнесенная по трем странам; часть записей — в двух сразу"""
+    with open(os.path.join(ROOT, "data", "qa_base.json"), "r", encoding="utf-8") as f:
+        base = json.load(f)
+    countries = [["Россия"], ["Беларусь"], ["Казахстан"], ["Беларусь", "Россия"]]
+    return [{**item, "country": countries[position % 4]} for position, item in enumerate(base)]
+
+
+def entry_ids(index, query):
+    item, _ = index.best_match(preprocess_text(query))
+    return item and item["id"]
+
+
+def test_merge_ranges():
+    assert merge_ranges([(5, 7), (0, 2), (2, 4), (6, 9)]) == [(0, 4), (5, 9)]
+
+
+def test_country_partitions_cover_exactly_their_phrases(base):
+    index = QAIndex(base)
+    search = PartitionedSearch(index)
+    for country, view in search.countries.items():
+        assert isinstance(view, PartitionView)
+        phrase_ids = {phrase_id for start, end in view.phrase_ranges for phrase_id in range(start, end)}
+        expected = {
+            phrase_id for phrase_id, entry_index in enumerate(index.phrase_entries)
+            if country in base[entry_index]["country"]
+        }
+        assert phrase_ids == expected
+        assert len(view) == sum(1 for item in base if country in item["country"])
+        # Записи одного набора стран лежат подряд: на страну — не больше двух диапазонов
+        assert len(view.phrase_ranges) <= 2
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_partition_matches_standalone_index(base, tmp_path, binary):
+    if binary:
+        json_path = str(tmp_path / "qa_base.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(base, f, ensure_ascii=False)
+        bin_path = str(tmp_path / "qa_base.bin")
+        kb_binary.build(json_path, bin_path)
+        index = kb_binary.MmapQAIndex(bin_path)
+    else:
+        index = QAIndex(base)
+    search = PartitionedSearch(index)
+
+    for country, view in search.countries.items():
+        standalone = QAIndex([item for item in base if country in item["country"]])
+        for query in QUERIES:
+            assert entry_ids(view, query) == entry_ids(standalone, query)
+            item, _, _ = search.lookup(preprocess_text(query), country)
+            assert item is None or country in item["country"]
+
+
+def test_partition_questions_in_base_order(base):
+    index = QAIndex(base)
+    view = PartitionedSearch(index).countries["Беларусь"]
+    entry_indexes = [entry_index for entry_index, _ in view.questions()]
+    assert entry_indexes == [i for i, item in enumerate(base) if "Беларусь" in item["country"]]
+
+
+def test_category_partitions(base):
+    search = PartitionedSearch(QAIndex(base), category_routing=True)
+    for (country, category), view in search.partitions.items():
+        for start, end in view.phrase_ranges:
+            for phrase_id in range(start, end):
+                item = base[view.phrase_entries[phrase_id]]
+                assert country in item["country"] and item["category"] == category
@@ -0,0 +1,29 @@
+import os
+import re
+
+from pdf_render import discard_pdf, render_pdf_file
+
+CONTRACT = "\n".join(
+    f"Пункт {number}. Арендатор обязуется вносить плату не позднее десятого числа каждого месяца."
+    for number in range(300)
+)
+
+
+def test_render_pdf_file_writes_valid_multipage_pdf(tmp_path):
+    path = render_pdf_file(CONTRACT, "Договор аренды квартиры", str(tmp_path))
+    assert path is not None
+    with open(path, "rb") as f:
+        data = f.read()
+
+    assert data.startswith(b"%PDF-")
+    assert data.rstrip().endswith(b"%%EOF")
+    # Таблица ссылок на объекты там, куда указывает startxref
+    offset = int(re.search(rb"startxref\s+(\d+)", data).group(1))
+    assert data[offset:offset + 4] == b"xref"
+    pages = len(re.findall(rb"/Type /Page\b", data))
+    assert pages > 1
+    assert int(re.search(rb"/Count (\d+)", data).group(1)) == pages
+
+    discard_pdf(path)
+    assert not os.path.exists(path)
+
@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from scheduler import GenerationScheduler
+from yalm import YaLMError
+
+
+class FakeClient:
+    """Клиент YaLM API без сети: первые failures запросов падают с ошибкой"""
+
+    configured = True
+
+    def __init__(self, failures=0, retryable=True):
+        self.failures = failures
+        self.retryable = retryable
+        self.calls = 0
+
+    def build_payload(self, messages):
+        return {"messages": messages}
+
+    async def complete(self, messages):
+        self.calls += 1
+        # Пауза, чтобы одинаковые запросы успели застать друг друга
+        await asyncio.sleep(0.01)
+        if self.calls <= self.failures:
+            raise YaLMError("Сбой API", retryable=self.retryable)
+        return f"ответ {self.calls}"
+
+    async def stream(self, messages):
+        self.calls += 1
+        yield "начало"
+        if self.calls <= self.failures:
+            raise YaLMError("Обрыв потока", retryable=self.retryable)
+        yield "начало и конец"
+
+    async def close(self):
+        pass
+
+
+def prompt(text):
+    return [{"role": "user", "text": text}]
+
+
+def make_scheduler(client, **kwargs):
+    # Без лимита запросов и без пауз между повторами
+    return GenerationScheduler(client, rate=0, backoff=0, **kwargs)
+
+
+def test_identical_prompts_share_one_request():
+    async def run():
+        client = FakeClient()
+        scheduler = make_scheduler(client)
+        results = await asyncio.gather(*[scheduler.complete(prompt("иск")) for _ in range(5)])
+        return client, scheduler, results
+
+    client, scheduler, results = asyncio.run(run())
+    assert client.calls == 1
+    assert results == ["ответ 1"] * 5
+    assert scheduler.coalesced == 4
+    assert scheduler.stats()["in_flight"] == 0
+
+
+def test_different_prompts_are_sent_separately():
+    async def run():
+        client = FakeClient()
+        scheduler = make_scheduler(client)
+        await asyncio.gather(scheduler.complete(prompt("иск")), scheduler.complete(prompt("жалоба")))
+        return client
+
+    assert asyncio.run(run()).calls == 2
+
+
+def test_retryable_error_is_retried():
+    async def run():
+        client = FakeClient(failures=2)
+        scheduler = make_scheduler(client, max_retries=3)
+        return client, scheduler, await scheduler.complete(prompt("иск"))
+
+    client, scheduler, text = asyncio.run(run())
+    assert text == "ответ 3"
+    assert client.calls == 3
+    assert scheduler.retries == 2
+
+
+def test_retries_stop_after_max_retries():
+    async def run():
+        client = FakeClient(failures=10)
+        scheduler = make_scheduler(client, max_retries=2)
+        with pytest.raises(YaLMError):
+            await scheduler.complete(prompt("иск"))
+        return client
+
+    assert asyncio.run(run()).calls == 3
+
+
+def test_permanent_error_reaches_every_waiter_without_retry():
+    async def run():
+        client = FakeClient(failures=1, retryable=False)
+        scheduler = make_scheduler(client, max_retries=3)
+        results = await asyncio.gather(
+            *[scheduler.complete(prompt("иск")) for _ in range(3)], return_exceptions=True
+        )
+        return client, results
+
+    client, results = asyncio.run(run())
+    assert client.calls == 1
+    assert all(isinstance(result, YaLMError) for result in results)
+
+
+def test_stream_is_not_retried_after_first_chunk():
+    async def run():
+        client = FakeClient(failures=1)
+        scheduler = make_scheduler(client, max_retries=3)
+        received = []
+        with pytest.raises(YaLMError):
+            async for text in scheduler.stream(prompt("иск")):
+                received.append(text)
+        return client, received
+
+    client, received = asyncio.run(run())
+    assert client.calls == 1
+    assert received == ["начало"]
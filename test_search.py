@@ -0,0 +1,63 @@
+import os
+import json
+
+import pytest
+
+import kb_binary
+import check_search
+from search import QAIndex, calculate_similarity, extract_features, preprocess_text, required_overlap
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BASE_PATH = os.path.join(ROOT, "data", "qa_base.json")
+CORPUS_PATH = os.path.join(ROOT, "data", "bench_messages.jsonl")
+
+
+@pytest.fixture(scope="module")
+def base():
+    with open(BASE_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+@pytest.fixture(scope="module")
+def corpus(base):
+    """Запросы корпуса и ответы полного перебора для них"""
+    queries = check_search.build_queries(base, CORPUS_PATH, perturbed=400)
+    return queries, check_search.expected_matches(base, QAIndex(base), queries)
+
+
+def test_lookup_matches_linear_scan_on_corpus(base, corpus):
+    # Настройки по умолчанию — те же, что у бота
+    queries, expected = corpus
+    index = QAIndex(base)
+    assert [check_search.entry_ids(index, query) for query in queries] == expected
+
+
+def test_binary_lookup_matches_linear_scan_on_corpus(base, corpus, tmp_path):
+    queries, expected = corpus
+    bin_path = str(tmp_path / "qa_base.bin")
+    kb_binary.build(BASE_PATH, bin_path)
+    index = kb_binary.MmapQAIndex(bin_path)
+    assert [check_search.entry_ids(index, query) for query in queries] == expected
+
+
+def test_unbounded_scan_matches_linear_scan_with_tiny_candidate_budget(base, corpus):
+    # Почти без кандидатов и с урезанными списками признаков результат держится только на досмотре
+    queries, expected = corpus
+    index = QAIndex(base, top_k=1, exact_limit=0)
+    index.posting_limit = 50
+    assert [check_search.entry_ids(index, query) for query in queries] == expected
+
+
+def test_required_overlap_is_a_lower_bound(base):
+    phrases = [preprocess_text(item["question"]) for item in base]
+    # Правки, после которых ratio остается высоким: опечатки, пропуски, лишние слова
+    variants = []
+    for phrase in phrases:
+        variants += [phrase[1:], phrase[:-2], phrase.replace("о", "а", 1), phrase + " срочно"]
+    for query, phrase in zip(variants, [p for p in phrases for _ in range(4)]):
+        ratio = calculate_similarity(query, phrase)
+        for bound_ratio in (0.86, 0.9, 0.95):
+            if ratio >= bound_ratio:
+                shared = len(extract_features(query) & extract_features(phrase))
+                assert shared >= required_overlap(query, bound_ratio)
+    assert required_overlap("как вернуть товар", 0.6) <= 0
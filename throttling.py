@@ -0,0 +1,114 @@
+"""
+Ограничение частоты сообщений от одного пользователя.
+
+Обработчики делятся на дешевые (поиск по базе, команды) и дорогие —
+помеченные флагом cost="expensive" (генерация документов). Для каждого
+пользователя ведутся два ведра токенов, дорогие обработчики расходуют оба.
+Кроме того, в одном чате одновременно выполняется не больше chat_in_flight
+генераций, а при глубокой очереди к YaLM API (overloaded() возвращает True)
+новые генерации не принимаются вовсе. Лимиты действуют в пределах процесса.
+"""
+import logging
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+
+from scheduler import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITED_TEXT = "Слишком много сообщений. Подождите {seconds} с и повторите."
+IN_FLIGHT_TEXT = "Дождитесь окончания генерации предыдущего документа."
+OVERLOADED_TEXT = "Сейчас слишком много запросов на генерацию документов. Попробуйте через пару минут."
+
+
+class _UserLimits:
+    __slots__ = ("cheap", "expensive", "warned")
+
+    def __init__(self, middleware):
+        self.cheap = TokenBucket(middleware.rate, middleware.burst)
+        self.expensive = TokenBucket(middleware.expensive_rate, middleware.expensive_burst)
+        # Предупреждение о лимите отправляется один раз, пока сообщения отклоняются
+        self.warned = False
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware: отклоняет сообщение до вызова обработчика, если
+    пользователь превысил лимит. rate=0 отключает соответствующее ограничение.
+    """
+
+    def __init__(self, registry, rate=1.0, burst=5, expensive_rate=0.1, expensive_burst=2,
+                 chat_in_flight=1, overloaded=None, max_users=10000):
+        self.rate = rate
+        self.burst = burst
+        self.expensive_rate = expensive_rate
+        self.expensive_burst = expensive_burst
+        self.chat_in_flight = chat_in_flight
+        self.overloaded = overloaded
+        self.max_users = max_users
+        self._users = OrderedDict()
+        self._in_flight = {}
+        self.throttled_total = registry.counter(
+            "lexoai_throttled_total", "Отклоненные сообщения: rate, expensive_rate, in_flight, overload", ["reason"]
+        )
+
+    def _limits(self, user_id):
+        limits = self._users.get(user_id)
+        if limits is None:
+            limits = self._users[user_id] = _UserLimits(self)
+            # Давно не писавшие пользователи вытесняются, их ведра и так полные
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return limits
+
+    async def _reject(self, event, reason, text, limits=None):
+        self.throttled_total.inc(reason)
+        if limits is not None:
+            if limits.warned:
+                return None
+            limits.warned = True
+        logger.warning(f"Сообщение от {event.from_user.id} отклонено: {reason}")
+        await event.answer(text)
+        return None
+
+    async def __call__(self, handler, event, data):
+        user = getattr(event, "from_user", None)
+        if user is None:
+            return await handler(event, data)
+
+        expensive = get_flag(data, "cost") == "expensive"
+        limits = self._limits(user.id)
+
+        delay = limits.cheap.delay()
+        reason = "rate"
+        if expensive and limits.expensive.delay() > delay:
+            delay = limits.expensive.delay()
+            reason = "expensive_rate"
+        if delay > 0:
+            return await self._reject(event, reason, RATE_LIMITED_TEXT.format(seconds=max(1, round(delay))), limits)
+        limits.warned = False
+
+        if not expensive:
+            limits.cheap.take()
+            return await handler(event, data)
+
+        # Один чат с разными ботами процесса — разные диалоги
+        dialog = (data["bot"].id, event.chat.id)
+        if self.chat_in_flight > 0 and self._in_flight.get(dialog, 0) >= self.chat_in_flight:
+            return await self._reject(event, "in_flight", IN_FLIGHT_TEXT)
+        if self.overloaded is not None and self.overloaded():
+            return await self._reject(event, "overload", OVERLOADED_TEXT)
+
+        limits.cheap.take()
+        limits.expensive.take()
+        self._in_flight[dialog] = self._in_flight.get(dialog, 0) + 1
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight[dialog] -= 1
+            if not self._in_flight[dialog]:
+                del self._in_flight[dialog]
@@ -0,0 +1,150 @@
+import os
+import signal
+import asyncio
+import functools
+import logging
+import multiprocessing
+
+from aiohttp import web
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import setup_application
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookConfig:
+    """Настройки режима webhook из переменных окружения"""
+
+    def __init__(self):
+        self.url = os.getenv("WEBHOOK_URL", "")
+        self.path = os.getenv("WEBHOOK_PATH", "/webhook")
+        self.host = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+        self.port = int(os.getenv("WEBHOOK_PORT", "8080"))
+        self.secret = os.getenv("WEBHOOK_SECRET") or None
+        self.workers = int(os.getenv("WEBHOOK_WORKERS", "1"))
+        self.max_concurrency = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "100"))
+        self.shutdown_timeout = float(os.getenv("WEBHOOK_SHUTDOWN_TIMEOUT", "30"))
+
+
+def webhook_path(config, bot, bots):
+    """Путь webhook бота: у единственного бота — WEBHOOK_PATH, иначе WEBHOOK_PATH/<id бота>"""
+    if len(bots) == 1:
+        return config.path
+    return f"{config.path.rstrip('/')}/{bot.id}"
+
+
+def create_webhook_app(dp, bots, config):
+    """
+    Приложение aiohttp, принимающее обновления Telegram для всех ботов.
+
+    Обновление сразу подтверждается ответом 200, а обрабатывается в фоне.
+    Одновременно обрабатывается не больше config.max_concurrency обновлений,
+    остальные ждут своей очереди. При остановке приложение дожидается
+    обработки уже принятых обновлений.
+    """
+    semaphore = asyncio.Semaphore(config.max_concurrency)
+    tasks = set()
+
+    async def process_update(bot, data):
+        async with semaphore:
+            try:
+                await dp.feed_raw_update(bot, data)
+            except Exception as e:
+                logger.exception(f"Ошибка при обработке обновления: {e}")
+
+    async def handle_update(bot, request):
+        if config.secret and request.headers.get(SECRET_HEADER) != config.secret:
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        task = asyncio.create_task(process_update(bot, data))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return web.Response()
+
+    async def drain_updates(app):
+        if tasks:
+            logger.info(f"Ожидание обработки {len(tasks)} обновлений перед остановкой")
+            await asyncio.wait(set(tasks), timeout=config.shutdown_timeout)
+
+    app = web.Application()
+    for bot in bots:
+        app.router.add_post(webhook_path(config, bot, bots), functools.partial(handle_update, bot))
+    # Сначала дожидаемся обновлений, затем останавливаем диспетчер
+    app.on_shutdown.append(drain_updates)
+    setup_application(app, dp, bots=bots)
+    return app
+
+
+async def set_webhook(bots, config):
+    """Регистрирует webhook каждого бота в Telegram (один раз, до запуска процессов)"""
+    for bot in bots:
+        url = config.url.rstrip("/") + webhook_path(config, bot, bots)
+        await bot.set_webhook(url, secret_token=config.secret)
+        logger.info(f"Webhook установлен: {url}")
+    for bot in bots:
+        await bot.session.close()
+
+
+def _run_worker(dp, bots, config):
+    app = create_webhook_app(dp, bots, config)
+    # reuse_port позволяет нескольким процессам слушать один порт
+    web.run_app(
+        app,
+        host=config.host,
+        port=config.port,
+        reuse_port=config.workers > 1,
+        shutdown_timeout=config.shutdown_timeout,
+        print=None
+    )
+
+
+def run_webhook(dp, bots, config=None):
+    """
+    Запускает ботов в режиме webhook в config.workers процессах на одном порту.
+    Без WEBHOOK_URL webhook в Telegram не регистрируется — удобно для локальной
+    проверки: обновления можно отправлять POST-запросом на WEBHOOK_PATH.
+    """
+    config = config or WebhookConfig()
+
+    # Состояние диалога в памяти у каждого процесса свое: следующее сообщение
+    # пользователя может попасть в другой процесс и потерять заполненную форму
+    if config.workers > 1 and isinstance(dp.storage, MemoryStorage):
+        raise RuntimeError(
+            "WEBHOOK_WORKERS > 1 требует общего хранилища FSM: FSM_STORAGE=sqlite или redis"
+        )
+
+    if config.url:
+        asyncio.run(set_webhook(bots, config))
+    else:
+        logger.warning("WEBHOOK_URL не задан, webhook в Telegram не регистрируется")
+
+    logger.info(f"Webhook-сервер на {config.host}:{config.port}{config.path}, процессов: {config.workers}")
+    if config.workers <= 1:
+        _run_worker(dp, bots, config)
+        return
+
+    # Процессы наследуют уже созданных ботов и диспетчер
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=_run_worker, args=(dp, bots, config), daemon=False)
+        for _ in range(config.workers)
+    ]
+    for process in processes:
+        process.start()
+
+    def stop(signum, frame):
+        logger.info("Остановка процессов webhook-сервера...")
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for process in processes:
+        process.join()
@@ -0,0 +1,165 @@
+import os
+import json
+import asyncio
+import logging
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+API_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+
+
+# Коды ответа, после которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class YaLMError(Exception):
+    """
+    Ошибка при обращении к YaLM API.
+    retryable — временная ошибка (лимит запросов, таймаут, сбой сети),
+    retry_after — пауза из заголовка Retry-After, если API ее указал.
+    """
+
+    def __init__(self, message, retryable=False, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+def _request_error(e):
+    """Превращает ошибку aiohttp в YaLMError с признаком повторяемости"""
+    if isinstance(e, aiohttp.ClientResponseError):
+        retry_after = None
+        if e.headers is not None:
+            try:
+                retry_after = float(e.headers.get("Retry-After"))
+            except (TypeError, ValueError):
+                pass
+        return YaLMError(f"Ошибка запроса к YaLM API: {e!r}",
+                         retryable=e.status in RETRYABLE_STATUSES, retry_after=retry_after)
+    return YaLMError(f"Ошибка запроса к YaLM API: {e!r}", retryable=True)
+
+
+class YaLMClient:
+    """
+    Асинхронный клиент YandexGPT.
+
+    Одна сессия aiohttp с пулом keep-alive соединений живет все время работы
+    бота, а семафор ограничивает число одновременных запросов к API.
+    """
+
+    def __init__(self, api_key=None, catalog_id=None, api_url=API_URL,
+                 timeout=60, connect_timeout=10, max_concurrency=10, keepalive_timeout=30):
+        self.api_key = api_key
+        self.catalog_id = catalog_id
+        self.api_url = api_url
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=connect_timeout)
+        self.max_concurrency = max_concurrency
+        self.keepalive_timeout = keepalive_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+
+    @classmethod
+    def from_env(cls):
+        """Создает клиент по переменным окружения"""
+        return cls(
+            api_key=os.getenv("YALM_API_KEY"),
+            catalog_id=os.getenv("CATALOG_ID"),
+            api_url=os.getenv("YALM_API_URL", API_URL),
+            timeout=float(os.getenv("YALM_TIMEOUT", "60")),
+            connect_timeout=float(os.getenv("YALM_CONNECT_TIMEOUT", "10")),
+            max_concurrency=int(os.getenv("YALM_MAX_CONCURRENCY", "10")),
+        )
+
+    @property
+    def configured(self):
+        return bool(self.api_key and self.catalog_id)
+
+    @property
+    def model_uri(self):
+        return f"gpt://{self.catalog_id}/yandexgpt/latest"
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={
+                    "Authorization": f"Api-Key {self.api_key}",
+                    "Content-Type": "application/json"
+                }
+            )
+        return self._session
+
+    def build_payload(self, messages, temperature=0.3, max_tokens=2000, stream=False):
+        return {
+            "modelUri": self.model_uri,
+            "completionOptions": {
+                "stream": stream,
+                "temperature": temperature,
+                "maxTokens": str(max_tokens)
+            },
+            "messages": messages
+        }
+
+    async def complete(self, messages, temperature=0.3, max_tokens=2000):
+        """Отправляет запрос на генерацию и возвращает текст ответа"""
+        if not self.configured:
+            raise YaLMError("Отсутствуют необходимые переменные окружения для YaLM API")
+
+        payload = self.build_payload(messages, temperature, max_tokens)
+        session = await self._get_session()
+        async with self._semaphore:
+            try:
+                async with session.post(self.api_url, json=payload) as response:
+                    response.raise_for_status()
+                    result = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise _request_error(e) from e
+
+        return self._extract_text(result)
+
+    async def stream(self, messages, temperature=0.3, max_tokens=2000):
+        """
+        Потоковая генерация. YaLM API отдает ответ построчно в формате JSON,
+        каждая строка содержит весь сгенерированный к этому моменту текст,
+        его и отдает генератор.
+        """
+        if not self.configured:
+            raise YaLMError("Отсутствуют необходимые переменные окружения для YaLM API")
+
+        payload = self.build_payload(messages, temperature, max_tokens, stream=True)
+        session = await self._get_session()
+        async with self._semaphore:
+            try:
+                async with session.post(self.api_url, json=payload) as response:
+                    response.raise_for_status()
+                    async for line in response.content:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            chunk = json.loads(line)
+                        except ValueError as e:
+                            raise YaLMError(f"Некорректная строка в потоке YaLM API: {line[:200]!r}") from e
+                        yield self._extract_text(chunk)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise _request_error(e) from e
+
+    @staticmethod
+    def _extract_text(result):
+        try:
+            return result["result"]["alternatives"][0]["message"]["text"]
+        except (KeyError, IndexError, TypeError) as e:
+            raise YaLMError(f"Неожиданный ответ YaLM API: {result}") from e
+
+    async def close(self):
+        """Закрывает пул соединений"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None